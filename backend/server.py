@@ -1,4 +1,5 @@
-from fastapi import FastAPI, APIRouter, WebSocket, WebSocketDisconnect, HTTPException, Depends, Request
+from fastapi import FastAPI, APIRouter, WebSocket, HTTPException, Depends, Request, Query, Response
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
 from dotenv import load_dotenv
@@ -8,13 +9,28 @@ import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, validator
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, AsyncIterator, Callable, Tuple
+from contextlib import asynccontextmanager
 import uuid
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
 import json
 import asyncio
 import time
-from collections import defaultdict
+import functools
+import bisect
+import hashlib
+import base64
+import re
+import unicodedata
+import random
+import hmac
+import zlib
+import heapq
+from collections import OrderedDict, deque
+from pymongo import ReturnDocument, CursorType, ReplaceOne
+from pymongo.errors import BulkWriteError, CollectionInvalid, DuplicateKeyError
+from bson import json_util
 from emergentintegrations.llm.chat import LlmChat, UserMessage
 
 ROOT_DIR = Path(__file__).parent
@@ -26,6 +42,192 @@ MAX_MESSAGE_LENGTH = 2000
 MAX_MESSAGES_PER_MINUTE = 10
 MAX_DAILY_MESSAGES = 200
 SESSION_TIMEOUT_HOURS = 24
+WS_INBOUND_QUEUE_SIZE = 4
+WS_SEND_HIGH_WATER = 256
+# Idle sockets are pinged after this long; clients that speak the heartbeat protocol
+# are closed if nothing arrives within the pong timeout
+WS_PING_INTERVAL_SECONDS = float(os.environ.get('WS_PING_INTERVAL_SECONDS', '20'))
+WS_PONG_TIMEOUT_SECONDS = float(os.environ.get('WS_PONG_TIMEOUT_SECONDS', '10'))
+# Clients that never sent a heartbeat frame are only closed after this long without any frame
+WS_IDLE_TIMEOUT_SECONDS = SESSION_TIMEOUT_HOURS * 3600
+MAINTENANCE_INTERVAL_SECONDS = 60
+EXPIRY_MAX_SLEEP_SECONDS = 60
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'True').lower() == 'true'
+STREAM_CHUNK_SIZE = 64
+CHAT_POOL_SIZE = int(os.environ.get('CHAT_POOL_SIZE', '1000'))
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', '5000'))
+RESPONSE_CACHE_TTL_SECONDS = int(os.environ.get('RESPONSE_CACHE_TTL_SECONDS', str(6 * 3600)))
+RESPONSE_CACHE_SHARED = os.environ.get('RESPONSE_CACHE_SHARED', 'False').lower() == 'true'
+# Long, personal messages practically never repeat, so only short questions are cached
+RESPONSE_CACHE_MAX_MESSAGE_LENGTH = 300
+PROFILE_CACHE_SIZE = int(os.environ.get('PROFILE_CACHE_SIZE', '10000'))
+PROFILE_CACHE_TTL_SECONDS = int(os.environ.get('PROFILE_CACHE_TTL_SECONDS', '300'))
+PROFILE_POLL_INTERVAL_SECONDS = 5
+CHAT_WRITE_BATCH_SIZE = int(os.environ.get('CHAT_WRITE_BATCH_SIZE', '100'))
+CHAT_WRITE_FLUSH_SECONDS = float(os.environ.get('CHAT_WRITE_FLUSH_SECONDS', '0.5'))
+CHAT_WRITE_QUEUE_SIZE = int(os.environ.get('CHAT_WRITE_QUEUE_SIZE', '10000'))
+CHAT_WRITE_MAX_RETRIES = 3
+CHAT_SPILL_DIR = Path(os.environ.get('CHAT_SPILL_DIR', str(ROOT_DIR / 'spill')))
+CONTEXT_ENABLED = os.environ.get('CONTEXT_ENABLED', 'True').lower() == 'true'
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', '1500'))
+CONTEXT_SUMMARIZE_EVERY = int(os.environ.get('CONTEXT_SUMMARIZE_EVERY', '10'))
+CONTEXT_KEEP_RECENT = 4
+CONTEXT_TURN_RESPONSE_CHARS = 600
+CONTEXT_SUMMARY_MAX_TOKENS = 500
+CONTEXT_STATE_TTL_SECONDS = 1800
+# A failed summary is retried after this delay, doubling per failure up to the maximum
+CONTEXT_SUMMARY_RETRY_SECONDS = 30
+CONTEXT_SUMMARY_MAX_RETRY_SECONDS = 900
+PLAN_WORKERS = int(os.environ.get('PLAN_WORKERS', '4'))
+PLAN_QUEUE_SIZE = 1000
+# Plans run off the request path, so they get a far larger budget than chat and
+# a single attempt may use all of it
+PLAN_DEADLINE_SECONDS = float(os.environ.get('PLAN_DEADLINE_SECONDS', '120'))
+PLAN_LEASE_SECONDS = 300
+PLAN_MAX_ATTEMPTS = 3
+# A job whose attempt hit overload or an outage is requeued after this delay, doubling per attempt
+PLAN_RETRY_BASE_SECONDS = 15
+PLAN_RETRY_MAX_SECONDS = 300
+PLAN_DEDUPE_SECONDS = 24 * 3600
+PLAN_PROGRESS_INTERVAL_SECONDS = 2.0
+PLAN_RECOVERY_INTERVAL_SECONDS = 60
+EXPORT_BATCH_SIZE = 500
+EXPORT_FLUSH_BYTES = 64 * 1024
+IMPORT_BATCH_SIZE = 500
+IMPORT_MAX_LINE_BYTES = 64 * 1024
+IMPORT_MAX_REPORTED_ERRORS = 20
+CHAT_BATCH_MAX_ITEMS = 500
+CHAT_BATCH_CONCURRENCY = int(os.environ.get('CHAT_BATCH_CONCURRENCY', '16'))
+# Messages older than this move from chat_messages into compressed monthly buckets; 0 disables archiving
+CHAT_ARCHIVE_AFTER_DAYS = int(os.environ.get('CHAT_ARCHIVE_AFTER_DAYS', '30'))
+# Messages older than this are deleted from both tiers; 0 keeps history forever
+CHAT_RETENTION_DAYS = int(os.environ.get('CHAT_RETENTION_DAYS', '0'))
+CHAT_ARCHIVE_INTERVAL_SECONDS = 3600
+CHAT_ARCHIVE_BATCH_SIZE = 2000
+# Keeps a bucket well under the 16MB document limit even with 4000-token responses
+CHAT_ARCHIVE_BUCKET_SIZE = 200
+CHAT_ARCHIVE_LOCK_SECONDS = 900
+# Day boundaries for daily counts and streaks follow the users' local time
+STATS_TIMEZONE = ZoneInfo(os.environ.get('STATS_TIMEZONE', 'Asia/Jerusalem'))
+STATS_DEFAULT_DAYS = 30
+STATS_BACKFILL_BATCH_SIZE = 500
+LLM_MAX_IN_FLIGHT = int(os.environ.get('LLM_MAX_IN_FLIGHT', '32'))
+LLM_MAX_QUEUE = int(os.environ.get('LLM_MAX_QUEUE', '256'))
+LLM_QUEUE_TIMEOUT_SECONDS = float(os.environ.get('LLM_QUEUE_TIMEOUT_SECONDS', '10'))
+# Per-attempt upstream timeout and overall budget; kept under the frontend's 30s request timeout
+LLM_ATTEMPT_TIMEOUT_SECONDS = float(os.environ.get('LLM_ATTEMPT_TIMEOUT_SECONDS', '12'))
+LLM_DEADLINE_SECONDS = float(os.environ.get('LLM_DEADLINE_SECONDS', '25'))
+LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', '2'))
+LLM_RETRY_BASE_DELAY_SECONDS = 0.25
+LLM_RETRY_MAX_DELAY_SECONDS = 2.0
+LLM_HEDGE_ENABLED = os.environ.get('LLM_HEDGE_ENABLED', 'True').lower() == 'true'
+LLM_HEDGE_MIN_SAMPLES = 20
+LLM_HEDGE_MIN_DELAY_SECONDS = 0.5
+LLM_LATENCY_WINDOW = 200
+LLM_CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('LLM_CIRCUIT_FAILURE_THRESHOLD', '5'))
+LLM_CIRCUIT_RESET_SECONDS = float(os.environ.get('LLM_CIRCUIT_RESET_SECONDS', '30'))
+# Lower value is served first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_STANDARD = 1
+PRIORITY_BATCH = 2
+# Model routing table; LLM_ROUTES (JSON) overrides fields per route, e.g. '{"plan": {"model": "gemini-2.5-pro"}}'
+DEFAULT_LLM_ROUTES = {
+    "small_talk": {"model": "gemini-2.0-flash-lite", "max_tokens": 300, "system_prompt": "brief"},
+    "standard": {"model": "gemini-2.0-flash", "max_tokens": 2000, "system_prompt": "full"},
+    "plan": {"model": "gemini-2.5-flash", "max_tokens": 6000, "system_prompt": "full", "attempt_timeout": 20}
+}
+ROUTE_SMALL_TALK_MAX_WORDS = 4
+# Long messages from users with goals on file are usually asking for a tailored program
+ROUTE_PLAN_MIN_CHARS = 400
+ROUTE_SMALL_TALK_WORDS = {
+    "שלום", "היי", "הי", "אהלן", "בוקר", "ערב", "טוב", "לילה", "תודה", "רבה", "תודות", "אחלה", "סבבה",
+    "מעולה", "יופי", "מגניב", "אוקיי", "אוקי", "בסדר", "ביי", "להתראות", "נתראה", "מה", "נשמע", "שלומך",
+    "hi", "hello", "hey", "thanks", "thank", "you", "ok", "okay", "cool", "great", "bye", "good", "morning"
+}
+# Short messages that do not refer back to earlier turns are answered without conversation
+# context, so repeated questions stay cacheable for returning users
+ROUTE_STANDALONE_MAX_WORDS = 8
+ROUTE_FOLLOW_UP_WORDS = (
+    "זה", "זאת", "זו", "אותו", "אותה", "אותם", "אותן", "עוד", "שוב", "גם", "ואם", "ומה", "קודם", "הקודם",
+    "הקודמת", "אמרת", "במקום", "ההוא", "ההיא",
+    "it", "that", "this", "these", "those", "more", "again", "also", "instead", "previous", "earlier", "said"
+)
+ROUTE_PLAN_KEYWORDS = (
+    "תוכנית", "תכנית", "תוכניות", "תכניות", "תפריט", "לוח זמנים", "שבועות", "חודשים",
+    "program", "plan", "schedule", "meal prep", "weeks"
+)
+# Topic histogram keywords; a message counts toward every topic it mentions, or "other"
+STATS_TOPIC_KEYWORDS = {
+    "workout": (
+        "אימון", "אימונים", "להתאמן", "מתאמן", "מתאמנת", "כושר", "ריצה", "לרוץ", "משקולות", "סקוואט",
+        "שכיבות", "מתח", "סטים", "חזרות", "אירובי", "מתיחות", "חדר כושר",
+        "workout", "training", "exercise", "gym", "squat", "cardio", "running"
+    ),
+    "nutrition": (
+        "תזונה", "אוכל", "לאכול", "ארוחה", "ארוחת", "ארוחות", "חלבון", "פחמימות", "שומן", "קלוריות",
+        "דיאטה", "ירקות", "פירות", "ויטמין", "תוסף", "תוספי",
+        "nutrition", "diet", "protein", "calories", "carbs", "meal", "food"
+    ),
+    "motivation": (
+        "מוטיבציה", "כוח רצון", "עייף", "עייפה", "לוותר", "להתמיד", "התמדה", "עצלן", "עצלנית",
+        "משעמם", "הרגל", "הרגלים", "מצב רוח", "קשה לי",
+        "motivation", "motivated", "tired", "lazy", "habit", "give up"
+    )
+}
+FULL_SYSTEM_MESSAGE = """אתה מאמן כושר מקצועי ומומחה ברמה גבוהה ביותר, עם ניסיון של 20 שנה בתחום הכושר, התזונה והמוטיבציה. אתה דובר עברית באופן מושלם ומתמחה במתן עצות מותאמות אישית.
+
+## התפקיד שלך:
+🏋️‍♂️ **מאמן כושר מקצועי** - מנתח כל בקשה בעומק ונותן תוכניות מותאמות אישית
+🥗 **יועץ תזונה מוסמך** - מספק עצות תזונה מקצועיות ומותאמות אישית  
+🧠 **מוטיבטור מקצועי** - מעניק מוטיבציה אישית והנחיה רגשית
+📊 **אנליסט כושר** - מנתח את המצב הנוכחי ומתכנן את הדרך קדימה
+
+## דרישות המקצועיות שלך:
+1. **ניתוח מעמיק** - בכל שאלה, תנתח:
+   - המטרות של השואל
+   - רמת הכושר המשוערת  
+   - הקונטקסט המלא
+   - דרכי התאמה אישית
+
+2. **תשובות מקצועיות** - כל תשובה תכלול:
+   - ניתוח מפורט של הבקשה
+   - עצות ספציפיות ומפורטות
+   - תוכנית פעולה ברורה
+   - שאלות המעמיקות
+
+3. **בטיחות מקצועית**:
+   - תמיד תדגיש בטיחות באימונים
+   - תמליץ להתייעץ עם רופא במקרים רפואיים
+   - תתן עצות מבוססות מחקר מדעי
+
+## סגנון מקצועי:
+- עברית מושלמת עם אימוג'ים רלוונטיים 💪🔥🏋️‍♂️🥗🎯
+- מבנה ברור עם כותרות
+- דוגמאות מעשיות וספציפיות
+- תמיד עם המלצה למעקב
+
+זכור: אתה מאמן אמיתי שמקדיש זמן, מנתח לעומק, ובאמת אכפת לו מההצלחה של המשתמש!"""
+# Same instructions in about a third of the tokens; select with SYSTEM_PROMPT_VERSION=v2
+COMPACT_SYSTEM_MESSAGE = """אתה מאמן כושר, יועץ תזונה ומוטיבטור מקצועי עם 20 שנות ניסיון, ודובר עברית מושלמת.
+בכל תשובה:
+- נתח את המטרות, רמת הכושר וההקשר של המשתמש
+- תן עצות ספציפיות ומותאמות אישית ותוכנית פעולה ברורה
+- הדגש בטיחות, המלץ להתייעץ עם רופא במקרים רפואיים והסתמך על מחקר מדעי
+- סיים בהמלצה למעקב או בשאלה מעמיקה
+כתוב במבנה ברור עם כותרות, דוגמאות מעשיות ואימוג'ים רלוונטיים 💪🥗🎯"""
+BRIEF_SYSTEM_MESSAGE = """אתה מאמן כושר ותזונה ידידותי שמדבר עברית.
+ענה בקצרה ובחום, במשפט או שניים עם אימוג'י מתאים.
+אם המשתמש רוצה עזרה מקצועית, הזמן אותו לשאול על אימונים, תזונה או יעדים."""
+# System prompts by name and version; PROMPTS_DIR files named <name>.<version>.txt add or replace versions
+SYSTEM_PROMPT_VERSION = os.environ.get('SYSTEM_PROMPT_VERSION', 'v1')
+PROMPTS_DIR = Path(os.environ.get('PROMPTS_DIR', str(ROOT_DIR / 'prompts')))
+SUMMARY_SYSTEM_MESSAGE = """אתה מסכם שיחות בין מאמן כושר למתאמן.
+עדכן את הסיכום הקודם עם ההודעות החדשות בעברית תמציתית, עד 150 מילים.
+שמור רק מידע שימושי להמשך האימון: מטרות, מגבלות ופציעות, העדפות, תוכניות שניתנו והתקדמות."""
+SYSTEM_PROMPTS = {
+    "full": {"v1": FULL_SYSTEM_MESSAGE, "v2": COMPACT_SYSTEM_MESSAGE},
+    "brief": {"v1": BRIEF_SYSTEM_MESSAGE}
+}
 
 # MongoDB connection with production settings
 mongo_url = os.environ['MONGO_URL']
@@ -55,192 +257,2926 @@ if PRODUCTION_MODE:
         allowed_hosts=["*"]
     )
 
+# JSON serialization
+try:
+    import orjson
+except ImportError:  # optional speedup; the stdlib path below renders the same bytes
+    orjson = None
+
+def json_dumps(content: Any) -> bytes:
+    """Compact UTF-8 JSON, byte-identical to Starlette's JSONResponse rendering.
+
+    Callers pass plain JSON types (datetimes already converted), which both
+    encoders render the same way.
+    """
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+def json_text(content: Any) -> str:
+    return json_dumps(content).decode("utf-8")
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with json_dumps; routes return it to skip response_model re-validation"""
+
+    def render(self, content: Any) -> bytes:
+        return json_dumps(content)
+
+# Metrics
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _format_labels(names, values) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+class Counter:
+    def __init__(self, registry, name: str, help_text: str, labels=()):
+        self.registry = registry
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        if self.registry.enabled:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for label_values, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+class Gauge:
+    """Gauge read from a callback at scrape time, so the hot path pays nothing.
+
+    With `labels`, the callback returns a dict of label values -> sample.
+    """
+
+    def __init__(self, registry, name: str, help_text: str, callback, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.callback = callback
+        self.labels = labels
+
+    def render(self) -> List[str]:
+        try:
+            value = self.callback()
+        except Exception:
+            return []
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        if not self.labels:
+            lines.append(f"{self.name} {value}")
+            return lines
+        for label_values, sample in value.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {sample}")
+        return lines
+
+class Histogram:
+    def __init__(self, registry, name: str, help_text: str, labels=(), buckets=LATENCY_BUCKETS):
+        self.registry = registry
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [per-bucket counts (+Inf last), sum, count]
+        self._series: Dict[tuple, List[Any]] = {}
+
+    def observe(self, value: float, *label_values):
+        if not self.registry.enabled:
+            return
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def time(self, *label_values):
+        return _Timer(self, label_values)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(self.labels + ('le',), label_values + (le,))} {cumulative}"
+                )
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, label_values)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, label_values)} {count}")
+        return lines
+
+class _Timer:
+    __slots__ = ('histogram', 'label_values', 'started')
+
+    def __init__(self, histogram: Histogram, label_values: tuple):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, *self.label_values)
+
+class MetricsRegistry:
+    """Minimal Prometheus-compatible registry.
+
+    When disabled, recording methods return immediately, `timed` leaves
+    functions undecorated and the HTTP middleware is not installed.
+    """
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self._metrics: List[Any] = []
+
+    def counter(self, name: str, help_text: str, labels=()) -> Counter:
+        return self._register(Counter(self, name, help_text, labels))
+
+    def gauge(self, name: str, help_text: str, callback, labels=()) -> Gauge:
+        return self._register(Gauge(self, name, help_text, callback, labels))
+
+    def histogram(self, name: str, help_text: str, labels=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(self, name, help_text, labels, buckets))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry(METRICS_ENABLED)
+
+def timed(histogram: Histogram, *label_values):
+    """Decorator recording the duration of an async function into `histogram`"""
+    def decorator(func):
+        if not metrics.enabled:
+            return func
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, *label_values)
+        return wrapper
+    return decorator
+
+REQUEST_SECONDS = metrics.histogram(
+    "http_request_duration_seconds", "Total HTTP request time", labels=("method", "route", "status")
+)
+AI_RESPONSE_SECONDS = metrics.histogram(
+    "ai_response_duration_seconds", "get_response time including cache lookups"
+)
+LLM_SECONDS = metrics.histogram(
+    "llm_request_duration_seconds", "Upstream Gemini call time"
+)
+PROFILE_LOOKUP_SECONDS = metrics.histogram(
+    "profile_lookup_duration_seconds", "Profile lookup time including cache hits"
+)
+DB_INSERT_SECONDS = metrics.histogram(
+    "chat_db_insert_duration_seconds", "chat_messages insert_many batch time"
+)
+RATE_LIMIT_REJECTIONS = metrics.counter(
+    "rate_limit_rejections_total", "Messages rejected by the rate limiter", labels=("channel",)
+)
+LLM_SHED = metrics.counter(
+    "llm_requests_shed_total", "LLM calls rejected by admission control"
+)
+LLM_FAILURES = metrics.counter(
+    "llm_attempt_failures_total", "Failed upstream LLM attempts", labels=("reason",)
+)
+LLM_RETRIES = metrics.counter(
+    "llm_retries_total", "Upstream LLM attempts retried after a failure"
+)
+LLM_HEDGES = metrics.counter(
+    "llm_hedged_requests_total", "Duplicate LLM requests sent after the p95 latency"
+)
+LLM_ROUTE_SECONDS = metrics.histogram(
+    "llm_route_duration_seconds", "Model answer time per routing class", labels=("route", "model")
+)
+LLM_ROUTE_TOKENS = metrics.counter(
+    "llm_route_tokens_total", "Estimated prompt and completion tokens per routing class", labels=("route", "kind")
+)
+WS_REAPED = metrics.counter(
+    "websocket_reaped_total", "WebSockets closed for not answering heartbeats"
+)
+LLM_PROMPT_TOKENS = metrics.histogram(
+    "llm_prompt_tokens", "Estimated prompt tokens per request by part", ("route", "part"),
+    buckets=(16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+)
+LLM_UNAVAILABLE = metrics.counter(
+    "llm_unavailable_total", "Chat requests answered with an unavailable error", labels=("reason",)
+)
+
+class MetricsMiddleware:
+    """ASGI middleware timing every HTTP request, labelled by route template"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            # Route templates keep label cardinality bounded; raw paths contain user ids
+            REQUEST_SECONDS.observe(
+                time.perf_counter() - started,
+                scope["method"],
+                route.path if route is not None else "unmatched",
+                str(status[0])
+            )
+
+if metrics.enabled:
+    app.add_middleware(MetricsMiddleware)
+
 # Rate limiting
-rate_limiter = defaultdict(lambda: defaultdict(list))
+# Each window is (name, size in seconds, max messages). Limits are enforced with a
+# sliding-window counter: only the current and previous bucket counts are kept per
+# user, and the previous bucket is weighted by how much of it still overlaps the window.
+RATE_LIMIT_WINDOWS = (
+    ("minute", 60, MAX_MESSAGES_PER_MINUTE),
+    ("day", 24 * 60 * 60, MAX_DAILY_MESSAGES),
+)
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'mongo' if PRODUCTION_MODE else 'memory').lower()
+
+def sliding_window_count(previous: int, current: int, now: float, size: int) -> float:
+    """Estimate the number of hits in the last `size` seconds"""
+    elapsed_fraction = (now % size) / size
+    return previous * (1 - elapsed_fraction) + current
+
+class _UserRateState:
+    __slots__ = ('last_seen', 'counters')
+
+    def __init__(self, window_count: int):
+        self.last_seen = 0.0
+        # [bucket index, current bucket count, previous bucket count] per window
+        self.counters = [[0, 0, 0] for _ in range(window_count)]
+
+class InMemoryRateLimiter:
+    """Per-process limiter with O(1) state per user"""
+
+    def __init__(self, windows=RATE_LIMIT_WINDOWS):
+        self.windows = windows
+        self.idle_after = 2 * max(size for _, size, _ in windows)
+        self._users: "OrderedDict[str, _UserRateState]" = OrderedDict()
+
+    async def setup(self):
+        pass
+
+    async def hit(self, user_id: str) -> bool:
+        now = time.time()
+        state = self._users.get(user_id)
+        if state is None:
+            state = self._users[user_id] = _UserRateState(len(self.windows))
+        else:
+            self._users.move_to_end(user_id)
+        state.last_seen = now
+
+        for (_, size, limit), counters in zip(self.windows, state.counters):
+            bucket = int(now // size)
+            if counters[0] != bucket:
+                counters[2] = counters[1] if counters[0] == bucket - 1 else 0
+                counters[1] = 0
+                counters[0] = bucket
+            if sliding_window_count(counters[2], counters[1], now, size) >= limit:
+                return False
+
+        for counters in state.counters:
+            counters[1] += 1
+        return True
+
+    def evict_idle(self) -> int:
+        """Drop users whose counters no longer affect any window"""
+        cutoff = time.time() - self.idle_after
+        evicted = 0
+        # Entries are kept in least-recently-used order, so stop at the first active one
+        while self._users:
+            user_id, state = next(iter(self._users.items()))
+            if state.last_seen > cutoff:
+                break
+            del self._users[user_id]
+            evicted += 1
+        return evicted
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+class MongoRateLimiter:
+    """Limiter shared by all workers through time-bucketed counter documents"""
+
+    def __init__(self, collection, windows=RATE_LIMIT_WINDOWS):
+        self.collection = collection
+        self.windows = windows
 
-def check_rate_limit(client_ip: str, user_id: str) -> bool:
+    async def setup(self):
+        # Bucket documents carry their own expiry so idle users disappear automatically
+        await self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    async def hit(self, user_id: str) -> bool:
+        now = time.time()
+        operations = []
+        current_ids = []
+        for name, size, _ in self.windows:
+            bucket = int(now // size)
+            current_id = f"{user_id}:{name}:{bucket}"
+            current_ids.append(current_id)
+            operations.append(self.collection.find_one_and_update(
+                {"_id": current_id},
+                {
+                    "$inc": {"count": 1},
+                    "$setOnInsert": {"expires_at": datetime.utcfromtimestamp((bucket + 2) * size)}
+                },
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            ))
+            operations.append(self.collection.find_one({"_id": f"{user_id}:{name}:{bucket - 1}"}, {"count": 1}))
+
+        try:
+            results = await asyncio.gather(*operations)
+        except Exception as e:
+            # Fail open: a limiter outage must not take the chat down with it
+            logger.error(f"Rate limiter error: {str(e)}")
+            return True
+
+        allowed = True
+        for index, (_, size, limit) in enumerate(self.windows):
+            current = results[2 * index]["count"]
+            previous = (results[2 * index + 1] or {}).get("count", 0)
+            # `current` already includes this request
+            if sliding_window_count(previous, current - 1, now, size) >= limit:
+                allowed = False
+
+        if not allowed:
+            # Rejected requests do not count against the quota
+            try:
+                await self.collection.update_many({"_id": {"$in": current_ids}}, {"$inc": {"count": -1}})
+            except Exception as e:
+                logger.error(f"Rate limiter rollback error: {str(e)}")
+        return allowed
+
+    def evict_idle(self) -> int:
+        # Expiry is handled by the TTL index
+        return 0
+
+    def __len__(self) -> int:
+        return 0
+
+def create_rate_limiter():
+    if RATE_LIMIT_BACKEND == 'mongo':
+        return MongoRateLimiter(db.rate_limits)
+    return InMemoryRateLimiter()
+
+rate_limiter = create_rate_limiter()
+
+async def check_rate_limit(client_ip: str, user_id: str) -> bool:
     """Check if user has exceeded rate limits"""
-    now = time.time()
-    minute_ago = now - 60
-    day_ago = now - (24 * 60 * 60)
-    
-    # Clean old entries
-    rate_limiter[user_id]['minute'] = [t for t in rate_limiter[user_id]['minute'] if t > minute_ago]
-    rate_limiter[user_id]['day'] = [t for t in rate_limiter[user_id]['day'] if t > day_ago]
-    
-    # Check limits
-    if len(rate_limiter[user_id]['minute']) >= MAX_MESSAGES_PER_MINUTE:
-        return False
-    if len(rate_limiter[user_id]['day']) >= MAX_DAILY_MESSAGES:
-        return False
-    
-    # Add current request
-    rate_limiter[user_id]['minute'].append(now)
-    rate_limiter[user_id]['day'].append(now)
-    
-    return True
+    return await rate_limiter.hit(user_id)
+
+def rate_limit_retry_after() -> int:
+    """Seconds until the per-minute window rolls over; a hint for rejected clients"""
+    return int(60 - time.time() % 60) + 1
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
+# Idle expiry
+class ExpiryScheduler:
+    """Min-heap of deadlines that drives idle eviction.
+
+    `schedule` sets or moves a key's deadline by pushing a new heap entry;
+    the superseded entry is skipped when it surfaces, so scheduling,
+    rescheduling and expiring are all O(log n). One task sleeps until the
+    earliest deadline and runs the callbacks that are due. The heap is
+    rebuilt once stale entries outnumber live ones, so memory stays
+    proportional to the number of scheduled keys. Callbacks are plain
+    functions; they may reschedule their own key.
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[float, int, Any]] = []
+        self._entries: Dict[Any, Tuple[float, Callable]] = {}
+        self._sequence = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.fired = 0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def schedule(self, key, delay: float, callback: Callable):
+        deadline = time.monotonic() + delay
+        self._entries[key] = (deadline, callback)
+        self._sequence += 1
+        heapq.heappush(self._heap, (deadline, self._sequence, key))
+        if self._heap[0][1] == self._sequence:
+            # New earliest deadline: cut the runner's sleep short
+            self._wakeup.set()
+        if len(self._heap) > 2 * len(self._entries) + 1024:
+            self._compact()
+
+    def every(self, key, interval: float, callback: Callable):
+        """Run `callback()` every `interval` seconds"""
+        def run(_):
+            self.schedule(key, interval, run)
+            callback()
+        self.schedule(key, interval, run)
+
+    def cancel(self, key):
+        self._entries.pop(key, None)
+
+    def _compact(self):
+        self._heap = [(deadline, sequence, key) for sequence, (key, (deadline, _)) in enumerate(self._entries.items())]
+        heapq.heapify(self._heap)
+        self._sequence = len(self._heap)
+
+    def run_due(self, now: Optional[float] = None) -> int:
+        now = time.monotonic() if now is None else now
+        fired = 0
+        while self._heap and self._heap[0][0] <= now:
+            deadline, _, key = heapq.heappop(self._heap)
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != deadline:
+                continue
+            del self._entries[key]
+            fired += 1
+            try:
+                entry[1](key)
+            except Exception as e:
+                logger.error(f"Expiry callback error for {key!r}: {str(e)}")
+        self.fired += fired
+        return fired
+
+    async def _run(self):
+        while True:
+            self.run_due()
+            delay = self._heap[0][0] - time.monotonic() if self._heap else EXPIRY_MAX_SLEEP_SECONDS
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.0, min(delay, EXPIRY_MAX_SLEEP_SECONDS)))
+            except asyncio.TimeoutError:
+                pass
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"scheduled": len(self._entries), "heap_size": len(self._heap), "fired": self.fired}
+
+expiry_scheduler = ExpiryScheduler()
+
 # WebSocket connection manager with production features
-class ConnectionManager:
+_HEARTBEAT_FRAME_PATTERN = re.compile(r'^\s*\{\s*"type"\s*:\s*"(ping|pong)"\s*\}\s*$')
+PING_FRAME = json_text({"type": "ping"})
+PONG_FRAME = json_text({"type": "pong"})
+
+class ClientConnection:
+    """A WebSocket with bounded inbound and outbound queues.
+
+    A reader task pulls frames off the socket as they arrive and rejects
+    them once WS_INBOUND_QUEUE_SIZE are waiting, so a client cannot queue
+    unbounded work. Outgoing frames go through a writer task; a client that
+    stops reading and lets WS_SEND_HIGH_WATER frames pile up is disconnected
+    instead of buffering without limit.
+    """
+
+    def __init__(self, websocket: WebSocket, inbound_limit: int = WS_INBOUND_QUEUE_SIZE,
+                 high_water: int = WS_SEND_HIGH_WATER):
+        self.websocket = websocket
+        self.inbound_limit = inbound_limit
+        self.high_water = high_water
+        # Bounds are enforced by hand so the end-of-stream marker always fits
+        self.inbound: asyncio.Queue = asyncio.Queue()
+        self.outbound: asyncio.Queue = asyncio.Queue()
+        self.closed = False
+        self.connected_at = datetime.utcnow()
+        # Any inbound frame, heartbeat or not, proves the peer is alive
+        self.last_seen = time.monotonic()
+        # Set by the first ping or pong from the client; only such clients are expected to answer pings
+        self.heartbeats = False
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self):
+        self._tasks = [
+            asyncio.create_task(self._read_loop()),
+            asyncio.create_task(self._write_loop())
+        ]
+
+    async def _read_loop(self):
+        try:
+            while True:
+                data = await self.websocket.receive_text()
+                self.last_seen = time.monotonic()
+                heartbeat = _HEARTBEAT_FRAME_PATTERN.match(data) if len(data) <= 64 else None
+                if heartbeat is not None:
+                    self.heartbeats = True
+                    # Answered here so heartbeats never queue behind a reply or count against rate limits
+                    if heartbeat.group(1) == "ping":
+                        self.send_nowait(PONG_FRAME)
+                    continue
+                if self.inbound.qsize() >= self.inbound_limit:
+                    await self.send_json({
+                        "type": "error",
+                        "message": "Too many messages in progress. Please wait for the current reply.",
+                        "retry_after": 1
+                    })
+                    continue
+                self.inbound.put_nowait(data)
+        except Exception:
+            # The client disconnected or the transport broke; either way the stream has ended
+            pass
+        finally:
+            self.closed = True
+            self.inbound.put_nowait(None)
+
+    async def _write_loop(self):
+        try:
+            while True:
+                await self.websocket.send_text(await self.outbound.get())
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.closed = True
+
+    async def receive(self) -> Optional[str]:
+        """Next inbound frame, or None once the client has gone away"""
+        return await self.inbound.get()
+
+    async def send_text(self, message: str):
+        if self.closed:
+            return
+        if self.outbound.qsize() >= self.high_water:
+            logger.warning("Closing WebSocket: client is not reading its messages")
+            await self.close(code=1013)
+            return
+        self.outbound.put_nowait(message)
+
+    def send_nowait(self, message: str):
+        """Queue a control frame; dropped when the client is not keeping up, as a reply would close it anyway"""
+        if not self.closed and self.outbound.qsize() < self.high_water:
+            self.outbound.put_nowait(message)
+
+    async def send_json(self, data: Dict[str, Any]):
+        await self.send_text(json_text(data))
+
+    async def close(self, code: int = 1000):
+        self.closed = True
+        for task in self._tasks:
+            task.cancel()
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+# WebSocket backplane
+WS_BACKPLANE = os.environ.get('WS_BACKPLANE', 'mongo' if PRODUCTION_MODE else 'memory').lower()
+WS_EVENTS_CAPPED_BYTES = 16 * 1024 * 1024
+WS_BACKPLANE_POLL_SECONDS = 0.5
+WS_PRESENCE_HEARTBEAT_SECONDS = 10
+WORKER_ID = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+class InMemoryBackplane:
+    """Single-process backplane: a published message goes straight to local sockets"""
+
     def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
-        self.connection_times: Dict[str, datetime] = {}
+        self.deliver = None
+        self.counts = None
+        self.published = 0
+
+    async def start(self, deliver, counts):
+        self.deliver = deliver
+        self.counts = counts
+
+    async def publish(self, user_id: str, message: str):
+        self.published += 1
+        await self.deliver(user_id, message)
+
+    async def presence(self) -> Dict[str, int]:
+        users, connections = self.counts()
+        return {"users": users, "connections": connections, "workers": 1}
+
+    async def close(self):
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "memory", "published": self.published}
+
+class MongoBackplane:
+    """Fans WebSocket messages out across workers through a capped collection.
+
+    publish() delivers to this worker's sockets right away and appends the
+    event to `ws_events`; every other worker tails that collection with a
+    tailable cursor and delivers events for users connected to it. Where
+    tailable cursors are unavailable the same loop degrades to polling.
+    Each worker reports its user and connection counts to `ws_presence` on
+    a heartbeat; a TTL index drops workers that stop reporting. A user with
+    sockets on two workers is counted once per worker.
+    """
+
+    def __init__(self, database, worker_id: str):
+        self.database = database
+        self.events = database.ws_events
+        self.presence_collection = database.ws_presence
+        self.worker_id = worker_id
+        self.deliver = None
+        self.counts = None
+        self.published = 0
+        self.received = 0
+        self._tasks: List[asyncio.Task] = []
+
+    async def start(self, deliver, counts):
+        self.deliver = deliver
+        self.counts = counts
+        try:
+            await self.database.create_collection("ws_events", capped=True, size=WS_EVENTS_CAPPED_BYTES)
+        except CollectionInvalid:
+            pass  # Already created by another worker
+        except Exception as e:
+            logger.error(f"Backplane setup error: {str(e)}")
+        try:
+            await self.presence_collection.create_index("expires_at", expireAfterSeconds=0)
+        except Exception as e:
+            logger.error(f"Presence index creation error: {str(e)}")
+        self._tasks = [asyncio.create_task(self._tail()), asyncio.create_task(self._heartbeat())]
+
+    async def publish(self, user_id: str, message: str):
+        self.published += 1
+        await self.deliver(user_id, message)
+        await self.events.insert_one({
+            "user_id": user_id,
+            "message": message,
+            "origin": self.worker_id,
+            "created_at": datetime.utcnow()
+        })
+
+    async def _tail(self):
+        # Start after the newest event so a restarted worker does not replay old pushes
+        last_id = None
+        try:
+            newest = await self.events.find_one({}, sort=[("$natural", -1)])
+            if newest is not None:
+                last_id = newest["_id"]
+        except Exception as e:
+            logger.error(f"Backplane tail setup error: {str(e)}")
+
+        while True:
+            try:
+                query = {"_id": {"$gt": last_id}} if last_id is not None else {}
+                cursor = self.events.find(query, cursor_type=CursorType.TAILABLE_AWAIT)
+                async for event in cursor:
+                    last_id = event["_id"]
+                    if event.get("origin") != self.worker_id:
+                        self.received += 1
+                        await self.deliver(event["user_id"], event["message"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Backplane tail error: {str(e)}")
+            # The cursor ends when the collection is empty or it is killed; reopen shortly
+            await asyncio.sleep(WS_BACKPLANE_POLL_SECONDS)
+
+    async def _heartbeat(self):
+        while True:
+            try:
+                users, connections = self.counts()
+                await self.presence_collection.update_one(
+                    {"_id": self.worker_id},
+                    {"$set": {
+                        "users": users,
+                        "connections": connections,
+                        "expires_at": datetime.utcnow() + timedelta(seconds=3 * WS_PRESENCE_HEARTBEAT_SECONDS)
+                    }},
+                    upsert=True
+                )
+            except Exception as e:
+                logger.error(f"Presence heartbeat error: {str(e)}")
+            await asyncio.sleep(WS_PRESENCE_HEARTBEAT_SECONDS)
+
+    async def presence(self) -> Dict[str, int]:
+        # TTL deletion can lag by a minute, so expired workers are filtered here too
+        totals = {"users": 0, "connections": 0, "workers": 0}
+        async for doc in self.presence_collection.find(
+            {"expires_at": {"$gt": datetime.utcnow()}, "_id": {"$ne": self.worker_id}}
+        ):
+            totals["users"] += doc.get("users", 0)
+            totals["connections"] += doc.get("connections", 0)
+            totals["workers"] += 1
+        # This worker's own counts are always current
+        users, connections = self.counts()
+        totals["users"] += users
+        totals["connections"] += connections
+        totals["workers"] += 1
+        return totals
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        try:
+            await self.presence_collection.delete_one({"_id": self.worker_id})
+        except Exception as e:
+            logger.error(f"Presence cleanup error: {str(e)}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": "mongo",
+            "worker_id": self.worker_id,
+            "published": self.published,
+            "received": self.received
+        }
+
+def create_backplane():
+    if WS_BACKPLANE == 'mongo':
+        return MongoBackplane(db, WORKER_ID)
+    return InMemoryBackplane()
+
+class ConnectionManager:
+    """Tracks this worker's WebSockets and routes pushes through the backplane.
 
-    async def connect(self, websocket: WebSocket, user_id: str):
+    A user may hold several connections at once (tabs, devices); all of
+    them receive pushed messages. User and connection counts are maintained
+    on connect and disconnect so presence never walks the connections.
+    Each connection has one liveness check in the expiry scheduler: a
+    socket silent for WS_PING_INTERVAL_SECONDS gets a ping frame. A client
+    that has sent heartbeats itself and stays silent WS_PONG_TIMEOUT_SECONDS
+    later is closed, so half-open peers are dropped within seconds. Clients
+    that never opted in keep being pinged, which surfaces a dead transport
+    as a write error, and are otherwise closed after WS_IDLE_TIMEOUT_SECONDS.
+    """
+
+    def __init__(self, backplane, expiry: ExpiryScheduler):
+        self.active_connections: Dict[str, set] = {}
+        self.connection_count = 0
+        self.backplane = backplane
+        self.expiry = expiry
+        self.reaped = 0
+
+    async def start(self):
+        await self.backplane.start(self.send_local, self.counts)
+
+    def counts(self) -> Tuple[int, int]:
+        return len(self.active_connections), self.connection_count
+
+    async def connect(self, websocket: WebSocket, user_id: str) -> ClientConnection:
         await websocket.accept()
-        self.active_connections[user_id] = websocket
-        self.connection_times[user_id] = datetime.utcnow()
+        connection = ClientConnection(websocket)
+        connection.start()
+        self.active_connections.setdefault(user_id, set()).add(connection)
+        self.connection_count += 1
+        self.expiry.schedule((user_id, connection), WS_PING_INTERVAL_SECONDS, self._check_liveness)
+        return connection
 
-    def disconnect(self, user_id: str):
-        if user_id in self.active_connections:
+    def _check_liveness(self, key: Tuple[str, ClientConnection]):
+        user_id, connection = key
+        if connection not in self.active_connections.get(user_id, ()):
+            return
+        idle = time.monotonic() - connection.last_seen
+        timeout = WS_PING_INTERVAL_SECONDS + WS_PONG_TIMEOUT_SECONDS if connection.heartbeats else WS_IDLE_TIMEOUT_SECONDS
+        # A closed connection here failed a write, e.g. a ping to a half-open peer, while its reader still waits
+        if connection.closed or idle >= timeout:
+            self.reaped += 1
+            WS_REAPED.inc()
+            self.disconnect(user_id, connection)
+            asyncio.create_task(connection.close(code=1001))
+            return
+        if idle >= WS_PING_INTERVAL_SECONDS:
+            connection.send_nowait(PING_FRAME)
+            delay = min(WS_PING_INTERVAL_SECONDS, timeout - idle)
+        else:
+            delay = WS_PING_INTERVAL_SECONDS - idle
+        self.expiry.schedule(key, delay, self._check_liveness)
+
+    def disconnect(self, user_id: str, connection: Optional[ClientConnection] = None):
+        """Forget one connection, or all of the user's connections when none is given"""
+        connections = self.active_connections.get(user_id)
+        if not connections:
+            return
+        if connection is None:
+            for existing in connections:
+                self.expiry.cancel((user_id, existing))
+            self.connection_count -= len(connections)
             del self.active_connections[user_id]
-        if user_id in self.connection_times:
-            del self.connection_times[user_id]
+            return
+        if connection in connections:
+            self.expiry.cancel((user_id, connection))
+            connections.discard(connection)
+            self.connection_count -= 1
+            if not connections:
+                del self.active_connections[user_id]
+
+    def is_connected(self, user_id: str) -> bool:
+        """Whether the user has a socket on this worker"""
+        return user_id in self.active_connections
+
+    async def send_local(self, user_id: str, message: str):
+        for connection in list(self.active_connections.get(user_id, ())):
+            await connection.send_text(message)
 
     async def send_personal_message(self, message: str, user_id: str):
-        if user_id in self.active_connections:
-            try:
-                await self.active_connections[user_id].send_text(message)
-            except:
-                self.disconnect(user_id)
-
-    def cleanup_old_connections(self):
-        """Remove connections older than session timeout"""
-        cutoff_time = datetime.utcnow() - timedelta(hours=SESSION_TIMEOUT_HOURS)
-        to_remove = []
-        
-        for user_id, connect_time in self.connection_times.items():
-            if connect_time < cutoff_time:
-                to_remove.append(user_id)
-        
-        for user_id in to_remove:
-            self.disconnect(user_id)
+        """Deliver to every socket the user has open, on any worker"""
+        try:
+            await self.backplane.publish(user_id, message)
+        except Exception as e:
+            logger.error(f"Error publishing message for {user_id}: {str(e)}")
 
-manager = ConnectionManager()
+    async def push(self, user_id: str, payload: Dict[str, Any]):
+        await self.send_personal_message(json_text(payload), user_id)
 
-# Production-Ready Gemini Fitness Trainer
-class ProductionFitnessTrainer:
-    def __init__(self, api_key: str):
-        self.api_key = api_key
-        self.system_message = """אתה מאמן כושר מקצועי ומומחה ברמה גבוהה ביותר, עם ניסיון של 20 שנה בתחום הכושר, התזונה והמוטיבציה. אתה דובר עברית באופן מושלם ומתמחה במתן עצות מותאמות אישית.
+    async def presence(self) -> Dict[str, int]:
+        return await self.backplane.presence()
 
-## התפקיד שלך:
-🏋️‍♂️ **מאמן כושר מקצועי** - מנתח כל בקשה בעומק ונותן תוכניות מותאמות אישית
-🥗 **יועץ תזונה מוסמך** - מספק עצות תזונה מקצועיות ומותאמות אישית  
-🧠 **מוטיבטור מקצועי** - מעניק מוטיבציה אישית והנחיה רגשית
-📊 **אנליסט כושר** - מנתח את המצב הנוכחי ומתכנן את הדרך קדימה
+    async def close(self):
+        await self.backplane.close()
 
-## דרישות המקצועיות שלך:
-1. **ניתוח מעמיק** - בכל שאלה, תנתח:
-   - המטרות של השואל
-   - רמת הכושר המשוערת  
-   - הקונטקסט המלא
-   - דרכי התאמה אישית
+manager = ConnectionManager(create_backplane(), expiry_scheduler)
 
-2. **תשובות מקצועיות** - כל תשובה תכלול:
-   - ניתוח מפורט של הבקשה
-   - עצות ספציפיות ומפורטות
-   - תוכנית פעולה ברורה
-   - שאלות המעמיקות
+class LRUCache:
+    """Bounded mapping with least-recently-used eviction and an optional TTL.
 
-3. **בטיחות מקצועית**:
-   - תמיד תדגיש בטיחות באימונים
-   - תמליץ להתייעץ עם רופא במקרים רפואיים
-   - תתן עצות מבוססות מחקר מדעי
+    With ``sliding=True`` every read pushes the expiry forward, which suits
+    idle timeouts; otherwise entries expire a fixed time after being set.
+    """
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None, sliding: bool = False):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sliding = sliding
+        self._data: "OrderedDict[Any, List[Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _expiry(self) -> Optional[float]:
+        return time.time() + self.ttl if self.ttl else None
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        if entry[0] is not None and entry[0] <= time.time():
+            del self._data[key]
+            self.evictions += 1
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        if self.sliding:
+            entry[0] = self._expiry()
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value):
+        if key in self._data:
+            self._data.move_to_end(key)
+        self._data[key] = [self._expiry(), value]
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def expire(self) -> int:
+        """Remove every expired entry"""
+        now = time.time()
+        if self.sliding:
+            # Every access moves an entry to the end with a fresh expiry, so entries expire in order
+            expired = 0
+            while self._data:
+                key, entry = next(iter(self._data.items()))
+                if entry[0] is None or entry[0] > now:
+                    break
+                del self._data[key]
+                expired += 1
+            self.evictions += expired
+            return expired
+        expired = [key for key, entry in self._data.items() if entry[0] is not None and entry[0] <= now]
+        for key in expired:
+            del self._data[key]
+        self.evictions += len(expired)
+        return len(expired)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+    def __contains__(self, key) -> bool:
+        return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+class SingleFlight:
+    """Coalesce concurrent calls that share a key into a single execution.
+
+    The shared work runs as its own task, so a waiter that is cancelled (for
+    example a client disconnecting) does not cancel it for the others. The
+    task is only cancelled once every waiter has gone away, and its result
+    or exception is delivered to all of them.
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, List[Any]] = {}
+        self.executions = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, func):
+        call = self._calls.get(key)
+        if call is None:
+            # [task, number of waiters]
+            call = [asyncio.ensure_future(func()), 0]
+            self._calls[key] = call
+            self.executions += 1
+
+            def _forget(_task):
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+
+            call[0].add_done_callback(_forget)
+        else:
+            self.coalesced += 1
+
+        call[1] += 1
+        try:
+            return await asyncio.shield(call[0])
+        finally:
+            call[1] -= 1
+            if call[1] == 0 and not call[0].done():
+                call[0].cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._calls),
+            "executions": self.executions,
+            "coalesced": self.coalesced
+        }
+
+# Admission control for upstream LLM calls
+class LlmUnavailable(Exception):
+    """Raised when no model answer can be produced; routes turn it into a 503"""
+    detail = "AI service is temporarily unavailable. Please retry shortly."
+    reason = "upstream"
+
+    def __init__(self, retry_after: int, message: Optional[str] = None):
+        super().__init__(message or f"LLM unavailable, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+class LlmOverloaded(LlmUnavailable):
+    """Raised when an LLM call is shed instead of queued"""
+    detail = "AI service is busy. Please retry shortly."
+    reason = "overloaded"
+
+    def __init__(self, retry_after: int):
+        super().__init__(retry_after, f"LLM capacity exhausted, retry after {retry_after}s")
+
+class CircuitOpen(LlmUnavailable):
+    """Raised without calling upstream while the circuit breaker is open"""
+    reason = "circuit_open"
+
+    def __init__(self, retry_after: int):
+        super().__init__(retry_after, f"LLM circuit open, retry after {retry_after}s")
+
+class LlmRejected(LlmUnavailable):
+    """Raised when upstream cannot answer this particular request, e.g. a bad request or blocked output"""
+    detail = "The AI coach could not answer this message. Please rephrase it and try again."
+    reason = "rejected"
+
+    def __init__(self):
+        super().__init__(1, "LLM could not answer the request")
+
+class EmptyLlmResponse(Exception):
+    """The model returned no text, e.g. because the reply was blocked"""
+
+def is_transient_llm_error(error: Exception) -> bool:
+    """Whether another attempt could succeed: timeouts, connection errors, throttling and upstream 5xx"""
+    if isinstance(error, EmptyLlmResponse):
+        return False
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    if isinstance(status, int):
+        return status in (408, 429) or status >= 500
+    return not isinstance(error, (ValueError, TypeError))
+
+class AdmissionScheduler:
+    """Bounds concurrent upstream calls and orders the ones that must wait.
+
+    At most `max_in_flight` calls run at once. Waiters are queued per
+    priority level and served round-robin across users within a level, so
+    one user's burst cannot starve everyone else. A request is shed with
+    LlmOverloaded, rather than left to hit the client timeout, when its
+    estimated wait behind the waiters at its own or a higher priority
+    exceeds `max_wait`, when the queue is full of waiters at its own or a
+    higher priority, or when it is still waiting once that deadline passes.
+    A full queue makes room for a request by shedding the newest waiter of
+    a lower priority.
+    """
+
+    def __init__(self, max_in_flight: int, max_queue: int, max_wait: float):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self.queued = 0
+        # One OrderedDict per priority: user_id -> deque of [future, deadline]
+        self._queues = [OrderedDict() for _ in (PRIORITY_INTERACTIVE, PRIORITY_STANDARD, PRIORITY_BATCH)]
+        # Live waiters per priority; abandoned entries stay in the queues until skipped
+        self._waiting = [0] * len(self._queues)
+        # Moving average of how long a call holds its slot
+        self.avg_service_time = 1.0
+        self.admitted = 0
+        self.shed = 0
+
+    def has_capacity(self) -> bool:
+        return self.in_flight < self.max_in_flight and self.queued == 0
+
+    def _estimated_wait(self, priority: int = PRIORITY_BATCH) -> float:
+        """Expected wait for a new request, counting only the waiters that would be served before it"""
+        ahead = sum(self._waiting[:priority + 1])
+        return (ahead + 1) / max(1, self.max_in_flight) * self.avg_service_time
+
+    def retry_after(self, priority: int = PRIORITY_BATCH) -> int:
+        return max(1, int(self._estimated_wait(priority)) + 1)
+
+    def _shed(self, priority: int = PRIORITY_BATCH) -> LlmOverloaded:
+        self.shed += 1
+        LLM_SHED.inc()
+        return LlmOverloaded(self.retry_after(priority))
+
+    def _dequeued(self, priority: int):
+        self.queued -= 1
+        self._waiting[priority] -= 1
+
+    def _evict(self, priority: int) -> bool:
+        """Shed the newest waiter below `priority` to make room, if there is one"""
+        for level in range(len(self._queues) - 1, priority, -1):
+            queue = self._queues[level]
+            while queue:
+                user_id, waiters = next(reversed(queue.items()))
+                future, _ = waiters.pop()
+                if not waiters:
+                    del queue[user_id]
+                if future.done():
+                    continue
+                self._dequeued(level)
+                future.set_exception(self._shed(level))
+                return True
+        return False
+
+    @asynccontextmanager
+    async def slot(self, user_id: str, priority: int = PRIORITY_STANDARD):
+        await self._acquire(user_id, priority)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.avg_service_time = 0.9 * self.avg_service_time + 0.1 * (time.perf_counter() - started)
+            self._release()
+
+    async def _acquire(self, user_id: str, priority: int):
+        if self.in_flight < self.max_in_flight and self.queued == 0:
+            self.in_flight += 1
+            self.admitted += 1
+            return
+        if self._estimated_wait(priority) > self.max_wait:
+            raise self._shed(priority)
+        if self.queued >= self.max_queue and not self._evict(priority):
+            raise self._shed(priority)
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queues[priority].setdefault(user_id, deque()).append([future, loop.time() + self.max_wait])
+        self.queued += 1
+        self._waiting[priority] += 1
+        try:
+            await asyncio.wait_for(future, self.max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                # The slot was handed over just as this waiter gave up; pass it on
+                self._release()
+            else:
+                # Leave the entry for _release to skip; only the counts are updated here
+                future.cancel()
+                self._dequeued(priority)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            raise self._shed(priority)
+        self.admitted += 1
+
+    def _next_waiter(self):
+        for priority, queue in enumerate(self._queues):
+            while queue:
+                user_id, waiters = next(iter(queue.items()))
+                waiter = waiters.popleft()
+                if waiters:
+                    queue.move_to_end(user_id)
+                else:
+                    del queue[user_id]
+                return priority, waiter
+        return None, None
+
+    def _release(self):
+        now = asyncio.get_running_loop().time()
+        while True:
+            priority, waiter = self._next_waiter()
+            if waiter is None:
+                self.in_flight -= 1
+                return
+            future, deadline = waiter
+            if future.done():
+                continue
+            self._dequeued(priority)
+            if deadline <= now:
+                future.set_exception(self._shed(priority))
+                continue
+            # Hand the slot straight to the waiter; in_flight is unchanged
+            future.set_result(None)
+            return
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "queued": self.queued,
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "avg_service_seconds": round(self.avg_service_time, 3)
+        }
+
+llm_scheduler = AdmissionScheduler(LLM_MAX_IN_FLIGHT, LLM_MAX_QUEUE, LLM_QUEUE_TIMEOUT_SECONDS)
+
+# Resilient LLM calls
+class CircuitBreaker:
+    """Stops calling a failing upstream until it has had time to recover.
+
+    Closed: calls flow and consecutive failures are counted. After
+    `failure_threshold` of them the breaker opens and refuses every call for
+    `reset_timeout` seconds. It then goes half-open and lets a single probe
+    through; the probe's outcome closes or re-opens it.
+    """
+
+    CLOSED = "closed"
+    HALF_OPEN = "half_open"
+    OPEN = "open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self._state = self.CLOSED
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self._state = self.HALF_OPEN
+            self._probing = False
+        return self._state
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def release(self):
+        """Give up a half-open probe without an outcome, e.g. when it was cancelled"""
+        self._probing = False
+
+    def record_success(self):
+        self.failures = 0
+        self._probing = False
+        self._state = self.CLOSED
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self._state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self._state != self.OPEN:
+                self.trips += 1
+                logger.warning(f"LLM circuit opened after {self.failures} consecutive failures")
+            self._state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def retry_after(self) -> int:
+        if self.state != self.OPEN:
+            return 1
+        return max(1, int(self.reset_timeout - (time.monotonic() - self.opened_at)) + 1)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "trips": self.trips,
+            "retry_after": self.retry_after()
+        }
+
+class ResilientLlmClient:
+    """Calls LlmChat.send_message with deadlines, retries, hedging and a circuit breaker.
+
+    Each attempt may run for `attempt_timeout` seconds once it holds a
+    scheduler slot, and the whole call is bounded by `deadline`. Failed or
+    empty attempts are retried on a fresh session with full-jitter
+    exponential backoff. If an attempt is still running after the recent p95
+    latency and the scheduler has a free slot, a duplicate is sent on another
+    session and the first answer wins. Latency is tracked per route label so
+    slow plan requests do not skew hedging for small talk. While the breaker
+    is open calls fail immediately with CircuitOpen instead of waiting on a
+    degraded upstream.
+
+    A call that gives up counts once toward the breaker, however many
+    attempts it made. Errors that another attempt cannot fix (bad requests,
+    empty or blocked output) are neither retried nor counted, and raise
+    LlmRejected.
+    """
+
+    def __init__(self, scheduler: AdmissionScheduler, breaker: CircuitBreaker,
+                 attempt_timeout: float = LLM_ATTEMPT_TIMEOUT_SECONDS,
+                 deadline: float = LLM_DEADLINE_SECONDS,
+                 max_retries: int = LLM_MAX_RETRIES,
+                 hedge: bool = LLM_HEDGE_ENABLED):
+        self.scheduler = scheduler
+        self.breaker = breaker
+        self.attempt_timeout = attempt_timeout
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.hedge = hedge
+        self.latencies: Dict[str, deque] = {}
+        self.calls = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.failures = 0
+
+    def hedge_delay(self, route: str = "default") -> Optional[float]:
+        latencies = self.latencies.get(route)
+        if not self.hedge or latencies is None or len(latencies) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(latencies)
+        p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+        return max(LLM_HEDGE_MIN_DELAY_SECONDS, p95)
+
+    def _admit(self) -> bool:
+        """Check the breaker; returns True when this call is the half-open probe"""
+        probe = self.breaker.state == CircuitBreaker.HALF_OPEN
+        if not self.breaker.allow():
+            raise CircuitOpen(self.breaker.retry_after())
+        self.calls += 1
+        return probe
+
+    def _record_failure(self, error: Exception, user_id: str, attempt: int):
+        if isinstance(error, asyncio.TimeoutError):
+            reason = "timeout"
+        elif isinstance(error, EmptyLlmResponse):
+            reason = "empty"
+        else:
+            reason = "error"
+        self.failures += 1
+        LLM_FAILURES.inc(reason)
+        logger.warning(f"LLM attempt {attempt + 1} for {user_id} failed ({reason}): {error!r}")
+
+    def _observe(self, route: str, elapsed: float):
+        LLM_SECONDS.observe(elapsed)
+        self.latencies.setdefault(route, deque(maxlen=LLM_LATENCY_WINDOW)).append(elapsed)
+
+    async def _call(self, chat: LlmChat, text: str, user_id: str, priority: int, route: str,
+                    timeout: float, upstream: Optional[asyncio.Event] = None) -> str:
+        async with self.scheduler.slot(user_id, priority):
+            if upstream is not None:
+                upstream.set()
+            started = time.perf_counter()
+            response = await asyncio.wait_for(chat.send_message(UserMessage(text=text)), timeout)
+            elapsed = time.perf_counter() - started
+        response = (response or "").strip()
+        if not response:
+            raise EmptyLlmResponse()
+        self._observe(route, elapsed)
+        return response
+
+    async def _attempt(self, chat: LlmChat, text: str, user_id: str, priority: int, route: str, timeout: float,
+                       new_chat: Callable[[], LlmChat], deadline: float) -> Tuple[str, LlmChat]:
+        loop = asyncio.get_running_loop()
+        upstream = asyncio.Event()
+        primary = asyncio.create_task(self._call(chat, text, user_id, priority, route, timeout, upstream))
+        chats = {primary: chat}
+        pending = {primary}
+        error = None
+        try:
+            hedge_delay = self.hedge_delay(route)
+            if hedge_delay is not None:
+                # Time the hedge from when the primary reaches upstream, not from its queue wait
+                reached = asyncio.create_task(upstream.wait())
+                await asyncio.wait(
+                    {primary, reached}, timeout=max(0.0, deadline - loop.time()), return_when=asyncio.FIRST_COMPLETED
+                )
+                reached.cancel()
+                if primary.done() or loop.time() + hedge_delay >= deadline:
+                    hedge_delay = None
+            if hedge_delay is not None:
+                done, _ = await asyncio.wait(pending, timeout=hedge_delay)
+                if not done and self.scheduler.has_capacity():
+                    hedge_chat = new_chat()
+                    hedge = asyncio.create_task(self._call(hedge_chat, text, user_id, priority, route, timeout))
+                    chats[hedge] = hedge_chat
+                    pending.add(hedge)
+                    self.hedges += 1
+                    LLM_HEDGES.inc()
+
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=max(0.0, deadline - loop.time()), return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    raise asyncio.TimeoutError("LLM call deadline exceeded")
+                winner = None
+                for task in done:
+                    if task.exception() is None:
+                        winner = winner or task
+                    elif error is None or task is primary:
+                        error = task.exception()
+                if winner is not None:
+                    if winner is not primary:
+                        self.hedge_wins += 1
+                    return winner.result(), chats[winner]
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def send(self, chat: LlmChat, text: str, user_id: str, priority: int,
+                   new_chat: Callable[[], LlmChat], route: str = "default",
+                   attempt_timeout: Optional[float] = None,
+                   deadline: Optional[float] = None) -> Tuple[str, LlmChat]:
+        """Return the reply and the session that produced it.
+
+        Raises LlmOverloaded when admission control sheds the call and
+        LlmUnavailable (or CircuitOpen) when upstream cannot answer in time.
+        """
+        probe = self._admit()
+        timeout = attempt_timeout or self.attempt_timeout
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (deadline or self.deadline)
+        attempt = 0
+        try:
+            while True:
+                try:
+                    result = await self._attempt(chat, text, user_id, priority, route, timeout, new_chat, deadline)
+                except LlmOverloaded:
+                    # Shed locally; says nothing about upstream health
+                    if probe:
+                        self.breaker.release()
+                    raise
+                except Exception as e:
+                    self._record_failure(e, user_id, attempt)
+                    if not is_transient_llm_error(e):
+                        # Upstream is reachable; this request would fail the same way again
+                        if probe:
+                            self.breaker.release()
+                        raise LlmRejected() from e
+                    backoff = random.uniform(
+                        0, min(LLM_RETRY_MAX_DELAY_SECONDS, LLM_RETRY_BASE_DELAY_SECONDS * 2 ** attempt)
+                    )
+                    if (attempt >= self.max_retries or self.breaker.state != CircuitBreaker.CLOSED
+                            or loop.time() + backoff >= deadline):
+                        self.breaker.record_failure()
+                        raise LlmUnavailable(self.breaker.retry_after()) from e
+                    attempt += 1
+                    self.retries += 1
+                    LLM_RETRIES.inc()
+                    await asyncio.sleep(backoff)
+                    # The failed session may hold a half-finished exchange
+                    chat = new_chat()
+                    continue
+                self.breaker.record_success()
+                return result
+        except asyncio.CancelledError:
+            if probe:
+                self.breaker.release()
+            raise
+
+    async def stream(self, chat: LlmChat, text: str, user_id: str, priority: int, route: str = "default",
+                     attempt_timeout: Optional[float] = None) -> AsyncIterator[str]:
+        """Yield chunks from the integration's native stream.
+
+        Each chunk must arrive within `attempt_timeout`. There are no retries
+        or hedges here since output may already have reached the client.
+        """
+        probe = self._admit()
+        timeout = attempt_timeout or self.attempt_timeout
+        outcome_recorded = False
+        try:
+            async with self.scheduler.slot(user_id, priority):
+                started = time.perf_counter()
+                chunks = chat.stream_message(UserMessage(text=text)).__aiter__()
+                received = False
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(chunks.__anext__(), timeout)
+                    except StopAsyncIteration:
+                        break
+                    if chunk:
+                        received = True
+                        yield chunk
+                elapsed = time.perf_counter() - started
+            if not received:
+                raise EmptyLlmResponse()
+            self._observe(route, elapsed)
+            outcome_recorded = True
+            self.breaker.record_success()
+        except LlmOverloaded:
+            raise
+        except Exception as e:
+            self._record_failure(e, user_id, 0)
+            if not is_transient_llm_error(e):
+                raise LlmRejected() from e
+            outcome_recorded = True
+            self.breaker.record_failure()
+            raise LlmUnavailable(self.breaker.retry_after()) from e
+        finally:
+            # A probe that was shed or abandoned must not keep the breaker half-open forever
+            if probe and not outcome_recorded:
+                self.breaker.release()
+
+    def stats(self) -> Dict[str, Any]:
+        hedge_delays = {route: self.hedge_delay(route) for route in self.latencies}
+        return {
+            "circuit": self.breaker.stats(),
+            "calls": self.calls,
+            "retries": self.retries,
+            "failures": self.failures,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "hedge_delay_seconds": {
+                route: round(delay, 3) for route, delay in hedge_delays.items() if delay is not None
+            }
+        }
+
+llm_client = ResilientLlmClient(
+    llm_scheduler, CircuitBreaker(LLM_CIRCUIT_FAILURE_THRESHOLD, LLM_CIRCUIT_RESET_SECONDS)
+)
+
+# Response cache for repeated coaching questions
+_NON_WORD_PATTERN = re.compile(r"[^\w\s]", re.UNICODE)
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+
+def normalize_message(text: str) -> str:
+    """Reduce a message to a canonical form so trivial variations share a cache entry"""
+    text = unicodedata.normalize("NFKD", text.lower())
+    # Drops Hebrew niqqud and other combining marks along with punctuation and emoji
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    text = _NON_WORD_PATTERN.sub(" ", text)
+    return _WHITESPACE_PATTERN.sub(" ", text).strip()
+
+class ResponseCache:
+    """Two-tier cache of AI responses: a bounded in-process LRU and an optional shared Mongo tier"""
+
+    def __init__(self, max_size: int, ttl: int, collection=None):
+        self.ttl = ttl
+        self.memory = LRUCache(max_size, ttl=ttl)
+        self.collection = collection
+        self.shared_hits = 0
+
+    async def setup(self):
+        if self.collection is not None:
+            await self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    def make_key(self, user_message: str, user_profile: Dict = None) -> Optional[str]:
+        """Build the cache key, or return None if the message should not be cached"""
+        normalized = normalize_message(user_message)
+        if not normalized or len(normalized) > RESPONSE_CACHE_MAX_MESSAGE_LENGTH:
+            return None
+        profile = user_profile or {}
+        # Every field the prompt's profile block renders, so a reply is only shared
+        # between users whose prompts were identical
+        key_parts = [normalized]
+        for field, _ in PROFILE_FIELD_LABELS:
+            value = profile.get(field)
+            key_parts.append(",".join(value) if field == 'goals' and value else str(value or ''))
+        return hashlib.sha256("\x1f".join(key_parts).encode("utf-8")).hexdigest()
+
+    async def get(self, key: str) -> Optional[str]:
+        response = self.memory.get(key)
+        if response is not None or self.collection is None:
+            return response
+        try:
+            doc = await self.collection.find_one({"_id": key, "expires_at": {"$gt": datetime.utcnow()}})
+        except Exception as e:
+            logger.error(f"Response cache read error: {str(e)}")
+            return None
+        if doc:
+            self.shared_hits += 1
+            self.memory.set(key, doc["response"])
+            return doc["response"]
+        return None
+
+    async def set(self, key: str, response: str):
+        self.memory.set(key, response)
+        if self.collection is None:
+            return
+        try:
+            await self.collection.update_one(
+                {"_id": key},
+                {"$set": {"response": response, "expires_at": datetime.utcnow() + timedelta(seconds=self.ttl)}},
+                upsert=True
+            )
+        except Exception as e:
+            logger.error(f"Response cache write error: {str(e)}")
+
+    def stats(self) -> Dict[str, Any]:
+        stats = self.memory.stats()
+        stats["shared_hits"] = self.shared_hits
+        stats["shared"] = self.collection is not None
+        return stats
+
+response_cache = ResponseCache(
+    RESPONSE_CACHE_SIZE,
+    RESPONSE_CACHE_TTL_SECONDS,
+    collection=db.response_cache if RESPONSE_CACHE_SHARED else None
+)
+
+# Profile cache shared by the chat routes
+class ProfileCache:
+    """LRU/TTL cache of user profiles with cross-worker invalidation.
+
+    Profile writes invalidate the local entry directly. Other workers learn
+    about them from a change stream on the collection, or by polling
+    `updated_at` when change streams are unavailable (standalone mongod).
+    Long-lived readers compare `generation()` to notice invalidations without
+    re-querying on every message.
+    """
+
+    def __init__(self, collection, max_size: int, ttl: int):
+        self.collection = collection
+        self.cache = LRUCache(max_size, ttl=ttl)
+        self._generations = LRUCache(max_size)
+        self._generation_counter = 0
+        self._epoch = 0
+        self.invalidations = 0
+
+    @timed(PROFILE_LOOKUP_SECONDS)
+    async def get(self, user_id: str) -> Dict:
+        profile = self.cache.get(user_id)
+        if profile is None:
+            generation = self.generation(user_id)
+            profile = await self.collection.find_one({"user_id": user_id}) or {}
+            # Missing profiles are cached too, so users without one do not hit Mongo every message
+            self._fill(user_id, profile, generation)
+        return profile
+
+    async def get_many(self, user_ids) -> Dict[str, Dict]:
+        """Profiles for many users, fetching all the uncached ones with a single `$in` query"""
+        profiles: Dict[str, Dict] = {}
+        missing = []
+        for user_id in set(user_ids):
+            profile = self.cache.get(user_id)
+            if profile is None:
+                missing.append(user_id)
+            else:
+                profiles[user_id] = profile
+        if missing:
+            generations = {user_id: self.generation(user_id) for user_id in missing}
+            with PROFILE_LOOKUP_SECONDS.time():
+                async for doc in self.collection.find({"user_id": {"$in": missing}}):
+                    profiles[doc["user_id"]] = doc
+            for user_id in missing:
+                self._fill(user_id, profiles.setdefault(user_id, {}), generations[user_id])
+        return profiles
+
+    def _fill(self, user_id: str, profile: Dict, generation):
+        """Cache a profile read from Mongo unless it was written or invalidated while the read was running"""
+        if self.generation(user_id) == generation:
+            self.cache.set(user_id, profile)
+
+    def put(self, user_id: str, profile: Dict, changed: bool = True):
+        """Cache a profile this worker just read or wrote, bumping its generation if it changed"""
+        if changed:
+            self.invalidate(user_id)
+        self.cache.set(user_id, profile)
+
+    def generation(self, user_id: str):
+        return (self._epoch, self._generations.get(user_id, 0))
+
+    def invalidate(self, user_id: str):
+        self.cache.pop(user_id)
+        self._generation_counter += 1
+        self._generations.set(user_id, self._generation_counter)
+        self.invalidations += 1
+
+    def clear(self):
+        self.cache = LRUCache(self.cache.max_size, ttl=self.cache.ttl)
+        self._epoch += 1
+
+    def _apply_change(self, change: Dict):
+        document = change.get("fullDocument") or {}
+        if document.get("user_id"):
+            self.invalidate(document["user_id"])
+        else:
+            # Deletes only carry the _id, so drop everything rather than serve a stale profile
+            self.clear()
+
+    async def watch(self):
+        """Background task that keeps the cache consistent with writes from other workers"""
+        try:
+            async with self.collection.watch(full_document="updateLookup") as stream:
+                logger.info("Profile cache listening to user_profiles change stream")
+                async for change in stream:
+                    self._apply_change(change)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Profile change stream unavailable, polling instead: {str(e)}")
+        await self._poll()
+
+    async def _poll(self):
+        while True:
+            poll_started = datetime.utcnow()
+            await asyncio.sleep(PROFILE_POLL_INTERVAL_SECONDS)
+            try:
+                # Overlap one interval to tolerate clock skew between workers
+                since = poll_started - timedelta(seconds=PROFILE_POLL_INTERVAL_SECONDS)
+                async for doc in self.collection.find({"updated_at": {"$gt": since}}, {"user_id": 1, "_id": 0}):
+                    self.invalidate(doc["user_id"])
+            except Exception as e:
+                logger.error(f"Profile cache poll error: {str(e)}")
+
+    def stats(self) -> Dict[str, Any]:
+        stats = self.cache.stats()
+        stats["invalidations"] = self.invalidations
+        return stats
+
+profile_cache = ProfileCache(db.user_profiles, PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL_SECONDS)
+
+# Write-behind persistence for chat messages
+class ChatMessageWriter:
+    """Batches chat message inserts off the request path.
+
+    Messages are queued and written with `insert_many` once a batch fills up
+    or the flush interval elapses. The queue is bounded, so producers wait
+    when Mongo falls behind. Batches that still fail after retries are
+    appended to a local NDJSON spill file and replayed on the next startup.
+    """
+
+    def __init__(self, collection, batch_size: int, flush_interval: float, max_queue: int, spill_dir: Path):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self.spill_dir = spill_dir
+        self.spill_path = spill_dir / f"chat_messages_{os.getpid()}.ndjson"
+        self._batch_ready = asyncio.Event()
+        self._pending: List[Dict] = []
+        self._task: Optional[asyncio.Task] = None
+        self.written = 0
+        self.spilled = 0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        asyncio.create_task(self.replay_spill())
+
+    async def enqueue(self, document: Dict):
+        if self._task is None:
+            # Not running (before startup or during shutdown): write through
+            await self._write([document])
+            return
+        await self.queue.put(document)
+        if self.queue.qsize() >= self.batch_size:
+            self._batch_ready.set()
+
+    async def _run(self):
+        while True:
+            self._pending = [await self.queue.get()]
+            if self.queue.qsize() + 1 < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._batch_ready.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._batch_ready.clear()
+            while len(self._pending) < self.batch_size and not self.queue.empty():
+                self._pending.append(self.queue.get_nowait())
+            await self._write(self._pending)
+            self._pending = []
+
+    async def _write(self, batch: List[Dict]):
+        for attempt in range(CHAT_WRITE_MAX_RETRIES):
+            try:
+                with DB_INSERT_SECONDS.time():
+                    await self.collection.insert_many(batch, ordered=False)
+                self.written += len(batch)
+                return
+            except BulkWriteError as e:
+                # insert_many assigns _id up front, so a retried batch reports the rows
+                # that already made it as duplicates; those are not failures
+                details = e.details or {}
+                errors = details.get("writeErrors", [])
+                if not details.get("writeConcernErrors") and all(err.get("code") == 11000 for err in errors):
+                    self.written += len(batch) - len(errors)
+                    return
+                error = e
+            except Exception as e:
+                error = e
+            logger.warning(f"Chat message batch write failed (attempt {attempt + 1}): {str(error)}")
+            if attempt + 1 < CHAT_WRITE_MAX_RETRIES:
+                await asyncio.sleep(0.5 * 2 ** attempt)
+
+        self._spill(batch)
+
+    def _spill(self, batch: List[Dict]):
+        try:
+            self.spill_dir.mkdir(parents=True, exist_ok=True)
+            with open(self.spill_path, "a", encoding="utf-8") as spill_file:
+                for document in batch:
+                    spill_file.write(json_util.dumps(document) + "\n")
+            self.spilled += len(batch)
+            logger.error(f"Spilled {len(batch)} chat messages to {self.spill_path}")
+        except Exception as e:
+            logger.error(f"Lost {len(batch)} chat messages, spill failed: {str(e)}", exc_info=True)
+
+    async def replay_spill(self):
+        """Re-insert messages spilled by any worker during an earlier outage"""
+        if not self.spill_dir.exists():
+            return
+        for path in self.spill_dir.glob("chat_messages_*.ndjson"):
+            # Claim the file first so concurrent workers do not replay it twice
+            claimed = path.with_suffix(f".replaying-{os.getpid()}")
+            try:
+                path.rename(claimed)
+            except OSError:
+                continue
+            batch = []
+            with open(claimed, encoding="utf-8") as spill_file:
+                for line in spill_file:
+                    if line.strip():
+                        batch.append(json_util.loads(line))
+                    if len(batch) >= self.batch_size:
+                        await self._write(batch)
+                        batch = []
+            if batch:
+                await self._write(batch)
+            claimed.unlink()
+            logger.info(f"Replayed spilled chat messages from {path.name}")
+
+    async def close(self):
+        """Stop the background writer and flush everything still buffered"""
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        remaining = self._pending
+        self._pending = []
+        while not self.queue.empty():
+            remaining.append(self.queue.get_nowait())
+        for start in range(0, len(remaining), self.batch_size):
+            await self._write(remaining[start:start + self.batch_size])
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queue_depth": self.queue.qsize(),
+            "written": self.written,
+            "spilled": self.spilled
+        }
+
+chat_writer = ChatMessageWriter(
+    db.chat_messages,
+    CHAT_WRITE_BATCH_SIZE,
+    CHAT_WRITE_FLUSH_SECONDS,
+    CHAT_WRITE_QUEUE_SIZE,
+    CHAT_SPILL_DIR
+)
+
+# Tiered chat history storage
+class ChatArchiver:
+    """Moves old chat messages from the hot collection into monthly buckets.
+
+    Messages older than `archive_after_days` are grouped per user and month
+    into bucket documents of at most `bucket_size` messages, stored as one
+    zlib-compressed JSON payload, and then deleted from the hot collection.
+    The hot collection and its indexes therefore only ever hold the recent
+    window. Bucket ids are derived from the messages they hold, so a run that
+    dies between writing buckets and deleting messages is simply repeated.
+    With a retention period set, buckets carry an `expires_at` for Mongo's
+    TTL monitor and hot messages past retention are dropped, not archived.
+    A lease in `maintenance_locks` keeps workers from archiving concurrently.
+    """
+
+    def __init__(self, messages, buckets, locks, archive_after_days: int, retention_days: int,
+                 batch_size: int, bucket_size: int):
+        self.messages = messages
+        self.buckets = buckets
+        self.locks = locks
+        self.archive_after_days = archive_after_days
+        self.retention_days = retention_days
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self._task: Optional[asyncio.Task] = None
+        self.archived = 0
+        self.expired = 0
+        self.buckets_written = 0
+        self.last_run: Optional[datetime] = None
+
+    async def setup(self):
+        try:
+            await self.buckets.create_index([("user_id", 1), ("end", -1)], name="user_buckets")
+            # Documents without expires_at (no retention configured) are never removed
+            await self.buckets.create_index("expires_at", expireAfterSeconds=0, name="retention")
+        except Exception as e:
+            logger.error(f"Archive index creation error: {str(e)}")
+
+    def start(self):
+        if self.archive_after_days > 0:
+            self._task = asyncio.create_task(self._run_loop())
+
+    async def _run_loop(self):
+        while True:
+            try:
+                await self.run()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Chat archive error: {str(e)}")
+            await asyncio.sleep(CHAT_ARCHIVE_INTERVAL_SECONDS)
+
+    @staticmethod
+    def pack(messages: List[Dict]) -> bytes:
+        return zlib.compress(json.dumps(messages, ensure_ascii=False).encode("utf-8"))
+
+    @staticmethod
+    def unpack(payload: bytes) -> List[Dict]:
+        return json.loads(zlib.decompress(payload))
+
+    async def _acquire(self) -> bool:
+        now = datetime.utcnow()
+        try:
+            await self.locks.find_one_and_update(
+                {"_id": "chat_archive", "expires_at": {"$lt": now}},
+                {"$set": {"worker_id": WORKER_ID, "expires_at": now + timedelta(seconds=CHAT_ARCHIVE_LOCK_SECONDS)}},
+                upsert=True
+            )
+            return True
+        except DuplicateKeyError:
+            # The lock document exists and has not expired: another worker is archiving
+            return False
+
+    async def _release(self):
+        # Deleted rather than expired, so a run starting within the same millisecond is not locked out
+        await self.locks.delete_one({"_id": "chat_archive", "worker_id": WORKER_ID})
+
+    async def run(self) -> Dict[str, int]:
+        """Archive (or expire) every hot message past the cutoff, one batch at a time"""
+        result = {"archived": 0, "expired": 0, "buckets": 0}
+        if self.archive_after_days <= 0 or not await self._acquire():
+            return result
+        try:
+            now = datetime.utcnow()
+            cutoff = now - timedelta(days=self.archive_after_days)
+            retention_cutoff = now - timedelta(days=self.retention_days) if self.retention_days > 0 else None
+            while True:
+                batch = await self.messages.find(
+                    {"timestamp": {"$lt": cutoff}}, CHAT_HISTORY_PROJECTION
+                ).sort([("timestamp", 1), ("id", 1)]).limit(self.batch_size).to_list(self.batch_size)
+                if not batch:
+                    break
+                await self._archive_batch(batch, retention_cutoff, result)
+                if len(batch) < self.batch_size:
+                    break
+        finally:
+            await self._release()
+        self.last_run = datetime.utcnow()
+        if result["archived"] or result["expired"]:
+            logger.info(f"Chat archive: {result['archived']} archived, {result['expired']} expired into {result['buckets']} buckets")
+        return result
+
+    async def _archive_batch(self, batch: List[Dict], retention_cutoff: Optional[datetime], result: Dict[str, int]):
+        groups: Dict[Tuple[str, str], List[Dict]] = {}
+        expired = 0
+        for doc in batch:
+            if retention_cutoff is not None and doc["timestamp"] < retention_cutoff:
+                expired += 1
+                continue
+            groups.setdefault((doc["user_id"], doc["timestamp"].strftime("%Y-%m")), []).append(doc)
+
+        operations = []
+        for (user_id, month), docs in groups.items():
+            for start in range(0, len(docs), self.bucket_size):
+                chunk = docs[start:start + self.bucket_size]
+                bucket = {
+                    "user_id": user_id,
+                    "month": month,
+                    "start": chunk[0]["timestamp"],
+                    "end": chunk[-1]["timestamp"],
+                    "count": len(chunk),
+                    "payload": self.pack([{**doc, "timestamp": doc["timestamp"].isoformat()} for doc in chunk])
+                }
+                if self.retention_days > 0:
+                    bucket["expires_at"] = bucket["end"] + timedelta(days=self.retention_days)
+                # Derived from every message id, so a retried run rewrites the same bucket, while
+                # re-archived (e.g. re-imported) messages never replace a bucket holding others
+                digest = hashlib.sha1(",".join(doc["id"] for doc in chunk).encode("utf-8")).hexdigest()[:16]
+                operations.append(ReplaceOne({"_id": f"{user_id}:{month}:{chunk[0]['id']}:{digest}"}, bucket, upsert=True))
+        if operations:
+            await self.buckets.bulk_write(operations, ordered=False)
+        # Only delete once the buckets are durable
+        await self.messages.delete_many({"id": {"$in": [doc["id"] for doc in batch]}})
+
+        archived = len(batch) - expired
+        result["archived"] += archived
+        result["expired"] += expired
+        result["buckets"] += len(operations)
+        self.archived += archived
+        self.expired += expired
+        self.buckets_written += len(operations)
+
+    async def history(self, user_id: str, limit: int, before: Optional[Tuple[datetime, str]] = None) -> List[Dict]:
+        """Newest-first archived messages strictly older than the (timestamp, id) cursor.
+
+        Buckets are read newest-end first and reading stops once no remaining
+        bucket can hold a message newer than the oldest one kept.
+        """
+        query: Dict[str, Any] = {"user_id": user_id}
+        if before:
+            query["start"] = {"$lte": before[0]}
+        cursor = self.buckets.find(query, {"_id": 0, "end": 1, "payload": 1}).sort("end", -1).batch_size(4)
+        kept: List[Tuple[Tuple[datetime, str], Dict]] = []
+        seen = set()
+        async for bucket in cursor:
+            if len(kept) >= limit and bucket["end"] < kept[-1][0][0]:
+                break
+            for message in self.unpack(bucket["payload"]):
+                key = (datetime.fromisoformat(message["timestamp"]), message["id"])
+                # Re-importing an export can archive the same message twice
+                if (before is None or key < before) and message["id"] not in seen:
+                    seen.add(message["id"])
+                    kept.append((key, message))
+            kept.sort(key=lambda item: item[0], reverse=True)
+            del kept[limit:]
+        return [message for _, message in kept]
+
+    async def iter_oldest_first(self, user_id: str) -> AsyncIterator[Dict]:
+        async for bucket in self.buckets.find({"user_id": user_id}, {"_id": 0, "payload": 1}).sort("start", 1).batch_size(4):
+            for message in self.unpack(bucket["payload"]):
+                yield message
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "archive_after_days": self.archive_after_days,
+            "retention_days": self.retention_days,
+            "archived": self.archived,
+            "expired": self.expired,
+            "buckets_written": self.buckets_written,
+            "last_run": self.last_run.isoformat() if self.last_run else None
+        }
+
+chat_archiver = ChatArchiver(
+    db.chat_messages,
+    db.chat_archive,
+    db.maintenance_locks,
+    CHAT_ARCHIVE_AFTER_DAYS,
+    CHAT_RETENTION_DAYS,
+    CHAT_ARCHIVE_BATCH_SIZE,
+    CHAT_ARCHIVE_BUCKET_SIZE
+)
+
+# Per-user progress statistics
+# Same word-start matching as the plan keywords, with optional Hebrew prefix letters
+_TOPIC_PATTERNS = {
+    topic: re.compile(r"(?:^|\s)[והלבמש]{0,2}(?:" + "|".join(re.escape(keyword) for keyword in keywords) + ")")
+    for topic, keywords in STATS_TOPIC_KEYWORDS.items()
+}
+
+def classify_topics(text: str) -> List[str]:
+    lowered = text.lower()
+    return [topic for topic, pattern in _TOPIC_PATTERNS.items() if pattern.search(lowered)] or ["other"]
+
+def local_day(timestamp: datetime) -> str:
+    """Calendar day (YYYY-MM-DD) of a naive UTC timestamp in STATS_TIMEZONE"""
+    return timestamp.replace(tzinfo=timezone.utc).astimezone(STATS_TIMEZONE).date().isoformat()
+
+def previous_day(day: str) -> str:
+    return (datetime.fromisoformat(day) - timedelta(days=1)).date().isoformat()
+
+def compute_streaks(days) -> Tuple[int, int]:
+    """Return (streak ending on the last active day, longest streak) for a set of YYYY-MM-DD days"""
+    current = longest = 0
+    last = None
+    for day in sorted(days):
+        current = current + 1 if last is not None and previous_day(day) == last else 1
+        longest = max(longest, current)
+        last = day
+    return current, longest
+
+class UserStats:
+    """Incrementally maintained per-user aggregates in `user_stats`.
+
+    Every saved turn updates one document per user with `$inc`: total and
+    per-day message counts and a topic histogram. Streaks are kept in the
+    same document; the update filters on `last_active_day` so that a turn
+    on the same day, the day after, or after a gap is a single conditional
+    write that stays correct with concurrent writers. Reads are one
+    document lookup. `backfill` rebuilds everything from both history tiers.
+    """
+
+    def __init__(self, collection, messages, archive):
+        self.collection = collection
+        self.messages = messages
+        self.archive = archive
+        self.recorded = 0
+        self.failed = 0
+        self._pending = set()
+
+    async def setup(self):
+        try:
+            await self.collection.create_index("user_id", unique=True)
+        except Exception as e:
+            logger.error(f"Stats index creation error: {str(e)}")
+
+    def record_later(self, document: Dict):
+        """Update the stats in the background so chat replies never wait on them"""
+        task = asyncio.create_task(self._record_logged(document))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def _record_logged(self, document: Dict):
+        try:
+            await self.record(document)
+        except Exception as e:
+            # Stats are best effort and can be rebuilt with backfill-stats
+            self.failed += 1
+            logger.error(f"Error updating user stats: {str(e)}")
+
+    async def close(self):
+        """Wait for the updates still in flight"""
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+
+    async def record(self, document: Dict):
+        user_id = document["user_id"]
+        timestamp = document["timestamp"]
+        day = local_day(timestamp)
+        yesterday = previous_day(day)
+        increments = {"total_messages": 1, f"daily.{day}": 1}
+        for topic in classify_topics(document["message"]):
+            increments[f"topics.{topic}"] = 1
+
+        for _ in range(2):
+            # Already active today: counts only
+            result = await self.collection.update_one(
+                {"user_id": user_id, "last_active_day": day},
+                {"$inc": increments, "$max": {"last_message_at": timestamp}}
+            )
+            if result.matched_count:
+                break
+            # Active yesterday: the streak continues
+            updated = await self.collection.find_one_and_update(
+                {"user_id": user_id, "last_active_day": yesterday},
+                {"$inc": {**increments, "current_streak": 1}, "$set": {"last_active_day": day},
+                 "$max": {"last_message_at": timestamp}},
+                projection={"current_streak": 1},
+                return_document=ReturnDocument.AFTER
+            )
+            if updated is not None:
+                await self.collection.update_one(
+                    {"user_id": user_id}, {"$max": {"longest_streak": updated["current_streak"]}}
+                )
+                break
+            # First message, or first after a gap: a new streak starts
+            try:
+                await self.collection.update_one(
+                    {"user_id": user_id, "$or": [
+                        {"last_active_day": {"$lt": yesterday}}, {"last_active_day": {"$exists": False}}
+                    ]},
+                    {"$inc": increments, "$set": {"last_active_day": day, "current_streak": 1},
+                     "$max": {"longest_streak": 1, "last_message_at": timestamp},
+                     "$min": {"first_message_at": timestamp}},
+                    upsert=True
+                )
+                break
+            except DuplicateKeyError:
+                # Another writer moved last_active_day in between; try again
+                continue
+        else:
+            # last_active_day is ahead of this message (clock skew at midnight): count it, leave streaks alone
+            await self.collection.update_one({"user_id": user_id}, {"$inc": increments})
+        self.recorded += 1
+
+    async def get(self, user_id: str, days: int = STATS_DEFAULT_DAYS) -> Dict[str, Any]:
+        doc = await self.collection.find_one({"user_id": user_id}, {"_id": 0}) or {}
+        today = local_day(datetime.utcnow())
+        since = (datetime.fromisoformat(today) - timedelta(days=days - 1)).date().isoformat()
+        last_active_day = doc.get("last_active_day")
+        streak_alive = last_active_day is not None and last_active_day >= previous_day(today)
+        return {
+            "user_id": user_id,
+            "total_messages": doc.get("total_messages", 0),
+            "active_days": len(doc.get("daily", {})),
+            "current_streak": doc.get("current_streak", 0) if streak_alive else 0,
+            "longest_streak": doc.get("longest_streak", 0),
+            "last_active_day": last_active_day,
+            "first_message_at": doc["first_message_at"].isoformat() if doc.get("first_message_at") else None,
+            "last_message_at": doc["last_message_at"].isoformat() if doc.get("last_message_at") else None,
+            "topics": {topic: doc.get("topics", {}).get(topic, 0) for topic in [*STATS_TOPIC_KEYWORDS, "other"]},
+            "daily": {day: count for day, count in sorted(doc.get("daily", {}).items()) if day >= since}
+        }
+
+    @staticmethod
+    def _new_aggregate() -> Dict[str, Any]:
+        return {"total_messages": 0, "daily": {}, "topics": {}, "first_message_at": None, "last_message_at": None}
+
+    @staticmethod
+    def _add(aggregate: Dict[str, Any], message: str, timestamp: datetime):
+        aggregate["total_messages"] += 1
+        day = local_day(timestamp)
+        aggregate["daily"][day] = aggregate["daily"].get(day, 0) + 1
+        for topic in classify_topics(message):
+            aggregate["topics"][topic] = aggregate["topics"].get(topic, 0) + 1
+        if aggregate["first_message_at"] is None or timestamp < aggregate["first_message_at"]:
+            aggregate["first_message_at"] = timestamp
+        if aggregate["last_message_at"] is None or timestamp > aggregate["last_message_at"]:
+            aggregate["last_message_at"] = timestamp
+
+    @staticmethod
+    def _merge(aggregate: Dict[str, Any], other: Dict[str, Any]):
+        aggregate["total_messages"] += other["total_messages"]
+        for field in ("daily", "topics"):
+            for key, count in other[field].items():
+                aggregate[field][key] = aggregate[field].get(key, 0) + count
+        for field, pick in (("first_message_at", min), ("last_message_at", max)):
+            values = [value for value in (aggregate[field], other[field]) if value is not None]
+            aggregate[field] = pick(values) if values else None
+
+    async def _write(self, aggregates: Dict[str, Dict[str, Any]], run_id: str, merge: bool):
+        if merge:
+            # Users with archived history already have this run's partial totals
+            async for doc in self.collection.find(
+                {"user_id": {"$in": list(aggregates)}, "backfill_run": run_id}, {"_id": 0}
+            ):
+                self._merge(aggregates[doc["user_id"]], doc)
+        operations = []
+        for user_id, aggregate in aggregates.items():
+            current, longest = compute_streaks(aggregate["daily"])
+            operations.append(ReplaceOne({"user_id": user_id}, {
+                **aggregate,
+                "user_id": user_id,
+                "last_active_day": max(aggregate["daily"]),
+                "current_streak": current,
+                "longest_streak": longest,
+                "backfill_run": run_id
+            }, upsert=True))
+        await self.collection.bulk_write(operations, ordered=False)
+
+    async def backfill(self, user_id: Optional[str] = None, batch_size: int = STATS_BACKFILL_BATCH_SIZE) -> int:
+        """Rebuild aggregates from archived and hot history; returns the number of users written.
+
+        Both tiers are scanned in user_id order and written every `batch_size`
+        users. Turns saved while the backfill runs may be counted twice, so
+        run it when traffic is low.
+        """
+        run_id = uuid.uuid4().hex
+        query = {"user_id": user_id} if user_id else {}
+        users = set()
+
+        async def scan(documents, merge: bool):
+            aggregates: Dict[str, Dict[str, Any]] = {}
+            async for owner, message, timestamp in documents:
+                if owner not in aggregates:
+                    if len(aggregates) >= batch_size:
+                        await self._write(aggregates, run_id, merge)
+                        aggregates = {}
+                    aggregates[owner] = self._new_aggregate()
+                    users.add(owner)
+                self._add(aggregates[owner], message, timestamp)
+            if aggregates:
+                await self._write(aggregates, run_id, merge)
+
+        async def archived():
+            async for bucket in self.archive.find(query, {"_id": 0, "user_id": 1, "payload": 1}).sort("user_id", 1).batch_size(4):
+                for message in ChatArchiver.unpack(bucket["payload"]):
+                    yield bucket["user_id"], message["message"], datetime.fromisoformat(message["timestamp"])
+
+        async def hot():
+            cursor = self.messages.find(
+                query, {"_id": 0, "user_id": 1, "message": 1, "timestamp": 1}
+            ).sort("user_id", 1).batch_size(1000)
+            async for doc in cursor:
+                yield doc["user_id"], doc["message"], doc["timestamp"]
+
+        await scan(archived(), merge=False)
+        await scan(hot(), merge=True)
+        logger.info(f"Rebuilt stats for {len(users)} users")
+        return len(users)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"recorded": self.recorded, "pending": len(self._pending), "failed": self.failed}
+
+user_stats = UserStats(db.user_stats, db.chat_messages, db.chat_archive)
+
+# Conversation context
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate; Hebrew averages roughly three characters per token"""
+    return len(text) // 3 + 1
+
+class ConversationState:
+    __slots__ = ('summary', 'summarized_until', 'turns', 'failures', 'retry_at')
+
+    def __init__(self, summary: str, summarized_until, turns, max_turns: int):
+        self.summary = summary
+        # (timestamp, id) of the newest turn folded into the summary
+        self.summarized_until = summarized_until
+        self.turns = deque(turns, maxlen=max_turns)
+        # Consecutive failed summaries and when the next attempt may start
+        self.failures = 0
+        self.retry_at = 0.0
+
+class ConversationContext:
+    """Builds bounded conversation context from recent turns and a rolling summary.
+
+    Recent turns are kept in memory per active user and loaded from
+    chat_messages on first use. Every `summarize_every` turns, the turns
+    older than the newest `keep_recent` are folded into a stored summary
+    in the background, so the summary is extended incrementally rather
+    than rebuilt from the full history.
+    """
+
+    def __init__(self, messages, summaries, summarizer, token_budget: int,
+                 summarize_every: int, keep_recent: int):
+        self.messages = messages
+        self.summaries = summaries
+        self.summarizer = summarizer
+        self.token_budget = token_budget
+        self.summarize_every = summarize_every
+        self.keep_recent = keep_recent
+        self.max_turns = summarize_every + keep_recent
+        # Turns wait here until a summary succeeds; only a long summarizer outage drops any
+        self.max_pending_turns = self.max_turns * 4
+        self.states = LRUCache(PROFILE_CACHE_SIZE, ttl=CONTEXT_STATE_TTL_SECONDS, sliding=True)
+        self._compacting = set()
+        self.compactions = 0
+        self.prompts = 0
+        self.prompt_tokens_total = 0
+        self.prompt_tokens_max = 0
+
+    async def _load(self, user_id: str) -> ConversationState:
+        state = self.states.get(user_id)
+        if state is not None:
+            return state
+
+        summary_doc = await self.summaries.find_one({"user_id": user_id}, {"_id": 0}) or {}
+        query: Dict[str, Any] = {"user_id": user_id}
+        summarized_until = None
+        if summary_doc.get("until_timestamp"):
+            summarized_until = (summary_doc["until_timestamp"], summary_doc["until_id"])
+            query["$or"] = [
+                {"timestamp": {"$gt": summarized_until[0]}},
+                {"timestamp": summarized_until[0], "id": {"$gt": summarized_until[1]}}
+            ]
+        docs = await self.messages.find(
+            query, {"_id": 0, "id": 1, "message": 1, "response": 1, "timestamp": 1}
+        ).sort([("timestamp", -1), ("id", -1)]).limit(self.max_turns).to_list(self.max_turns)
+
+        state = ConversationState(summary_doc.get("summary", ""), summarized_until, reversed(docs), self.max_pending_turns)
+        self.states.set(user_id, state)
+        return state
+
+    async def build(self, user_id: str) -> str:
+        """Return the context block for the next prompt, newest turns first within the token budget"""
+        state = await self._load(user_id)
+        budget = self.token_budget
+        parts = []
+        if state.summary:
+            parts.append(f"--- סיכום השיחה עד כה ---\n{state.summary}")
+            budget -= estimate_tokens(parts[0])
+
+        recent = []
+        for turn in reversed(state.turns):
+            block = f"משתמש: {turn['message']}\nמאמן: {turn['response'][:CONTEXT_TURN_RESPONSE_CHARS]}"
+            cost = estimate_tokens(block)
+            if cost > budget:
+                break
+            recent.append(block)
+            budget -= cost
+        if recent:
+            parts.append("--- הודעות אחרונות ---\n" + "\n\n".join(reversed(recent)))
+
+        return "\n\n".join(parts)
+
+    def observe_prompt(self, prompt: str):
+        tokens = estimate_tokens(prompt)
+        self.prompts += 1
+        self.prompt_tokens_total += tokens
+        self.prompt_tokens_max = max(self.prompt_tokens_max, tokens)
+
+    def record(self, message: Dict):
+        """Add a persisted chat turn to the user's in-memory window"""
+        user_id = message["user_id"]
+        state = self.states.get(user_id)
+        if state is None:
+            # Not loaded yet; the turn will be read from chat_messages when it is
+            return
+        state.turns.append({
+            "id": message["id"],
+            "message": message["message"],
+            "response": message["response"],
+            "timestamp": message["timestamp"]
+        })
+        if (len(state.turns) >= self.max_turns and user_id not in self._compacting
+                and time.monotonic() >= state.retry_at):
+            self._compacting.add(user_id)
+            asyncio.create_task(self._compact(user_id, state))
+
+    async def _compact(self, user_id: str, state: ConversationState):
+        try:
+            folded = list(state.turns)[:-self.keep_recent]
+            summary = await self.summarizer(user_id, state.summary, folded)
+            if not summary:
+                self._back_off(state)
+                return
+            last = folded[-1]
+            await self.summaries.update_one(
+                {"user_id": user_id},
+                {"$set": {
+                    "summary": summary,
+                    "until_timestamp": last["timestamp"],
+                    "until_id": last["id"],
+                    "updated_at": datetime.utcnow()
+                }},
+                upsert=True
+            )
+            state.summary = summary
+            state.summarized_until = (last["timestamp"], last["id"])
+            while state.turns and (state.turns[0]["timestamp"], state.turns[0]["id"]) <= state.summarized_until:
+                state.turns.popleft()
+            state.failures = 0
+            state.retry_at = 0.0
+            self.compactions += 1
+        except Exception as e:
+            logger.error(f"Conversation summary error: {str(e)}", exc_info=True)
+            self._back_off(state)
+        finally:
+            self._compacting.discard(user_id)
+
+    @staticmethod
+    def _back_off(state: ConversationState):
+        state.failures += 1
+        delay = min(CONTEXT_SUMMARY_RETRY_SECONDS * 2 ** (state.failures - 1), CONTEXT_SUMMARY_MAX_RETRY_SECONDS)
+        state.retry_at = time.monotonic() + delay
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active_users": len(self.states),
+            "compactions": self.compactions,
+            "prompts": self.prompts,
+            "avg_prompt_tokens": round(self.prompt_tokens_total / self.prompts, 1) if self.prompts else 0.0,
+            "max_prompt_tokens": self.prompt_tokens_max
+        }
+
+conversation_context = ConversationContext(
+    db.chat_messages,
+    db.conversation_summaries,
+    # Resolved lazily: the trainer is created further down
+    summarizer=lambda user_id, summary, turns: fitness_trainer.summarize(user_id, summary, turns),
+    token_budget=CONTEXT_TOKEN_BUDGET,
+    summarize_every=CONTEXT_SUMMARIZE_EVERY,
+    keep_recent=CONTEXT_KEEP_RECENT
+) if CONTEXT_ENABLED else None
+
+# Model routing
+# Keywords must start a word, optionally after Hebrew prefix letters (ו, ה, ל, ב, מ, ש)
+_PLAN_KEYWORD_PATTERN = re.compile(
+    r"(?:^|\s)[והלבמש]{0,2}(?:" + "|".join(re.escape(keyword) for keyword in ROUTE_PLAN_KEYWORDS) + ")"
+)
+
+_FOLLOW_UP_PATTERN = re.compile(
+    r"(?:^|\s)[והלבמש]{0,2}(?:" + "|".join(re.escape(word) for word in ROUTE_FOLLOW_UP_WORDS) + r")(?=\s|$)"
+)
+
+def load_llm_routes(override: Optional[str] = None) -> Dict[str, Dict[str, Any]]:
+    """Merge the LLM_ROUTES JSON override into the default routing table"""
+    routes = {name: dict(route) for name, route in DEFAULT_LLM_ROUTES.items()}
+    if not override:
+        return routes
+    try:
+        changes = json.loads(override)
+        for name, route in changes.items():
+            routes.setdefault(name, dict(DEFAULT_LLM_ROUTES["standard"])).update(route)
+    except (ValueError, AttributeError, TypeError) as e:
+        raise ValueError(f"Invalid LLM_ROUTES: {str(e)}")
+    return routes
+
+class ModelRouter:
+    """Classifies a request cheaply and picks the model, token budget and system prompt for it.
+
+    Plan keywords route to the plan model; messages made only of greetings
+    and thanks route to small talk; a long message from a user whose profile
+    lists goals is treated as a plan request. Everything else is standard.
+    Independently of the route, short messages with no reference to earlier
+    turns are standalone and answered without conversation context.
+    """
+
+    def __init__(self, routes: Dict[str, Dict[str, Any]]):
+        for name in ("small_talk", "standard", "plan"):
+            if name not in routes:
+                raise ValueError(f"LLM routing table is missing the '{name}' route")
+        self.routes = routes
+        self.counts = {name: 0 for name in routes}
+
+    def classify(self, user_message: str, user_profile: Dict = None) -> str:
+        normalized = normalize_message(user_message)
+        if _PLAN_KEYWORD_PATTERN.search(normalized):
+            return "plan"
+        words = normalized.split()
+        if len(words) <= ROUTE_SMALL_TALK_MAX_WORDS and all(word in ROUTE_SMALL_TALK_WORDS for word in words):
+            return "small_talk"
+        if user_profile and user_profile.get("goals") and len(user_message) >= ROUTE_PLAN_MIN_CHARS:
+            return "plan"
+        return "standard"
+
+    def is_standalone(self, user_message: str) -> bool:
+        words = normalize_message(user_message).split()
+        return len(words) <= ROUTE_STANDALONE_MAX_WORDS and not _FOLLOW_UP_PATTERN.search(" ".join(words))
+
+    def route(self, user_message: str, user_profile: Dict = None) -> str:
+        name = self.classify(user_message, user_profile)
+        self.counts[name] = self.counts.get(name, 0) + 1
+        return name
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "routes": {name: f"{route['model']}/{route['max_tokens']}" for name, route in self.routes.items()},
+            "counts": dict(self.counts)
+        }
+
+# Prompt assembly
+PROFILE_FIELD_LABELS = (("name", "שם"), ("age", "גיל"), ("fitness_level", "רמת כושר"), ("goals", "יעדים"))
+
+def load_system_prompts(version: str, directory: Optional[Path] = None) -> Dict[str, str]:
+    """Pick every named system prompt at `version`, falling back to v1 for names without it"""
+    versions = {name: dict(available) for name, available in SYSTEM_PROMPTS.items()}
+    if directory is not None and directory.is_dir():
+        for path in sorted(directory.glob("*.*.txt")):
+            name, file_version = path.name[:-len(".txt")].split(".", 1)
+            versions.setdefault(name, {})[file_version] = path.read_text(encoding="utf-8").strip()
+    if version not in versions["full"]:
+        raise ValueError(f"Unknown SYSTEM_PROMPT_VERSION: {version}")
+    return {
+        name: available.get(version, available.get("v1"))
+        for name, available in versions.items()
+        if version in available or "v1" in available
+    }
+
+class PromptBuilder:
+    """Assembles prompts from pieces rendered ahead of time.
+
+    System prompts are resolved once at startup and their token counts
+    computed then. The profile block is rendered once per profile and kept
+    per user, tagged with the profile cache generation and `updated_at`, so
+    an edit on any worker yields a fresh block on the next message. Every
+    prompt's estimated tokens are recorded per route and part (system,
+    profile, context, message).
+    """
+
+    def __init__(self, prompts: Dict[str, str], version: str, profiles: Optional[ProfileCache] = None,
+                 max_size: int = PROFILE_CACHE_SIZE):
+        self.prompts = prompts
+        self.version = version
+        self.profiles = profiles
+        self.fragments = LRUCache(max_size)
+        self._system_tokens = {name: estimate_tokens(text) for name, text in prompts.items()}
+        self.requests = 0
+        self.tokens = {"system": 0, "profile": 0, "context": 0, "message": 0}
+
+    def system_prompt(self, name: Optional[str]) -> str:
+        return self.prompts.get(name) or self.prompts["full"]
+
+    def system_tokens(self, name: Optional[str]) -> int:
+        return self._system_tokens.get(name) or self._system_tokens["full"]
+
+    @staticmethod
+    def render_profile(user_profile: Dict) -> str:
+        lines = []
+        for field, label in PROFILE_FIELD_LABELS:
+            value = user_profile.get(field)
+            if value:
+                lines.append(f"{label}: {', '.join(value) if field == 'goals' else value}\n")
+        return "\n\n--- פרופיל המשתמש ---\n" + "".join(lines) if lines else ""
+
+    def profile_fragment(self, user_id: str, user_profile: Optional[Dict]) -> Tuple[str, int]:
+        """Return the user's profile block and its token estimate, rendering it only when the profile changed"""
+        if not user_profile:
+            return "", 0
+        if user_profile.get("updated_at") is None:
+            # Not a stored profile, so there is nothing to tell versions apart by
+            fragment = self.render_profile(user_profile)
+            return fragment, estimate_tokens(fragment) if fragment else 0
+        version = (
+            self.profiles.generation(user_id) if self.profiles is not None else None,
+            user_profile.get("updated_at")
+        )
+        cached = self.fragments.get(user_id)
+        if cached is not None and cached[0] == version:
+            return cached[1], cached[2]
+        fragment = self.render_profile(user_profile)
+        tokens = estimate_tokens(fragment) if fragment else 0
+        self.fragments.set(user_id, (version, fragment, tokens))
+        return fragment, tokens
+
+    def build(self, user_message: str, user_id: str, user_profile: Optional[Dict], context: str,
+              route: str, system_prompt: Optional[str]) -> str:
+        fragment, profile_tokens = self.profile_fragment(user_id, user_profile)
+        prompt = user_message + fragment if fragment else user_message.strip()
+        if context:
+            prompt = f"{context}\n\n--- ההודעה הנוכחית ---\n{prompt}"
+        parts = {
+            "system": self.system_tokens(system_prompt),
+            "profile": profile_tokens,
+            "context": estimate_tokens(context) if context else 0,
+            "message": estimate_tokens(user_message)
+        }
+        self.requests += 1
+        for part, tokens in parts.items():
+            self.tokens[part] += tokens
+            LLM_PROMPT_TOKENS.observe(tokens, route, part)
+        return prompt
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "version": self.version,
+            "system_tokens": self._system_tokens,
+            "requests": self.requests,
+            "avg_tokens": {part: round(total / self.requests, 1) if self.requests else 0.0 for part, total in self.tokens.items()},
+            "profile_fragments": self.fragments.stats()
+        }
+
+# Production-Ready Gemini Fitness Trainer
+class ProductionFitnessTrainer:
+    def __init__(self, api_key: str, response_cache: Optional[ResponseCache] = None,
+                 context: Optional[ConversationContext] = None,
+                 llm: Optional[ResilientLlmClient] = None,
+                 router: Optional[ModelRouter] = None,
+                 prompts: Optional[PromptBuilder] = None,
+                 expiry: Optional[ExpiryScheduler] = None):
+        self.api_key = api_key
+        self.expiry = expiry
+        self.router = router or ModelRouter(load_llm_routes(os.environ.get('LLM_ROUTES')))
+        self.llm = llm or ResilientLlmClient(
+            AdmissionScheduler(LLM_MAX_IN_FLIGHT, LLM_MAX_QUEUE, LLM_QUEUE_TIMEOUT_SECONDS),
+            CircuitBreaker(LLM_CIRCUIT_FAILURE_THRESHOLD, LLM_CIRCUIT_RESET_SECONDS)
+        )
+        self.response_cache = response_cache
+        self.context = context
+        self.in_flight = SingleFlight()
+        self.prompts = prompts or PromptBuilder(load_system_prompts(SYSTEM_PROMPT_VERSION, PROMPTS_DIR), SYSTEM_PROMPT_VERSION)
+        self.system_message = self.prompts.system_prompt("full")
+        # Routes pick a system prompt by name
+        self.system_prompts = self.prompts.prompts
+
+        self.session_cache = {}
+        # Chat sessions are reused across messages so the client and system prompt are set up once
+        self.chat_pool = LRUCache(CHAT_POOL_SIZE, ttl=SESSION_TIMEOUT_HOURS * 3600, sliding=True)
+
+    def _cleanup_sessions(self):
+        """Drop pooled chat sessions idle past the session timeout; run periodically by the expiry scheduler"""
+        self.chat_pool.expire()
+
+    def _expire_session(self, key: Tuple[str, str]):
+        _, user_id = key
+        self.session_cache.pop(user_id, None)
+        for route in self.router.routes:
+            self.chat_pool.pop(self._session_id(user_id, route))
+
+    def _validate_message(self, user_message: str) -> Optional[str]:
+        """Return a canned reply for invalid input, or None if the message is usable"""
+        if not user_message or len(user_message.strip()) == 0:
+            return "שלום! 👋 לא קיבלתי הודעה ברורה. איך אני יכול לעזור לך היום?"
+
+        if len(user_message) > MAX_MESSAGE_LENGTH:
+            return f"ההודעה ארוכה מדי. אנא שלח הודעה עד {MAX_MESSAGE_LENGTH} תווים. 📝"
+
+        return None
+
+    async def _load_context(self, user_message: str, user_id: str) -> str:
+        """Conversation context for the prompt; standalone questions are answered without it"""
+        if self.context is None or self.router.is_standalone(user_message):
+            return ""
+        return await self.context.build(user_id)
+
+    def _prepare_prompt(self, user_message: str, user_id: str, user_profile: Dict = None,
+                        route: str = "standard", context: str = "") -> str:
+        """Build the full prompt: conversation context, then the message with its profile block"""
+        enhanced_message = self.prompts.build(
+            user_message, user_id, user_profile, context, route,
+            self.router.routes[route].get("system_prompt")
+        )
+        if self.context is not None:
+            self.context.observe_prompt(enhanced_message)
+        return enhanced_message
+
+    async def summarize(self, user_id: str, previous_summary: str, turns: List[Dict]) -> str:
+        """Fold older turns into the user's rolling conversation summary"""
+        conversation = "\n\n".join(
+            f"משתמש: {turn['message']}\nמאמן: {turn['response'][:CONTEXT_TURN_RESPONSE_CHARS]}"
+            for turn in turns
+        )
+        new_chat = lambda: LlmChat(
+            api_key=self.api_key,
+            session_id=f"summary_{user_id}_{uuid.uuid4()}",
+            system_message=SUMMARY_SYSTEM_MESSAGE
+        ).with_model("gemini", "gemini-2.0-flash").with_max_tokens(CONTEXT_SUMMARY_MAX_TOKENS)
+        summary, _ = await self.llm.send(
+            new_chat(),
+            f"סיכום קודם:\n{previous_summary or 'אין'}\n\nהודעות חדשות:\n{conversation}",
+            user_id,
+            PRIORITY_BATCH,
+            new_chat=new_chat,
+            route="summary"
+        )
+        # Start fresh sessions so history kept by the integration stays bounded;
+        # the summary now carries that continuity
+        for route in self.router.routes:
+            self.chat_pool.pop(self._session_id(user_id, route))
+        return summary
+
+    def _session_id(self, user_id: str, route: str) -> str:
+        return f"prod_fitness_{user_id}_{route}"
+
+    def _new_chat(self, session_id: str, route: str) -> LlmChat:
+        config = self.router.routes[route]
+        return LlmChat(
+            api_key=self.api_key,
+            session_id=session_id,
+            system_message=self.prompts.system_prompt(config.get("system_prompt"))
+        ).with_model(config.get("provider", "gemini"), config["model"]).with_max_tokens(config["max_tokens"])
+
+    def _get_chat(self, user_id: str, route: str = "standard") -> LlmChat:
+        """Return the pooled chat session for the user and route, creating it on first use"""
+        session_id = self._session_id(user_id, route)
+        chat = self.chat_pool.get(session_id)
+        if chat is None:
+            chat = self._new_chat(session_id, route)
+            self.chat_pool.set(session_id, chat)
+        return chat
+
+    def _observe_route(self, route: str, prompt: str, response: str, elapsed: float):
+        config = self.router.routes[route]
+        LLM_ROUTE_SECONDS.observe(elapsed, route, config["model"])
+        LLM_ROUTE_TOKENS.inc(route, "prompt", amount=self.prompts.system_tokens(config.get("system_prompt")) + estimate_tokens(prompt))
+        LLM_ROUTE_TOKENS.inc(route, "completion", amount=estimate_tokens(response))
 
-## סגנון מקצועי:
-- עברית מושלמת עם אימוג'ים רלוונטיים 💪🔥🏋️‍♂️🥗🎯
-- מבנה ברור עם כותרות
-- דוגמאות מעשיות וספציפיות
-- תמיד עם המלצה למעקב
+    def _touch_session(self, user_id: str):
+        self.session_cache[user_id] = {
+            'last_used': time.time(),
+            'message_count': self.session_cache.get(user_id, {}).get('message_count', 0) + 1
+        }
+        if self.expiry is not None:
+            self.expiry.schedule(("session", user_id), SESSION_TIMEOUT_HOURS * 3600, self._expire_session)
 
-זכור: אתה מאמן אמיתי שמקדיש זמן, מנתח לעומק, ובאמת אכפת לו מההצלחה של המשתמש!"""
+    def _cache_key(self, user_message: str, user_profile: Dict, use_cache: bool) -> Optional[str]:
+        if not use_cache or self.response_cache is None:
+            return None
+        return self.response_cache.make_key(user_message, user_profile)
 
-        self.session_cache = {}
-        self.last_cleanup = time.time()
+    def _flight_key(self, enhanced_message: str, route: str, use_cache: bool) -> Optional[str]:
+        """Key for coalescing concurrent calls: only prompts sent upstream verbatim may share an answer"""
+        if not use_cache:
+            return None
+        system_prompt = self.prompts.system_prompt(self.router.routes[route].get("system_prompt"))
+        key_parts = [route, system_prompt, enhanced_message]
+        return hashlib.sha256("\x1f".join(key_parts).encode("utf-8")).hexdigest()
 
-    def _cleanup_sessions(self):
-        """Clean old sessions to prevent memory leaks"""
-        if time.time() - self.last_cleanup > 3600:  # Cleanup every hour
-            cutoff_time = time.time() - (SESSION_TIMEOUT_HOURS * 3600)
-            self.session_cache = {
-                k: v for k, v in self.session_cache.items() 
-                if v.get('last_used', 0) > cutoff_time
-            }
-            self.last_cleanup = time.time()
+    async def _complete(self, enhanced_message: str, user_id: str, cache_key: Optional[str] = None,
+                        priority: int = PRIORITY_STANDARD, route: str = "standard",
+                        deadline: Optional[float] = None, attempt_timeout: Optional[float] = None) -> str:
+        """Send the message to the route's model and return the stripped reply, caching it when keyed"""
+        session_id = self._session_id(user_id, route)
+        chat = self._get_chat(user_id, route)
+        started = time.perf_counter()
+        try:
+            response, answered_by = await self.llm.send(
+                chat, enhanced_message, user_id, priority,
+                new_chat=lambda: self._new_chat(session_id, route),
+                route=route,
+                attempt_timeout=attempt_timeout or self.router.routes[route].get("attempt_timeout"),
+                deadline=deadline
+            )
+        except LlmUnavailable:
+            # The pooled session may hold a half-finished exchange
+            self.chat_pool.pop(session_id)
+            raise
+        if answered_by is not chat:
+            # A retry or hedge answered on a fresh session; continue the conversation there
+            self.chat_pool.set(session_id, answered_by)
+        self._observe_route(route, enhanced_message, response, time.perf_counter() - started)
+        if cache_key:
+            await self.response_cache.set(cache_key, response)
+        return response
 
-    async def get_response(self, user_message: str, user_id: str, user_profile: Dict = None) -> str:
+    @timed(AI_RESPONSE_SECONDS)
+    async def get_response(self, user_message: str, user_id: str, user_profile: Dict = None, use_cache: bool = True,
+                           priority: int = PRIORITY_STANDARD) -> str:
+        """Return the coach's reply.
+
+        Raises LlmUnavailable (LlmOverloaded when shed by admission control)
+        instead of returning a canned reply, so failures are never stored as
+        answers.
+        """
         try:
-            self._cleanup_sessions()
-            
             # Input validation and sanitization
-            if not user_message or len(user_message.strip()) == 0:
-                return "שלום! 👋 לא קיבלתי הודעה ברורה. איך אני יכול לעזור לך היום?"
-            
-            if len(user_message) > MAX_MESSAGE_LENGTH:
-                return f"ההודעה ארוכה מדי. אנא שלח הודעה עד {MAX_MESSAGE_LENGTH} תווים. 📝"
+            invalid_reply = self._validate_message(user_message)
+            if invalid_reply:
+                return invalid_reply
+
+            # Replies that build on the user's conversation are personal, so only
+            # context-free prompts are cached or coalesced with other users
+            context = await self._load_context(user_message, user_id)
+            shared = use_cache and not context
+
+            # Serve repeated questions from the cache
+            cache_key = self._cache_key(user_message, user_profile, shared)
+            if cache_key:
+                cached_response = await self.response_cache.get(cache_key)
+                if cached_response is not None:
+                    self._touch_session(user_id)
+                    return cached_response
 
             # Create enhanced context
-            enhanced_message = user_message.strip()
-            if user_profile and any(user_profile.get(key) for key in ['name', 'age', 'fitness_level', 'goals']):
-                profile_context = "\n\n--- פרופיל המשתמש ---\n"
-                if user_profile.get('name'):
-                    profile_context += f"שם: {user_profile['name']}\n"
-                if user_profile.get('age'):
-                    profile_context += f"גיל: {user_profile['age']}\n"
-                if user_profile.get('fitness_level'):
-                    profile_context += f"רמת כושר: {user_profile['fitness_level']}\n"
-                if user_profile.get('goals'):
-                    profile_context += f"יעדים: {', '.join(user_profile['goals'])}\n"
-                
-                enhanced_message = user_message + profile_context
-
-            # Create chat instance with error handling
-            chat = LlmChat(
-                api_key=self.api_key,
-                session_id=f"prod_fitness_{user_id}",
-                system_message=self.system_message
-            ).with_model("gemini", "gemini-2.0-flash").with_max_tokens(4000)
-            
-            # Create and send message
-            message = UserMessage(text=enhanced_message)
-            response = await chat.send_message(message)
+            route = self.router.route(user_message, user_profile)
+            enhanced_message = self._prepare_prompt(user_message, user_id, user_profile, route, context)
+
+            # Identical prompts that are already in flight share one upstream call
+            flight_key = self._flight_key(enhanced_message, route, shared)
+            if flight_key:
+                response = await self.in_flight.do(
+                    flight_key, lambda: self._complete(enhanced_message, user_id, cache_key, priority, route)
+                )
+            else:
+                response = await self._complete(enhanced_message, user_id, priority=priority, route=route)
             
             # Update session cache
-            self.session_cache[user_id] = {
-                'last_used': time.time(),
-                'message_count': self.session_cache.get(user_id, {}).get('message_count', 0) + 1
-            }
-            
-            # Validate response
-            if not response or len(response.strip()) == 0:
-                return "מצטער, נתקלתי בבעיה ביצירת תשובה. נסה שוב בעוד רגע! 🔄"
-            
-            return response.strip()
-            
+            self._touch_session(user_id)
+
+            return response
+
+        except LlmUnavailable as e:
+            LLM_UNAVAILABLE.inc(e.reason)
+            raise
         except Exception as e:
             logger.error(f"Error in ProductionFitnessTrainer.get_response: {str(e)}", exc_info=True)
-            return """שלום! 👋 נתקלתי בבעיה טכנית זמנית.
+            raise
+
+    async def stream_response(self, user_message: str, user_id: str, user_profile: Dict = None, use_cache: bool = True,
+                              priority: int = PRIORITY_STANDARD, route: Optional[str] = None,
+                              deadline: Optional[float] = None,
+                              attempt_timeout: Optional[float] = None) -> AsyncIterator[str]:
+        """Streaming variant of get_response that yields text chunks as they arrive.
+
+        Uses the integration's ``stream_message`` when the installed LlmChat
+        provides one; otherwise the completed reply is re-chunked so callers
+        can rely on a single streaming interface. A native stream that fails
+        before producing output is retried through the non-streaming path;
+        once output has been sent, failures raise LlmUnavailable. `route`
+        skips classification, `deadline` overrides the client's overall
+        budget for the non-streaming path and `attempt_timeout` the route's
+        per-attempt timeout, for callers such as plan jobs.
+        """
+        sent_any = False
+        try:
+            invalid_reply = self._validate_message(user_message)
+            if invalid_reply:
+                yield invalid_reply
+                return
+
+            context = await self._load_context(user_message, user_id)
+            shared = use_cache and not context
+
+            cache_key = self._cache_key(user_message, user_profile, shared)
+            if cache_key:
+                cached_response = await self.response_cache.get(cache_key)
+                if cached_response is not None:
+                    self._touch_session(user_id)
+                    yield cached_response
+                    return
 
-🔧 **אנא נסה שוב בעוד רגע**
+            route = route or self.router.route(user_message, user_profile)
+            enhanced_message = self._prepare_prompt(user_message, user_id, user_profile, route, context)
+            chat = self._get_chat(user_id, route)
 
-בינתיים, אני כאן לעזור לך עם:
-💪 תוכניות אימון מותאמות אישית
-🥗 עצות תזונה מקצועיות  
-🔥 מוטיבציה והנחיה אישית
-📊 ניתוח והגדרת יעדים
+            streamed = False
+            if getattr(chat, "stream_message", None) is not None:
+                chunks = []
+                started = time.perf_counter()
+                try:
+                    async for chunk in self.llm.stream(
+                        chat, enhanced_message, user_id, priority,
+                        route=route,
+                        attempt_timeout=attempt_timeout or self.router.routes[route].get("attempt_timeout")
+                    ):
+                        sent_any = True
+                        chunks.append(chunk)
+                        yield chunk
+                    streamed = True
+                except LlmOverloaded:
+                    raise
+                except LlmUnavailable as e:
+                    self.chat_pool.pop(self._session_id(user_id, route))
+                    if sent_any or isinstance(e, LlmRejected):
+                        raise
+
+                if streamed:
+                    full_response = "".join(chunks).strip()
+                    self._observe_route(route, enhanced_message, full_response, time.perf_counter() - started)
+                    if cache_key:
+                        await self.response_cache.set(cache_key, full_response)
+            if not streamed:
+                flight_key = self._flight_key(enhanced_message, route, shared)
+                if flight_key:
+                    response = await self.in_flight.do(
+                        flight_key,
+                        lambda: self._complete(enhanced_message, user_id, cache_key, priority, route, deadline, attempt_timeout)
+                    )
+                else:
+                    response = await self._complete(
+                        enhanced_message, user_id, priority=priority, route=route, deadline=deadline,
+                        attempt_timeout=attempt_timeout
+                    )
+                for start in range(0, len(response), STREAM_CHUNK_SIZE):
+                    yield response[start:start + STREAM_CHUNK_SIZE]
 
-ספר לי איך אני יכול לעזור לך! 😊"""
+            self._touch_session(user_id)
+
+        except LlmUnavailable as e:
+            LLM_UNAVAILABLE.inc(e.reason)
+            raise
+        except Exception as e:
+            logger.error(f"Error in ProductionFitnessTrainer.stream_response: {str(e)}", exc_info=True)
+            raise
 
 # Initialize trainer
 gemini_api_key = os.environ.get('GEMINI_API_KEY')
 if not gemini_api_key:
     raise ValueError("GEMINI_API_KEY environment variable is required")
 
-fitness_trainer = ProductionFitnessTrainer(gemini_api_key)
+prompt_builder = PromptBuilder(
+    load_system_prompts(SYSTEM_PROMPT_VERSION, PROMPTS_DIR),
+    SYSTEM_PROMPT_VERSION,
+    profiles=profile_cache
+)
+
+fitness_trainer = ProductionFitnessTrainer(
+    gemini_api_key,
+    response_cache=response_cache,
+    context=conversation_context,
+    llm=llm_client,
+    prompts=prompt_builder,
+    expiry=expiry_scheduler
+)
 
 # Enhanced Pydantic Models with validation
 class ChatMessage(BaseModel):
@@ -263,6 +3199,40 @@ class ChatMessageCreate(BaseModel):
     def sanitize_message(cls, v):
         return v.strip()
 
+class ChatBatchCreate(BaseModel):
+    items: List[ChatMessageCreate] = Field(..., min_items=1, max_items=CHAT_BATCH_MAX_ITEMS)
+    concurrency: int = Field(default=CHAT_BATCH_CONCURRENCY, ge=1, le=LLM_MAX_IN_FLIGHT)
+    # Check-ins send one message to many trainees, who should each get their own answer
+    use_cache: bool = False
+
+class PlanJobCreate(BaseModel):
+    user_id: str = Field(..., min_length=1, max_length=100)
+    request: str = Field(..., min_length=1, max_length=MAX_MESSAGE_LENGTH)
+
+    @validator('request')
+    def sanitize_request(cls, v):
+        return v.strip()
+
+class PlanJob(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    user_id: str
+    request: str
+    status: str = "queued"
+    result: Optional[str] = None
+    error: Optional[str] = None
+    attempts: int = 0
+    progress_chars: int = 0
+    retry_at: Optional[datetime] = None
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+    started_at: Optional[datetime] = None
+    completed_at: Optional[datetime] = None
+
+class PushMessage(BaseModel):
+    type: str = Field(default="notification", regex="^[a-z_]{1,40}$")
+    message: str = Field(..., min_length=1, max_length=MAX_MESSAGE_LENGTH)
+    data: Optional[Dict[str, Any]] = None
+
 class UserProfile(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     user_id: str = Field(..., min_length=1, max_length=100)
@@ -291,13 +3261,425 @@ async def rate_limit_check(request: Request, input: ChatMessageCreate = None):
     client_ip = request.client.host
     user_id = input.user_id if input else "unknown"
     
-    if not check_rate_limit(client_ip, user_id):
+    if not await check_rate_limit(client_ip, user_id):
+        RATE_LIMIT_REJECTIONS.inc("http")
         raise HTTPException(
             status_code=429,
-            detail="Rate limit exceeded. Please wait before sending more messages."
+            detail="Rate limit exceeded. Please wait before sending more messages.",
+            headers={"Retry-After": str(rate_limit_retry_after())}
         )
     return input
 
+def chat_message_payload(chat_message: ChatMessage) -> Dict[str, Any]:
+    """The JSON body for an already validated ChatMessage, as response_model=ChatMessage would render it"""
+    payload = chat_message.dict()
+    payload["timestamp"] = chat_message.timestamp.isoformat()
+    return payload
+
+def _record_turn(document: Dict):
+    if conversation_context is not None:
+        conversation_context.record(document)
+    user_stats.record_later(document)
+
+async def save_chat_message(chat_message: ChatMessage):
+    """Queue a chat turn for persistence and update the conversation window and user stats"""
+    document = chat_message.dict()
+    await chat_writer.enqueue(document)
+    _record_turn(document)
+
+async def save_chat_messages(chat_messages: List[ChatMessage]):
+    """Persist many chat turns with one insert_many, handing them to the write-behind queue if it fails"""
+    documents = [chat_message.dict() for chat_message in chat_messages]
+    try:
+        with DB_INSERT_SECONDS.time():
+            await db.chat_messages.insert_many(documents, ordered=False)
+    except Exception as e:
+        # The writer retries, skips ids that did get stored and spills what still fails
+        logger.error(f"Batch chat insert failed, queueing for retry: {str(e)}")
+        for document in documents:
+            await chat_writer.enqueue(document)
+    for document in documents:
+        _record_turn(document)
+
+# Plan generation jobs
+PLAN_PROJECTION = {"_id": 0, "dedupe_key": 0, "worker_id": 0, "lease_expires_at": 0}
+
+class PlanJobQueue:
+    """Runs long-form plan generation off the request path.
+
+    Jobs live in the `plans` collection; the in-process queue only carries
+    job ids. A bounded pool of workers claims a job by atomically moving it
+    from queued to running under a lease, generates the plan through the
+    trainer and pushes progress to the user's sockets. Jobs are deduplicated
+    per user and normalized request. An attempt that fails for a temporary
+    reason (overload, an open circuit, timeouts) is requeued with backoff
+    until PLAN_MAX_ATTEMPTS; only permanent errors fail the job early.
+    Queued jobs, and running jobs whose lease lapsed because their worker
+    died, are picked up again by a periodic recovery sweep in any process.
+    """
+
+    def __init__(self, collection, trainer, profiles, connections, workers: int, max_queue: int):
+        self.collection = collection
+        self.trainer = trainer
+        self.profiles = profiles
+        self.connections = connections
+        self.workers = workers
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._queued_ids = set()
+        self._retry_timers: Dict[str, asyncio.TimerHandle] = {}
+        self._tasks: List[asyncio.Task] = []
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+        self.deduplicated = 0
+
+    async def setup(self):
+        try:
+            await self.collection.create_index("id", unique=True)
+            # Sparse: finished-and-expired or failed jobs drop their key so the request can be made again
+            await self.collection.create_index("dedupe_key", unique=True, sparse=True)
+            await self.collection.create_index([("user_id", 1), ("created_at", -1)])
+            await self.collection.create_index([("status", 1), ("lease_expires_at", 1)])
+        except Exception as e:
+            logger.error(f"Plan index creation error: {str(e)}")
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._recover_loop()))
+
+    @staticmethod
+    def dedupe_key(user_id: str, request: str) -> str:
+        return hashlib.sha256(f"{user_id}\x1f{normalize_message(request)}".encode("utf-8")).hexdigest()
+
+    async def submit(self, user_id: str, request: str) -> Tuple[Dict[str, Any], bool]:
+        """Create a job, or return the existing one for the same user and request.
+
+        Returns the job and whether it was newly created.
+        """
+        key = self.dedupe_key(user_id, request)
+        existing = await self.collection.find_one({"dedupe_key": key}, PLAN_PROJECTION)
+        if existing is not None:
+            fresh = existing.get("completed_at") is None or \
+                existing["completed_at"] > datetime.utcnow() - timedelta(seconds=PLAN_DEDUPE_SECONDS)
+            if existing["status"] != "completed" or fresh:
+                self.deduplicated += 1
+                return existing, False
+            # An old plan no longer blocks asking for a new one
+            await self.collection.update_one({"id": existing["id"]}, {"$unset": {"dedupe_key": ""}})
+
+        job = PlanJob(user_id=user_id, request=request).dict()
+        try:
+            await self.collection.insert_one({**job, "dedupe_key": key})
+        except DuplicateKeyError:
+            # A concurrent request for the same plan won the race
+            existing = await self.collection.find_one({"dedupe_key": key}, PLAN_PROJECTION)
+            if existing is None:
+                raise
+            self.deduplicated += 1
+            return existing, False
+        self._enqueue(job["id"])
+        return job, True
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return await self.collection.find_one({"id": job_id}, PLAN_PROJECTION)
+
+    async def list_for_user(self, user_id: str, limit: int) -> List[Dict[str, Any]]:
+        cursor = self.collection.find({"user_id": user_id}, PLAN_PROJECTION).sort("created_at", -1).limit(limit)
+        return await cursor.to_list(length=limit)
+
+    def _enqueue(self, job_id: str):
+        if job_id in self._queued_ids:
+            return
+        try:
+            self.queue.put_nowait(job_id)
+            self._queued_ids.add(job_id)
+        except asyncio.QueueFull:
+            # Still queued in Mongo; the recovery sweep will pick it up
+            pass
+
+    def _enqueue_later(self, job_id: str, delay: float):
+        def due():
+            self._retry_timers.pop(job_id, None)
+            self._enqueue(job_id)
+        self._retry_timers[job_id] = asyncio.get_running_loop().call_later(delay, due)
+
+    async def _worker(self):
+        while True:
+            job_id = await self.queue.get()
+            self._queued_ids.discard(job_id)
+            self.running += 1
+            try:
+                await self._run(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Plan job {job_id} error: {str(e)}", exc_info=True)
+            finally:
+                self.running -= 1
+
+    async def _claim(self, job_id: str) -> Optional[Dict[str, Any]]:
+        now = datetime.utcnow()
+        return await self.collection.find_one_and_update(
+            {"id": job_id, "status": "queued", "$or": [{"retry_at": None}, {"retry_at": {"$lte": now}}]},
+            {
+                "$set": {
+                    "status": "running",
+                    "started_at": now,
+                    "updated_at": now,
+                    "worker_id": WORKER_ID,
+                    "lease_expires_at": now + timedelta(seconds=PLAN_LEASE_SECONDS)
+                },
+                "$inc": {"attempts": 1}
+            },
+            projection={"user_id": 1, "request": 1, "attempts": 1},
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def _run(self, job_id: str):
+        job = await self._claim(job_id)
+        if job is None:
+            # Claimed by another worker, or no longer queued
+            return
+        user_id = job["user_id"]
+        # Writes only land while this attempt still holds the job, so a worker whose
+        # lease lapsed cannot overwrite the progress or outcome of the one that took over
+        lease = {"id": job_id, "status": "running", "worker_id": WORKER_ID, "attempts": job["attempts"]}
+        await self._notify(user_id, job_id, "running")
+
+        chunks = []
+        progress_chars = 0
+        last_progress = time.monotonic()
+        try:
+            user_profile = await self.profiles.get(user_id)
+            async for chunk in self.trainer.stream_response(
+                job["request"], user_id, user_profile, use_cache=False,
+                priority=PRIORITY_BATCH, route="plan", deadline=PLAN_DEADLINE_SECONDS,
+                attempt_timeout=PLAN_DEADLINE_SECONDS
+            ):
+                chunks.append(chunk)
+                progress_chars += len(chunk)
+                if time.monotonic() - last_progress >= PLAN_PROGRESS_INTERVAL_SECONDS:
+                    last_progress = time.monotonic()
+                    if not await self._renew(lease, progress_chars):
+                        logger.warning(f"Plan job {job_id} lease lost, abandoning this attempt")
+                        return
+                    await self._notify(user_id, job_id, "running", progress_chars=progress_chars)
+            result = "".join(chunks).strip()
+        except LlmRejected as e:
+            await self._fail(lease, user_id, e.detail)
+            return
+        except LlmUnavailable as e:
+            if job["attempts"] >= PLAN_MAX_ATTEMPTS:
+                await self._fail(lease, user_id, e.detail)
+            else:
+                await self._retry(lease, user_id, e.detail, e.retry_after)
+            return
+        except Exception as e:
+            logger.error(f"Plan generation failed for job {job_id}: {str(e)}", exc_info=True)
+            await self._fail(lease, user_id, "Plan generation failed")
+            return
+
+        now = datetime.utcnow()
+        completed = await self.collection.update_one(
+            lease,
+            {
+                "$set": {
+                    "status": "completed",
+                    "result": result,
+                    "progress_chars": len(result),
+                    "completed_at": now,
+                    "updated_at": now
+                },
+                "$unset": {"lease_expires_at": "", "retry_at": "", "error": ""}
+            }
+        )
+        if completed.matched_count == 0:
+            logger.warning(f"Plan job {job_id} lease lost, discarding its result")
+            return
+        self.completed += 1
+        await self._notify(user_id, job_id, "completed", plan=result)
+
+    async def _renew(self, lease: Dict[str, Any], progress_chars: int) -> bool:
+        """Extend the lease and record progress; False if the attempt no longer holds the job"""
+        now = datetime.utcnow()
+        result = await self.collection.update_one(
+            lease,
+            {"$set": {
+                "progress_chars": progress_chars,
+                "updated_at": now,
+                "lease_expires_at": now + timedelta(seconds=PLAN_LEASE_SECONDS)
+            }}
+        )
+        return result.matched_count > 0
+
+    async def _retry(self, lease: Dict[str, Any], user_id: str, error: str, retry_after: float):
+        """Put the job back in the queue once the backoff for this attempt has passed"""
+        delay = max(retry_after, min(PLAN_RETRY_BASE_SECONDS * 2 ** (lease["attempts"] - 1), PLAN_RETRY_MAX_SECONDS))
+        now = datetime.utcnow()
+        result = await self.collection.update_one(
+            lease,
+            {
+                "$set": {
+                    "status": "queued",
+                    "error": error,
+                    "progress_chars": 0,
+                    "retry_at": now + timedelta(seconds=delay),
+                    "updated_at": now
+                },
+                "$unset": {"lease_expires_at": ""}
+            }
+        )
+        if result.matched_count == 0:
+            return
+        self.retried += 1
+        self._enqueue_later(lease["id"], delay)
+        await self._notify(user_id, lease["id"], "queued", error=error, retry_after=round(delay))
+
+    async def _fail(self, lease: Dict[str, Any], user_id: str, error: str):
+        now = datetime.utcnow()
+        result = await self.collection.update_one(
+            lease,
+            {
+                "$set": {"status": "failed", "error": error, "completed_at": now, "updated_at": now},
+                "$unset": {"dedupe_key": "", "lease_expires_at": ""}
+            }
+        )
+        if result.matched_count == 0:
+            return
+        self.failed += 1
+        await self._notify(user_id, lease["id"], "failed", error=error)
+
+    async def _notify(self, user_id: str, job_id: str, status: str, **fields):
+        await self.connections.push(user_id, {"type": "plan_update", "job_id": job_id, "status": status, **fields})
+
+    async def _recover_loop(self):
+        while True:
+            try:
+                await self.recover()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Plan recovery error: {str(e)}")
+            await asyncio.sleep(PLAN_RECOVERY_INTERVAL_SECONDS)
+
+    async def recover(self):
+        """Requeue jobs whose lease lapsed and enqueue queued jobs this process does not hold yet"""
+        now = datetime.utcnow()
+        lapsed = {"status": "running", "lease_expires_at": {"$lt": now}}
+        await self.collection.update_many(
+            {**lapsed, "attempts": {"$gte": PLAN_MAX_ATTEMPTS}},
+            {
+                "$set": {"status": "failed", "error": "Plan generation did not finish", "completed_at": now, "updated_at": now},
+                "$unset": {"dedupe_key": "", "lease_expires_at": ""}
+            }
+        )
+        await self.collection.update_many(
+            {**lapsed, "attempts": {"$lt": PLAN_MAX_ATTEMPTS}},
+            {"$set": {"status": "queued", "updated_at": now}}
+        )
+        room = self.queue.maxsize - self.queue.qsize()
+        if room <= 0:
+            return
+        due = {"status": "queued", "$or": [{"retry_at": None}, {"retry_at": {"$lte": now}}]}
+        cursor = self.collection.find(due, {"id": 1, "_id": 0}).sort("created_at", 1).limit(room)
+        async for doc in cursor:
+            self._enqueue(doc["id"])
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        for timer in self._retry_timers.values():
+            timer.cancel()
+        # Hand this worker's unfinished jobs back without waiting for their lease to lapse
+        try:
+            await self.collection.update_many(
+                {"status": "running", "worker_id": WORKER_ID},
+                {"$set": {"status": "queued", "updated_at": datetime.utcnow()}}
+            )
+        except Exception as e:
+            logger.error(f"Plan job release error: {str(e)}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "queued_locally": self.queue.qsize(),
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "retried": self.retried,
+            "deduplicated": self.deduplicated
+        }
+
+plan_jobs = PlanJobQueue(db.plans, fitness_trainer, profile_cache, manager, PLAN_WORKERS, PLAN_QUEUE_SIZE)
+
+# Gauges are read at scrape time
+metrics.gauge("websocket_active_connections", "Open WebSocket connections", lambda: manager.connection_count)
+metrics.gauge("websocket_connected_users", "Users with at least one open WebSocket", lambda: len(manager.active_connections))
+metrics.gauge("expiry_scheduled_keys", "Keys waiting in the expiry scheduler", lambda: len(expiry_scheduler))
+metrics.gauge("session_cache_size", "Entries in the trainer session cache", lambda: len(fitness_trainer.session_cache))
+metrics.gauge("chat_pool_size", "Pooled LLM chat sessions", lambda: len(fitness_trainer.chat_pool))
+metrics.gauge("rate_limiter_tracked_users", "Users held in the in-process rate limiter", lambda: len(rate_limiter))
+metrics.gauge("chat_write_queue_depth", "Chat messages waiting to be persisted", lambda: chat_writer.queue.qsize())
+metrics.gauge("llm_in_flight", "Distinct coalesced LLM calls in flight", lambda: fitness_trainer.in_flight.stats()["in_flight"])
+metrics.gauge("llm_scheduler_in_flight", "Upstream LLM calls holding a slot", lambda: llm_scheduler.in_flight)
+metrics.gauge("llm_scheduler_queued", "LLM calls waiting for a slot", lambda: llm_scheduler.queued)
+metrics.gauge(
+    "llm_circuit_state", "LLM circuit breaker state (0 closed, 1 half-open, 2 open)",
+    lambda: {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}[llm_client.breaker.state]
+)
+metrics.gauge("plan_jobs_running", "Plan generation jobs running in this worker", lambda: plan_jobs.running)
+metrics.gauge("plan_jobs_queued", "Plan generation jobs waiting in this worker's queue", lambda: plan_jobs.queue.qsize())
+metrics.gauge("profile_cache_size", "Cached user profiles", lambda: len(profile_cache.cache))
+
+# Everything else the components report about themselves, exported as
+# component_stats{component="...",stat="..."}
+COMPONENT_STATS = {
+    "chat_pool": lambda: fitness_trainer.chat_pool.stats(),
+    "response_cache": lambda: response_cache.stats(),
+    "in_flight": lambda: fitness_trainer.in_flight.stats(),
+    "profile_cache": lambda: profile_cache.stats(),
+    "chat_writer": lambda: chat_writer.stats(),
+    "llm_scheduler": lambda: llm_scheduler.stats(),
+    "llm": lambda: llm_client.stats(),
+    "routing": lambda: fitness_trainer.router.stats(),
+    "prompts": lambda: prompt_builder.stats(),
+    "plan_jobs": lambda: plan_jobs.stats(),
+    "archive": lambda: chat_archiver.stats(),
+    "user_stats": lambda: user_stats.stats(),
+    "expiry": lambda: expiry_scheduler.stats(),
+    "websocket": lambda: {"reaped": manager.reaped, "backplane": manager.backplane.stats()},
+    "context": lambda: conversation_context.stats() if conversation_context is not None else {}
+}
+
+def _numeric_stats(stats: Dict[str, Any], prefix: str = "") -> Dict[str, float]:
+    """Numeric leaves of a nested stats() dict, keyed by their underscore-joined path"""
+    values = {}
+    for key, value in stats.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            values.update(_numeric_stats(value, f"{name}_"))
+        elif isinstance(value, (int, float)):
+            values[name] = float(value)
+    return values
+
+def component_stats() -> Dict[tuple, float]:
+    samples = {}
+    for component, read_stats in COMPONENT_STATS.items():
+        try:
+            stats = read_stats()
+        except Exception as e:
+            logger.error(f"Error reading {component} stats: {str(e)}")
+            continue
+        for stat, value in _numeric_stats(stats).items():
+            samples[(component, stat)] = value
+    return samples
+
+metrics.gauge(
+    "component_stats", "Internal counters and sizes reported by each component",
+    component_stats, labels=("component", "stat")
+)
+
 # Production API Routes
 @api_router.get("/")
 async def root():
@@ -308,21 +3690,39 @@ async def root():
         "powered_by": "Gemini AI"
     }
 
+@api_router.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus text exposition of the in-process metrics"""
+    if not metrics.enabled:
+        raise HTTPException(status_code=404, detail="Metrics disabled")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+AI_SERVICE_STATUS = {
+    CircuitBreaker.CLOSED: "operational",
+    CircuitBreaker.HALF_OPEN: "recovering",
+    CircuitBreaker.OPEN: "unavailable"
+}
+
 @api_router.get("/health")
 async def health_check():
-    """Health check endpoint for monitoring"""
+    """Health check endpoint for monitoring; component internals are exported by /api/metrics"""
     try:
         # Check database connection
-        await db.admin.command('ping')
+        await db.command('ping')
         return {
             "status": "healthy",
             "timestamp": datetime.utcnow().isoformat(),
             "database": "connected",
-            "ai_service": "operational"
+            "ai_service": AI_SERVICE_STATUS[llm_client.breaker.state],
+            "circuit": llm_client.breaker.stats()
         }
     except Exception as e:
         raise HTTPException(status_code=503, detail="Service unhealthy")
 
+def cache_bypassed(request: Request) -> bool:
+    """Clients can ask for a fresh answer with `Cache-Control: no-cache`"""
+    return "no-cache" in request.headers.get("cache-control", "").lower()
+
 @api_router.post("/chat", response_model=ChatMessage)
 async def send_message(
     request: Request,
@@ -330,14 +3730,14 @@ async def send_message(
 ):
     try:
         # Get user profile for context
-        user_profile_doc = await db.user_profiles.find_one({"user_id": input.user_id})
-        user_profile = user_profile_doc if user_profile_doc else {}
+        user_profile = await profile_cache.get(input.user_id)
         
         # Generate AI response
         ai_response = await fitness_trainer.get_response(
             input.message, 
             input.user_id, 
-            user_profile
+            user_profile,
+            use_cache=not cache_bypassed(request)
         )
         
         # Create chat message
@@ -347,33 +3747,142 @@ async def send_message(
             response=ai_response
         )
         
-        # Save to database with error handling
-        try:
-            await db.chat_messages.insert_one(chat_message.dict())
-        except Exception as db_error:
-            logger.error(f"Database error: {str(db_error)}")
-            # Continue even if database save fails
+        # Persisted in the background by the write-behind queue
+        await save_chat_message(chat_message)
         
-        return chat_message
+        # Validated once on construction; skip response_model's second pass
+        return FastJSONResponse(chat_message_payload(chat_message))
         
     except HTTPException:
         raise
+    except LlmUnavailable as e:
+        raise HTTPException(
+            status_code=503,
+            detail=e.detail,
+            headers={"Retry-After": str(e.retry_after)}
+        )
     except Exception as e:
         logger.error(f"Error in send_message: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail="Internal server error")
 
+def format_sse(event: str, data: Dict[str, Any]) -> str:
+    """Encode a single Server-Sent Events frame"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@api_router.post("/chat/stream")
+async def stream_message(
+    request: Request,
+    input: ChatMessageCreate = Depends(rate_limit_check)
+):
+    """Stream the AI response as Server-Sent Events.
+
+    Emits ``delta`` events while the answer is generated and a final ``done``
+    event carrying the persisted chat message.
+    """
+    user_profile = await profile_cache.get(input.user_id)
+
+    async def event_stream():
+        chunks = []
+        try:
+            async for chunk in fitness_trainer.stream_response(
+                input.message, input.user_id, user_profile, use_cache=not cache_bypassed(request)
+            ):
+                chunks.append(chunk)
+                yield format_sse("delta", {"delta": chunk})
+
+            chat_message = ChatMessage(
+                user_id=input.user_id,
+                message=input.message,
+                response="".join(chunks)
+            )
+
+            await save_chat_message(chat_message)
+
+            yield format_sse("done", chat_message_payload(chat_message))
+
+        except LlmUnavailable as e:
+            yield format_sse("error", {"message": e.detail, "retry_after": e.retry_after})
+        except Exception as e:
+            logger.error(f"Error in stream_message: {str(e)}", exc_info=True)
+            yield format_sse("error", {"message": "Internal server error"})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+CHAT_HISTORY_PROJECTION = {
+    "_id": 0,
+    "id": 1,
+    "user_id": 1,
+    "message": 1,
+    "response": 1,
+    "timestamp": 1,
+    "message_type": 1
+}
+
+def encode_history_cursor(timestamp: datetime, message_id: str) -> str:
+    raw = f"{timestamp.isoformat()}|{message_id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+def decode_history_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+        timestamp, message_id = raw.split("|", 1)
+        return datetime.fromisoformat(timestamp), message_id
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
 @api_router.get("/chat/{user_id}", response_model=List[ChatMessage])
-async def get_chat_history(user_id: str, limit: int = Field(default=50, le=200, ge=1)):
+async def get_chat_history(
+    user_id: str,
+    limit: int = Query(default=50, le=200, ge=1),
+    before: Optional[str] = Query(default=None, description="Cursor from X-Next-Cursor of the previous page")
+):
+    """Newest-first chat history with keyset pagination on (timestamp, id).
+
+    The body stays a plain list; the cursor for the next (older) page is
+    returned in the X-Next-Cursor header when more messages may exist.
+    Pages that run past the hot collection continue into the archive.
+    """
     try:
         # Validate user_id
         if not user_id or len(user_id) > 100:
             raise HTTPException(status_code=400, detail="Invalid user_id")
+
+        query: Dict[str, Any] = {"user_id": user_id}
+        cursor = None
+        if before:
+            cursor = decode_history_cursor(before)
+            before_timestamp, before_id = cursor
+            query["$or"] = [
+                {"timestamp": {"$lt": before_timestamp}},
+                {"timestamp": before_timestamp, "id": {"$lt": before_id}}
+            ]
             
         messages = await db.chat_messages.find(
-            {"user_id": user_id}
-        ).sort("timestamp", -1).limit(limit).to_list(limit)
-        
-        return [ChatMessage(**msg) for msg in messages]
+            query, CHAT_HISTORY_PROJECTION
+        ).sort([("timestamp", -1), ("id", -1)]).limit(limit).to_list(limit)
+
+        # Documents were validated when they were written, so skip per-row model validation
+        for msg in messages:
+            msg["timestamp"] = msg["timestamp"].isoformat()
+
+        if len(messages) < limit:
+            # Merge rather than append: a message archived mid-request may be in both tiers
+            seen = {msg["id"] for msg in messages}
+            archived = await chat_archiver.history(user_id, limit, cursor)
+            messages.extend(msg for msg in archived if msg["id"] not in seen)
+            messages.sort(key=lambda msg: (msg["timestamp"], msg["id"]), reverse=True)
+            del messages[limit:]
+
+        headers = {}
+        if len(messages) == limit:
+            last = messages[-1]
+            headers["X-Next-Cursor"] = encode_history_cursor(datetime.fromisoformat(last["timestamp"]), last["id"])
+
+        return FastJSONResponse(content=messages, headers=headers)
         
     except HTTPException:
         raise
@@ -381,21 +3890,34 @@ async def get_chat_history(user_id: str, limit: int = Field(default=50, le=200,
         logger.error(f"Error in get_chat_history: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
+async def upsert_profile(profile: UserProfile) -> Tuple[Dict, bool]:
+    """Insert `profile` unless its user already has one, in a single round trip.
+
+    Returns the stored document and whether this call created it. Relies on the
+    unique `user_id` index: concurrent first requests race on the upsert, and
+    the loser retries and reads the winner's document.
+    """
+    defaults = {k: v for k, v in profile.dict().items() if k != "user_id"}
+    for attempt in range(2):
+        try:
+            doc = await db.user_profiles.find_one_and_update(
+                {"user_id": profile.user_id},
+                {"$setOnInsert": defaults},
+                projection={"_id": 0},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            return doc, doc["id"] == profile.id
+        except DuplicateKeyError:
+            if attempt:
+                raise
+
 @api_router.post("/profile", response_model=UserProfile)
 async def create_user_profile(input: UserProfileCreate):
     try:
-        # Check if profile exists
-        existing_profile = await db.user_profiles.find_one({"user_id": input.user_id})
-        if existing_profile:
-            return UserProfile(**existing_profile)
-        
-        # Create new profile
-        profile_data = input.dict()
-        profile_data['created_at'] = datetime.utcnow()
-        profile_data['updated_at'] = datetime.utcnow()
-        
-        profile = UserProfile(**profile_data)
-        await db.user_profiles.insert_one(profile.dict())
+        # An existing profile is returned unchanged
+        profile, created = await upsert_profile(UserProfile(**input.dict()))
+        profile_cache.put(input.user_id, profile, changed=created)
         return profile
         
     except Exception as e:
@@ -408,19 +3930,13 @@ async def get_user_profile(user_id: str):
         if not user_id or len(user_id) > 100:
             raise HTTPException(status_code=400, detail="Invalid user_id")
             
-        profile = await db.user_profiles.find_one({"user_id": user_id})
+        profile = profile_cache.cache.get(user_id)
         if profile:
-            return UserProfile(**profile)
-        else:
-            # Create default profile
-            default_profile = UserProfile(
-                user_id=user_id, 
-                name="משתמש",
-                created_at=datetime.utcnow(),
-                updated_at=datetime.utcnow()
-            )
-            await db.user_profiles.insert_one(default_profile.dict())
-            return default_profile
+            return profile
+        # Cache miss: read the profile, creating the default one if missing
+        profile, created = await upsert_profile(UserProfile(user_id=user_id, name="משתמש"))
+        profile_cache.put(user_id, profile, changed=created)
+        return profile
             
     except HTTPException:
         raise
@@ -434,23 +3950,23 @@ async def update_user_profile(user_id: str, input: UserProfileUpdate):
         if not user_id or len(user_id) > 100:
             raise HTTPException(status_code=400, detail="Invalid user_id")
             
-        # Get existing profile
-        existing_profile = await db.user_profiles.find_one({"user_id": user_id})
-        if not existing_profile:
-            raise HTTPException(status_code=404, detail="Profile not found")
-        
         # Update only provided fields
         update_data = {k: v for k, v in input.dict().items() if v is not None}
         if update_data:
             update_data['updated_at'] = datetime.utcnow()
-            await db.user_profiles.update_one(
+            profile = await db.user_profiles.find_one_and_update(
                 {"user_id": user_id},
-                {"$set": update_data}
+                {"$set": update_data},
+                projection={"_id": 0},
+                return_document=ReturnDocument.AFTER
             )
+        else:
+            profile = await db.user_profiles.find_one({"user_id": user_id}, {"_id": 0})
+        if not profile:
+            raise HTTPException(status_code=404, detail="Profile not found")
         
-        # Return updated profile
-        updated_profile = await db.user_profiles.find_one({"user_id": user_id})
-        return UserProfile(**updated_profile)
+        profile_cache.put(user_id, profile, changed=bool(update_data))
+        return profile
         
     except HTTPException:
         raise
@@ -458,41 +3974,381 @@ async def update_user_profile(user_id: str, input: UserProfileUpdate):
         logger.error(f"Error in update_user_profile: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
+async def plan_rate_limit_check(request: Request, input: PlanJobCreate):
+    return await rate_limit_check(request, input)
+
+@api_router.post("/plans", response_model=PlanJob, status_code=202)
+async def create_plan(response: Response, input: PlanJobCreate = Depends(plan_rate_limit_check)):
+    """Queue a plan generation job; progress and the result arrive over /api/ws/{user_id}.
+
+    Repeating a request returns the existing job (200) instead of queuing a duplicate.
+    """
+    try:
+        job, created = await plan_jobs.submit(input.user_id, input.request)
+        if not created:
+            response.status_code = 200
+        return job
+    except Exception as e:
+        logger.error(f"Error creating plan job: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+@api_router.get("/plans/{job_id}", response_model=PlanJob)
+async def get_plan(job_id: str):
+    try:
+        job = await plan_jobs.get(job_id)
+    except Exception as e:
+        logger.error(f"Error getting plan job: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+    if job is None:
+        raise HTTPException(status_code=404, detail="Plan not found")
+    return job
+
+@api_router.get("/plans/user/{user_id}", response_model=List[PlanJob])
+async def get_user_plans(user_id: str, limit: int = Query(default=20, ge=1, le=100)):
+    try:
+        return await plan_jobs.list_for_user(user_id, limit)
+    except Exception as e:
+        logger.error(f"Error listing plan jobs: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+@api_router.get("/stats/{user_id}")
+async def get_user_stats(user_id: str, days: int = Query(default=STATS_DEFAULT_DAYS, ge=1, le=366)):
+    """Precomputed progress stats: totals, streaks, topic mix and daily counts for the last `days` days"""
+    if not user_id or len(user_id) > 100:
+        raise HTTPException(status_code=400, detail="Invalid user_id")
+    try:
+        return await user_stats.get(user_id, days)
+    except Exception as e:
+        logger.error(f"Error getting user stats: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+# Bulk export and import of chat history
+async def export_chat_history(user_id: str) -> AsyncIterator[bytes]:
+    """Yield the user's history oldest-first as gzip-compressed NDJSON.
+
+    The cursor is read in EXPORT_BATCH_SIZE batches and output is compressed
+    in EXPORT_FLUSH_BYTES pieces, so memory stays flat however long the
+    history is.
+    """
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)  # gzip container
+    buffer = bytearray()
+
+    async def documents():
+        # Archived buckets hold the older messages, so they come first
+        async for doc in chat_archiver.iter_oldest_first(user_id):
+            yield doc
+        cursor = db.chat_messages.find(
+            {"user_id": user_id}, CHAT_HISTORY_PROJECTION
+        ).sort([("timestamp", 1), ("id", 1)]).batch_size(EXPORT_BATCH_SIZE)
+        async for doc in cursor:
+            doc["timestamp"] = doc["timestamp"].isoformat()
+            yield doc
+
+    try:
+        async for doc in documents():
+            buffer += json.dumps(doc, ensure_ascii=False).encode("utf-8") + b"\n"
+            if len(buffer) >= EXPORT_FLUSH_BYTES:
+                chunk = compressor.compress(bytes(buffer))
+                buffer.clear()
+                if chunk:
+                    yield chunk
+        yield compressor.compress(bytes(buffer)) + compressor.flush()
+    except Exception as e:
+        # Headers are already sent; aborting leaves a truncated gzip stream the client will reject
+        logger.error(f"Error exporting chat history for {user_id}: {str(e)}")
+        raise
+
+async def ndjson_lines(request: Request) -> AsyncIterator[bytes]:
+    """Split a plain or gzip-compressed request body into lines without buffering it whole"""
+    decompressor = None
+    sniffed = False
+    pending = b""
+    async for chunk in request.stream():
+        if not chunk:
+            continue
+        if not sniffed:
+            sniffed = True
+            if chunk[:2] == b"\x1f\x8b":
+                decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+        pieces = [chunk]
+        if decompressor is not None:
+            pieces = []
+            data = decompressor.decompress(chunk, IMPORT_MAX_LINE_BYTES)
+            while data:
+                pieces.append(data)
+                data = decompressor.decompress(decompressor.unconsumed_tail, IMPORT_MAX_LINE_BYTES) \
+                    if decompressor.unconsumed_tail else b""
+        for piece in pieces:
+            pending += piece
+            *lines, pending = pending.split(b"\n")
+            for line in lines:
+                yield line
+            if len(pending) > IMPORT_MAX_LINE_BYTES:
+                raise HTTPException(status_code=413, detail="Import line too long")
+    if pending:
+        yield pending
+
+async def import_chat_history(user_id: str, lines: AsyncIterator[bytes]) -> Dict[str, Any]:
+    """Validate NDJSON chat messages and insert them in unordered batches.
+
+    Messages whose id already exists are counted as duplicates, so an
+    interrupted import can simply be run again.
+    """
+    result = {"imported": 0, "duplicates": 0, "invalid": 0, "errors": []}
+    batch: List[Dict] = []
+    line_number = 0
+    async for line in lines:
+        line_number += 1
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            if not isinstance(record, dict):
+                raise ValueError("line is not a JSON object")
+            record.setdefault("user_id", user_id)
+            if record["user_id"] != user_id:
+                raise ValueError("user_id does not match the import target")
+            batch.append(ChatMessage(**record).dict())
+        except (ValueError, TypeError) as e:
+            result["invalid"] += 1
+            if len(result["errors"]) < IMPORT_MAX_REPORTED_ERRORS:
+                result["errors"].append({"line": line_number, "error": str(e)[:200]})
+            continue
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            await _insert_import_batch(batch, result)
+            batch = []
+    if batch:
+        await _insert_import_batch(batch, result)
+    return result
+
+async def rebuild_user_stats(user_id: str) -> bool:
+    """Recompute a user's stats from both history tiers after a bulk import"""
+    try:
+        await user_stats.backfill(user_id)
+        return True
+    except Exception as e:
+        logger.error(f"Error rebuilding stats for {user_id} after import, run backfill-stats: {str(e)}")
+        return False
+
+async def _insert_import_batch(batch: List[Dict], result: Dict[str, Any]):
+    try:
+        with DB_INSERT_SECONDS.time():
+            await db.chat_messages.insert_many(batch, ordered=False)
+        result["imported"] += len(batch)
+    except BulkWriteError as e:
+        errors = (e.details or {}).get("writeErrors", [])
+        duplicates = sum(1 for err in errors if err.get("code") == 11000)
+        if duplicates != len(errors):
+            raise
+        result["imported"] += len(batch) - duplicates
+        result["duplicates"] += duplicates
+
+# Admin endpoints are disabled unless ADMIN_API_TOKEN is set
+ADMIN_API_TOKEN = os.environ.get('ADMIN_API_TOKEN')
+admin_bearer = HTTPBearer(auto_error=False)
+
+async def require_admin(credentials: Optional[HTTPAuthorizationCredentials] = Depends(admin_bearer)):
+    if not ADMIN_API_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if credentials is None or not hmac.compare_digest(credentials.credentials, ADMIN_API_TOKEN):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+@api_router.get("/presence")
+async def get_presence():
+    """Connected users and sockets across all workers"""
+    try:
+        return await manager.presence()
+    except Exception as e:
+        logger.error(f"Error getting presence: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+@api_router.post("/push/{user_id}", dependencies=[Depends(require_admin)])
+async def push_message(user_id: str, push: PushMessage):
+    """Push a proactive message (e.g. a workout reminder) to every socket the user has open"""
+    payload = {
+        "type": push.type,
+        "message": push.message,
+        "timestamp": datetime.utcnow().isoformat()
+    }
+    if push.data is not None:
+        payload["data"] = push.data
+    await manager.push(user_id, payload)
+    return {"status": "published", "user_id": user_id}
+
+@api_router.get("/chat/{user_id}/export", dependencies=[Depends(require_admin)])
+async def export_chat(user_id: str):
+    """Full chat history as a gzip-compressed NDJSON download, streamed with constant memory"""
+    if not user_id or len(user_id) > 100:
+        raise HTTPException(status_code=400, detail="Invalid user_id")
+    filename = re.sub(r"[^A-Za-z0-9_.-]", "_", user_id)
+    return StreamingResponse(
+        export_chat_history(user_id),
+        media_type="application/gzip",
+        headers={"Content-Disposition": f'attachment; filename="chat_{filename}.ndjson.gz"'}
+    )
+
+@api_router.post("/chat/{user_id}/import", dependencies=[Depends(require_admin)])
+async def import_chat(user_id: str, request: Request):
+    """Bulk-load chat messages for a user from NDJSON (plain or gzip), e.g. an export file"""
+    if not user_id or len(user_id) > 100:
+        raise HTTPException(status_code=400, detail="Invalid user_id")
+    try:
+        result = await import_chat_history(user_id, ndjson_lines(request))
+    except HTTPException:
+        raise
+    except zlib.error:
+        raise HTTPException(status_code=400, detail="Invalid gzip body")
+    except Exception as e:
+        logger.error(f"Error importing chat history for {user_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+    if conversation_context is not None:
+        # The cached conversation window predates the imported messages
+        conversation_context.states.pop(user_id)
+    if result["imported"]:
+        result["stats_rebuilt"] = await rebuild_user_stats(user_id)
+    return result
+
+@api_router.post("/archive/run", dependencies=[Depends(require_admin)])
+async def run_archive():
+    """Archive old chat messages now instead of waiting for the hourly run"""
+    try:
+        return await chat_archiver.run()
+    except Exception as e:
+        logger.error(f"Error running chat archive: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+# Batch chat for coach dashboards
+chat_batch_tasks = set()
+
+async def run_chat_batch(batch: ChatBatchCreate, use_cache: bool, results: asyncio.Queue):
+    """Answer every item with bounded concurrency, publishing each result as it completes.
+
+    Runs detached from the request, so answers already generated are still
+    saved if the client disconnects; they are persisted together at the end.
+    Every item counts against its user's rate limit.
+    """
+    profiles = await profile_cache.get_many(item.user_id for item in batch.items)
+    semaphore = asyncio.Semaphore(batch.concurrency)
+    completed: List[ChatMessage] = []
+
+    async def answer(index: int, item: ChatMessageCreate):
+        result: Dict[str, Any] = {"index": index, "user_id": item.user_id}
+        try:
+            if not await check_rate_limit("batch", item.user_id):
+                RATE_LIMIT_REJECTIONS.inc("batch")
+                result.update(status=429, error="Rate limit exceeded", retry_after=rate_limit_retry_after())
+            else:
+                async with semaphore:
+                    ai_response = await fitness_trainer.get_response(
+                        item.message, item.user_id, profiles.get(item.user_id),
+                        use_cache=use_cache, priority=PRIORITY_BATCH
+                    )
+                chat_message = ChatMessage(user_id=item.user_id, message=item.message, response=ai_response)
+                completed.append(chat_message)
+                result.update(status=200, message=chat_message_payload(chat_message))
+        except LlmUnavailable as e:
+            result.update(status=503, error=e.detail, retry_after=e.retry_after)
+        except Exception as e:
+            logger.error(f"Error in chat batch item {index}: {str(e)}")
+            result.update(status=500, error="Internal server error")
+        await results.put(result)
+
+    try:
+        await asyncio.gather(*(answer(index, item) for index, item in enumerate(batch.items)))
+    finally:
+        try:
+            if completed:
+                await save_chat_messages(completed)
+        finally:
+            await results.put(None)
+
+@api_router.post("/chat/batch", dependencies=[Depends(require_admin)])
+async def send_message_batch(request: Request, batch: ChatBatchCreate):
+    """Answer up to CHAT_BATCH_MAX_ITEMS (user_id, message) items in one request.
+
+    Streams NDJSON: one line per item in completion order, carrying its
+    `index`, HTTP-style `status` and either the saved `message` or an
+    `error`, then a final summary line. Items run at batch priority, so
+    interactive chat is admitted first. Items skip the response cache and
+    are never coalesced with each other unless the batch sets `use_cache`.
+    """
+    results: asyncio.Queue = asyncio.Queue()
+    task = asyncio.create_task(run_chat_batch(batch, batch.use_cache and not cache_bypassed(request), results))
+    chat_batch_tasks.add(task)
+    task.add_done_callback(chat_batch_tasks.discard)
+
+    async def result_lines():
+        succeeded = failed = 0
+        while True:
+            result = await results.get()
+            if result is None:
+                break
+            if result["status"] == 200:
+                succeeded += 1
+            else:
+                failed += 1
+            yield json_dumps(result) + b"\n"
+        yield json_dumps({"done": True, "succeeded": succeeded, "failed": failed}) + b"\n"
+
+    return StreamingResponse(result_lines(), media_type="application/x-ndjson")
+
 @api_router.websocket("/ws/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, user_id: str):
     if not user_id or len(user_id) > 100:
         await websocket.close(code=1008, reason="Invalid user_id")
         return
         
-    await manager.connect(websocket, user_id)
+    connection = await manager.connect(websocket, user_id)
     try:
+        # Load the profile once per connection and refresh it only after an invalidation
+        profile_generation = profile_cache.generation(user_id)
+        user_profile = await profile_cache.get(user_id)
+
         while True:
-            # Check rate limit for WebSocket
-            if not check_rate_limit("websocket", user_id):
-                await websocket.send_text(json.dumps({
+            data = await connection.receive()
+            if data is None:
+                break
+
+            # Check rate limit for WebSocket once a message has actually arrived
+            if not await check_rate_limit("websocket", user_id):
+                RATE_LIMIT_REJECTIONS.inc("websocket")
+                await connection.send_json({
                     "type": "error",
-                    "message": "Rate limit exceeded. Please wait before sending more messages."
-                }))
+                    "message": "Rate limit exceeded. Please wait before sending more messages.",
+                    "retry_after": rate_limit_retry_after()
+                })
                 continue
                 
-            data = await websocket.receive_text()
             try:
                 message_data = json.loads(data)
                 user_message = message_data.get("message", "").strip()
                 
                 if not user_message or len(user_message) > MAX_MESSAGE_LENGTH:
-                    await websocket.send_text(json.dumps({
+                    await connection.send_json({
                         "type": "error", 
                         "message": "Invalid message"
-                    }))
+                    })
                     continue
                 
-                # Get user profile
-                user_profile_doc = await db.user_profiles.find_one({"user_id": user_id})
-                user_profile = user_profile_doc if user_profile_doc else {}
+                # Refresh the profile if it changed since it was loaded
+                if profile_cache.generation(user_id) != profile_generation:
+                    profile_generation = profile_cache.generation(user_id)
+                    user_profile = await profile_cache.get(user_id)
                 
-                # Generate AI response
-                ai_response = await fitness_trainer.get_response(user_message, user_id, user_profile)
+                # Generate AI response, optionally streaming deltas as they arrive
+                use_cache = not message_data.get("no_cache")
+                if message_data.get("stream"):
+                    chunks = []
+                    async for chunk in fitness_trainer.stream_response(
+                        user_message, user_id, user_profile, use_cache=use_cache, priority=PRIORITY_INTERACTIVE
+                    ):
+                        chunks.append(chunk)
+                        await connection.send_json({"type": "ai_response_delta", "delta": chunk})
+                    ai_response = "".join(chunks)
+                else:
+                    ai_response = await fitness_trainer.get_response(
+                        user_message, user_id, user_profile, use_cache=use_cache, priority=PRIORITY_INTERACTIVE
+                    )
                 
                 # Create and save chat message
                 chat_message = ChatMessage(
@@ -501,38 +4357,38 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                     response=ai_response
                 )
                 
-                try:
-                    await db.chat_messages.insert_one(chat_message.dict())
-                except:
-                    pass  # Continue even if database save fails
+                await save_chat_message(chat_message)
                 
                 # Send response
-                await manager.send_personal_message(
-                    json.dumps({
-                        "type": "ai_response",
-                        "message": ai_response,
-                        "timestamp": chat_message.timestamp.isoformat()
-                    }),
-                    user_id
-                )
+                await connection.send_json({
+                    "type": "ai_response",
+                    "message": ai_response,
+                    "timestamp": chat_message.timestamp.isoformat()
+                })
                 
             except json.JSONDecodeError:
-                await websocket.send_text(json.dumps({
+                await connection.send_json({
                     "type": "error",
                     "message": "Invalid JSON format"
-                }))
+                })
+            except LlmUnavailable as e:
+                await connection.send_json({
+                    "type": "error",
+                    "message": e.detail,
+                    "retry_after": e.retry_after
+                })
             except Exception as e:
                 logger.error(f"WebSocket error: {str(e)}")
-                await websocket.send_text(json.dumps({
+                await connection.send_json({
                     "type": "error",
                     "message": "Internal error occurred"
-                }))
+                })
                 
-    except WebSocketDisconnect:
-        manager.disconnect(user_id)
     except Exception as e:
         logger.error(f"WebSocket connection error: {str(e)}")
-        manager.disconnect(user_id)
+    finally:
+        manager.disconnect(user_id, connection)
+        await connection.close()
 
 # Include router
 app.include_router(api_router)
@@ -548,6 +4404,7 @@ app.add_middleware(
     allow_origins=allowed_origins,
     allow_methods=["GET", "POST", "PUT", "DELETE"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 # Production logging
@@ -557,25 +4414,73 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Cleanup task
-async def periodic_cleanup():
-    """Periodic cleanup of old connections and sessions"""
-    while True:
-        try:
-            await asyncio.sleep(3600)  # Run every hour
-            manager.cleanup_old_connections()
-            if hasattr(fitness_trainer, '_cleanup_sessions'):
-                fitness_trainer._cleanup_sessions()
-        except Exception as e:
-            logger.error(f"Cleanup error: {str(e)}")
+# Periodic maintenance
+def schedule_maintenance():
+    """Evict idle limiter state and chat sessions in small steps instead of hourly sweeps"""
+    expiry_scheduler.every("rate_limiter", MAINTENANCE_INTERVAL_SECONDS, rate_limiter.evict_idle)
+    expiry_scheduler.every("chat_pool", MAINTENANCE_INTERVAL_SECONDS, fitness_trainer._cleanup_sessions)
 
-# Start cleanup task
+async def _ensure_index(collection, keys, name: str, **options):
+    """Create one index, logging a failure by name so the remaining indexes are still created"""
+    try:
+        await collection.create_index(keys, name=name, **options)
+    except Exception as e:
+        logger.error(f"Index creation error ({collection.name}.{name}): {str(e)}")
+
+async def ensure_indexes():
+    """Create the indexes the hot queries rely on"""
+    # Serves newest-first history per user, including the (timestamp, id) keyset tiebreak
+    await _ensure_index(db.chat_messages, [("user_id", 1), ("timestamp", -1), ("id", -1)], "user_history")
+    # Lets repeated imports and retried batches skip messages already stored
+    await _ensure_index(db.chat_messages, "id", "message_id", unique=True)
+    # Lets the archiver find messages past the cutoff across all users
+    await _ensure_index(db.chat_messages, [("timestamp", 1), ("id", 1)], "archive_scan")
+    # One profile per user, which lets the profile routes upsert without a prior lookup
+    await _ensure_index(db.user_profiles, "user_id", "profile_user_id", unique=True)
+    # Lets every worker's profile cache poll for recent edits without scanning the collection
+    await _ensure_index(db.user_profiles, "updated_at", "profile_updated_at")
+
+# Startup and shutdown
 @app.on_event("startup")
 async def startup_event():
-    asyncio.create_task(periodic_cleanup())
+    await ensure_indexes()
+    await rate_limiter.setup()
+    await response_cache.setup()
+    asyncio.create_task(profile_cache.watch())
+    chat_writer.start()
+    await manager.start()
+    await plan_jobs.setup()
+    plan_jobs.start()
+    await chat_archiver.setup()
+    chat_archiver.start()
+    await user_stats.setup()
+    expiry_scheduler.start()
+    schedule_maintenance()
     logger.info("AI Fitness Trainer started successfully")
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await expiry_scheduler.close()
+    await chat_archiver.close()
+    await plan_jobs.close()
+    await chat_writer.close()
+    await user_stats.close()
+    await manager.close()
     client.close()
-    logger.info("AI Fitness Trainer shutdown completed")
\ No newline at end of file
+    logger.info("AI Fitness Trainer shutdown completed")
+
+async def _backfill_stats(user_id: Optional[str]):
+    await user_stats.setup()
+    await user_stats.backfill(user_id)
+    client.close()
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="AI Fitness Trainer maintenance commands")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    backfill_parser = subcommands.add_parser("backfill-stats", help="rebuild user_stats from chat history")
+    backfill_parser.add_argument("--user-id", help="rebuild a single user only")
+    args = parser.parse_args()
+    if args.command == "backfill-stats":
+        asyncio.run(_backfill_stats(args.user_id))
@@ -0,0 +1,517 @@
+"""Offline load and latency benchmark for the AI Fitness Trainer backend.
+
+Boots ``backend/server.py`` in-process with a stand-in LlmChat (configurable
+latency and token rate) and an in-memory Mongo (mongomock-motor), then drives
+concurrent HTTP and WebSocket load and reports p50/p95/p99 latency, requests
+per second and memory per WebSocket connection. The ``serialization``
+scenario is a CPU-only micro-benchmark of response and frame encoding.
+
+    python backend_benchmark.py
+    python backend_benchmark.py --scenarios chat,ws --concurrency 100
+    python backend_benchmark.py --save-baseline bench_baseline.json
+    python backend_benchmark.py --compare bench_baseline.json --tolerance 0.2
+
+With --compare the exit code is 1 when any scenario's p95 latency or
+throughput regressed by more than the tolerance.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+import uuid
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).parent
+BACKEND_DIR = ROOT_DIR / "backend"
+
+ALL_SCENARIOS = ["chat", "chat_stream", "history", "profile_create", "profile_get", "profile_update", "ws", "serialization"]
+FAQ_MESSAGES = [
+    "תוכנית אימון למתחילים",
+    "כמה חלבון לאכול",
+    "איך לשפר סיבולת",
+    "מה לאכול לפני אימון",
+]
+
+
+class FakeLlmConfig:
+    latency = 0.3
+    tokens_per_second = 200.0
+    response_tokens = 150
+    streaming = False
+    calls = 0
+
+
+class FakeUserMessage:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeLlmChat:
+    """Stand-in for emergentintegrations' LlmChat with a simulated generation time"""
+
+    def __init__(self, api_key, session_id, system_message):
+        self.session_id = session_id
+        self.system_message = system_message
+        if FakeLlmConfig.streaming:
+            self.stream_message = self._stream_message
+
+    def with_model(self, provider, model):
+        return self
+
+    def with_max_tokens(self, max_tokens):
+        self.max_tokens = max_tokens
+        return self
+
+    def _tokens(self):
+        return ["מילה"] * min(FakeLlmConfig.response_tokens, getattr(self, "max_tokens", 4000))
+
+    async def send_message(self, message):
+        FakeLlmConfig.calls += 1
+        tokens = self._tokens()
+        await asyncio.sleep(FakeLlmConfig.latency + len(tokens) / FakeLlmConfig.tokens_per_second)
+        return " ".join(tokens)
+
+    async def _stream_message(self, message):
+        FakeLlmConfig.calls += 1
+        tokens = self._tokens()
+        await asyncio.sleep(FakeLlmConfig.latency)
+        chunk_size = 8
+        for start in range(0, len(tokens), chunk_size):
+            chunk = tokens[start:start + chunk_size]
+            await asyncio.sleep(len(chunk) / FakeLlmConfig.tokens_per_second)
+            yield " ".join(chunk) + " "
+
+
+def load_server():
+    """Import the backend with the stand-in LLM and in-memory Mongo wired in"""
+    try:
+        import mongomock_motor
+    except ImportError:
+        sys.exit("mongomock-motor is required: pip install mongomock-motor")
+    import motor.motor_asyncio
+
+    chat_module = types.ModuleType("emergentintegrations.llm.chat")
+    chat_module.LlmChat = FakeLlmChat
+    chat_module.UserMessage = FakeUserMessage
+    sys.modules["emergentintegrations"] = types.ModuleType("emergentintegrations")
+    sys.modules["emergentintegrations.llm"] = types.ModuleType("emergentintegrations.llm")
+    sys.modules["emergentintegrations.llm.chat"] = chat_module
+    motor.motor_asyncio.AsyncIOMotorClient = lambda *args, **kwargs: mongomock_motor.AsyncMongoMockClient()
+
+    os.environ.setdefault("MONGO_URL", "mongodb://benchmark")
+    os.environ.setdefault("DB_NAME", "benchmark")
+    os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+    os.environ["RATE_LIMIT_BACKEND"] = "memory"
+    os.environ["CHAT_SPILL_DIR"] = tempfile.mkdtemp(prefix="benchmark_spill_")
+
+    sys.path.insert(0, str(BACKEND_DIR))
+    import server
+
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    # Quotas are not what is being measured; keep the limiter in the path with unreachable limits
+    server.rate_limiter = server.InMemoryRateLimiter(
+        windows=tuple((name, size, 10 ** 9) for name, size, _ in server.RATE_LIMIT_WINDOWS)
+    )
+    return server
+
+
+class ASGIWebSocket:
+    """Minimal in-process WebSocket client speaking ASGI directly to the app"""
+
+    def __init__(self, app, path):
+        self.app = app
+        self.path = path
+        self._to_app = asyncio.Queue()
+        self._from_app = asyncio.Queue()
+        self._task = None
+
+    async def connect(self):
+        scope = {
+            "type": "websocket",
+            "asgi": {"version": "3.0"},
+            "scheme": "ws",
+            "path": self.path,
+            "raw_path": self.path.encode(),
+            "root_path": "",
+            "query_string": b"",
+            "headers": [(b"host", b"benchmark")],
+            "client": ("127.0.0.1", 0),
+            "server": ("benchmark", 80),
+            "subprotocols": [],
+        }
+        self._task = asyncio.create_task(self.app(scope, self._to_app.get, self._from_app.put))
+        await self._to_app.put({"type": "websocket.connect"})
+        message = await self._from_app.get()
+        if message["type"] != "websocket.accept":
+            raise ConnectionError(f"WebSocket rejected: {message}")
+
+    async def send_json(self, data):
+        await self._to_app.put({"type": "websocket.receive", "text": json.dumps(data)})
+
+    async def receive_json(self):
+        message = await self._from_app.get()
+        if message["type"] == "websocket.close":
+            raise ConnectionError("WebSocket closed by server")
+        return json.loads(message["text"])
+
+    async def close(self):
+        await self._to_app.put({"type": "websocket.disconnect", "code": 1000})
+        try:
+            await asyncio.wait_for(self._task, timeout=5)
+        except Exception:
+            self._task.cancel()
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, errors, elapsed, extra=None):
+    ordered = sorted(latencies)
+    result = {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(ordered, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(ordered, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(ordered, 0.99) * 1000, 2),
+        "max_ms": round(ordered[-1] * 1000, 2) if ordered else 0.0,
+    }
+    result.update(extra or {})
+    return result
+
+
+async def run_load(total, concurrency, call):
+    """Run `call(i)` for i in range(total) with `concurrency` workers; call returns success"""
+    latencies = []
+    errors = 0
+    counter = itertools.count()
+
+    async def worker():
+        nonlocal errors
+        while True:
+            index = next(counter)
+            if index >= total:
+                return
+            started = time.perf_counter()
+            try:
+                ok = await call(index)
+            except Exception:
+                ok = False
+            latencies.append(time.perf_counter() - started)
+            if not ok:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return latencies, errors, time.perf_counter() - started
+
+
+class BackendBenchmark:
+    def __init__(self, server, args):
+        self.server = server
+        self.args = args
+        self.run_id = uuid.uuid4().hex[:8]
+        self.scenario = ""
+        self.http = None
+
+    def user_id(self, index):
+        return f"bench_{self.run_id}_{index % self.args.users}"
+
+    def message(self, index):
+        if self.args.faq_ratio and (index % 100) < self.args.faq_ratio * 100:
+            return FAQ_MESSAGES[index % len(FAQ_MESSAGES)]
+        # Unique per scenario so one scenario does not warm the response cache for the next
+        return f"שאלה מספר {index} ({self.scenario}) על אימון כוח ותזונה"
+
+    async def bench_chat(self):
+        async def call(i):
+            response = await self.http.post("/api/chat", json={"user_id": self.user_id(i), "message": self.message(i)})
+            return response.status_code == 200
+
+        return summarize(*await run_load(self.args.requests, self.args.concurrency, call))
+
+    async def bench_chat_stream(self):
+        first_delta = []
+
+        async def call(i):
+            started = time.perf_counter()
+            payload = {"user_id": self.user_id(i), "message": self.message(i)}
+            async with self.http.stream("POST", "/api/chat/stream", json=payload) as response:
+                seen_first = False
+                async for line in response.aiter_lines():
+                    if not seen_first and line.startswith("event: delta"):
+                        first_delta.append(time.perf_counter() - started)
+                        seen_first = True
+                return response.status_code == 200 and seen_first
+
+        latencies, errors, elapsed = await run_load(self.args.requests, self.args.concurrency, call)
+        ordered = sorted(first_delta)
+        return summarize(latencies, errors, elapsed, {
+            "ttfb_p50_ms": round(percentile(ordered, 0.50) * 1000, 2),
+            "ttfb_p95_ms": round(percentile(ordered, 0.95) * 1000, 2),
+        })
+
+    async def bench_history(self):
+        # Seed history directly so the scenario measures reads only
+        documents = []
+        for user_index in range(self.args.users):
+            for n in range(self.args.history_size):
+                documents.append(self.server.ChatMessage(
+                    user_id=self.user_id(user_index),
+                    message=f"הודעה {n}",
+                    response="תשובה " * 200
+                ).dict())
+        for start in range(0, len(documents), 1000):
+            await self.server.db.chat_messages.insert_many(documents[start:start + 1000])
+
+        async def call(i):
+            response = await self.http.get(f"/api/chat/{self.user_id(i)}", params={"limit": 50})
+            return response.status_code == 200
+
+        return summarize(*await run_load(self.args.requests, self.args.concurrency, call))
+
+    async def bench_profile_create(self):
+        async def call(i):
+            response = await self.http.post("/api/profile", json={
+                "user_id": f"bench_profile_{self.run_id}_{i}",
+                "name": "מתאמן",
+                "fitness_level": "intermediate",
+                "goals": ["כוח", "סיבולת"]
+            })
+            return response.status_code == 200
+
+        return summarize(*await run_load(self.args.requests, self.args.concurrency, call))
+
+    async def bench_profile_get(self):
+        async def call(i):
+            response = await self.http.get(f"/api/profile/{self.user_id(i)}")
+            return response.status_code == 200
+
+        return summarize(*await run_load(self.args.requests, self.args.concurrency, call))
+
+    async def bench_profile_update(self):
+        # Profiles created by profile_get, or on the fly when this scenario runs alone
+        async def call(i):
+            user_id = self.user_id(i)
+            response = await self.http.put(f"/api/profile/{user_id}", json={"age": 20 + i % 50})
+            if response.status_code == 404:
+                await self.http.get(f"/api/profile/{user_id}")
+                response = await self.http.put(f"/api/profile/{user_id}", json={"age": 20 + i % 50})
+            return response.status_code == 200
+
+        return summarize(*await run_load(self.args.requests, self.args.concurrency, call))
+
+    async def bench_serialization(self):
+        """Time the previous and the fast encoding of a long reply as a chat response, a history page and a WebSocket frame.
+
+        REST bodies must come out byte-identical; WebSocket frames must decode to the same JSON.
+        Latencies are for the fast path; each payload's speedup is reported alongside.
+        """
+        from fastapi.encoders import jsonable_encoder
+        from fastapi.responses import JSONResponse
+
+        server = self.server
+        # Roughly a 4000-token Hebrew reply
+        reply = "תוכנית אימון מותאמת אישית: שלושה אימוני כוח בשבוע, הליכה יומית ותזונה עשירה בחלבון 💪\n" * 150
+        chat_message = server.ChatMessage(user_id=self.user_id(0), message=self.message(0), response=reply)
+        history = [server.chat_message_payload(chat_message) for _ in range(50)]
+        frame = {"type": "ai_response", "message": reply, "timestamp": chat_message.timestamp.isoformat()}
+        cases = {
+            # response_model=ChatMessage re-validated the returned model, then ran jsonable_encoder
+            "chat": (lambda: JSONResponse(jsonable_encoder(server.ChatMessage(**chat_message.dict()))).body,
+                     lambda: server.FastJSONResponse(server.chat_message_payload(chat_message)).body),
+            "history": (lambda: JSONResponse(history).body, lambda: server.FastJSONResponse(history).body),
+            "ws_frame": (lambda: json.dumps(frame), lambda: server.json_text(frame)),
+        }
+
+        latencies = []
+        errors = 0
+        extra = {"encoder": "orjson" if server.orjson is not None else "json"}
+        started = time.perf_counter()
+        for name, (previous, fast) in cases.items():
+            before, after = previous(), fast()
+            same = before == after if name != "ws_frame" else json.loads(before) == json.loads(after)
+            if not same:
+                errors += 1
+            timings = {}
+            for label, encode in (("previous", previous), ("fast", fast)):
+                samples = []
+                for _ in range(self.args.requests):
+                    op_started = time.perf_counter()
+                    encode()
+                    samples.append(time.perf_counter() - op_started)
+                timings[label] = sorted(samples)[len(samples) // 2]
+                if label == "fast":
+                    latencies.extend(samples)
+            extra[f"{name}_us"] = f"{timings['previous'] * 1e6:.0f}->{timings['fast'] * 1e6:.0f}"
+            extra[f"{name}_speedup"] = round(timings["previous"] / timings["fast"], 1)
+        extra["ws_frame_bytes"] = f"{len(json.dumps(frame).encode())}->{len(server.json_text(frame).encode())}"
+        return summarize(latencies, errors, time.perf_counter() - started, extra)
+
+    async def bench_ws(self):
+        connections = self.args.ws_connections
+        sockets = []
+
+        tracemalloc.start()
+        memory_before = tracemalloc.get_traced_memory()[0]
+        for index in range(connections):
+            socket = ASGIWebSocket(self.server.app, f"/api/ws/bench_ws_{self.run_id}_{index}")
+            await socket.connect()
+            sockets.append(socket)
+        await asyncio.sleep(0.1)
+        memory_per_connection = (tracemalloc.get_traced_memory()[0] - memory_before) / max(connections, 1)
+        tracemalloc.stop()
+
+        latencies = []
+        errors = 0
+
+        async def drive(index, socket):
+            nonlocal errors
+            for n in range(self.args.ws_messages):
+                started = time.perf_counter()
+                await socket.send_json({"message": self.message(index * self.args.ws_messages + n)})
+                while True:
+                    frame = await socket.receive_json()
+                    if frame["type"] == "ping":
+                        await socket.send_json({"type": "pong"})
+                    if frame["type"] in ("ai_response", "error"):
+                        break
+                latencies.append(time.perf_counter() - started)
+                if frame["type"] == "error":
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*[drive(index, socket) for index, socket in enumerate(sockets)])
+        elapsed = time.perf_counter() - started
+        await asyncio.gather(*[socket.close() for socket in sockets])
+
+        return summarize(latencies, errors, elapsed, {
+            "connections": connections,
+            "memory_per_connection_kb": round(memory_per_connection / 1024, 2)
+        })
+
+    async def run(self, scenarios):
+        import httpx
+
+        results = {}
+        app = self.server.app
+        async with app.router.lifespan_context(app):
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=120) as http:
+                self.http = http
+                for scenario in scenarios:
+                    print(f"\n🔍 Running {scenario}...")
+                    self.scenario = scenario
+                    calls_before = FakeLlmConfig.calls
+                    result = await getattr(self, f"bench_{scenario}")()
+                    result["llm_calls"] = FakeLlmConfig.calls - calls_before
+                    results[scenario] = result
+                    print_result(scenario, result)
+        return results
+
+
+def print_result(name, result):
+    print(
+        f"   {name:<15} {result['requests']:>6} req  {result['rps']:>9.1f} req/s  "
+        f"p50 {result['p50_ms']:>8.2f}ms  p95 {result['p95_ms']:>8.2f}ms  p99 {result['p99_ms']:>8.2f}ms  "
+        f"errors {result['errors']}"
+    )
+    extras = {k: v for k, v in result.items() if k not in ("requests", "rps", "p50_ms", "p95_ms", "p99_ms", "max_ms", "errors")}
+    if extras:
+        print("   " + " " * 15 + "  ".join(f"{k}={v}" for k, v in extras.items()))
+
+
+def compare(results, baseline, tolerance):
+    """Print a comparison against a saved baseline and return the names of regressed scenarios"""
+    regressions = []
+    print("\n" + "=" * 70)
+    print(f"BASELINE COMPARISON (tolerance {tolerance:.0%})")
+    print("=" * 70)
+    for name, result in results.items():
+        base = baseline.get("scenarios", {}).get(name)
+        if not base:
+            print(f"   {name:<15} no baseline")
+            continue
+        p95_change = (result["p95_ms"] - base["p95_ms"]) / base["p95_ms"] if base["p95_ms"] else 0.0
+        rps_change = (result["rps"] - base["rps"]) / base["rps"] if base["rps"] else 0.0
+        regressed = p95_change > tolerance or rps_change < -tolerance
+        marker = "❌" if regressed else "✅"
+        print(f"{marker} {name:<15} p95 {base['p95_ms']:.2f} -> {result['p95_ms']:.2f}ms ({p95_change:+.1%})  "
+              f"rps {base['rps']:.1f} -> {result['rps']:.1f} ({rps_change:+.1%})")
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=",".join(ALL_SCENARIOS),
+                        help=f"comma separated subset of: {', '.join(ALL_SCENARIOS)}")
+    parser.add_argument("--requests", type=int, default=500, help="requests per HTTP scenario")
+    parser.add_argument("--concurrency", type=int, default=50, help="concurrent HTTP clients")
+    parser.add_argument("--users", type=int, default=100, help="distinct user ids to spread load over")
+    parser.add_argument("--history-size", type=int, default=100, help="seeded messages per user for the history scenario")
+    parser.add_argument("--faq-ratio", type=float, default=0.0, help="fraction of chat messages drawn from a repeated FAQ pool")
+    parser.add_argument("--ws-connections", type=int, default=200, help="concurrent WebSocket connections")
+    parser.add_argument("--ws-messages", type=int, default=3, help="messages sent per WebSocket connection")
+    parser.add_argument("--llm-latency-ms", type=float, default=300, help="simulated time to first token")
+    parser.add_argument("--llm-tokens-per-second", type=float, default=200, help="simulated generation rate")
+    parser.add_argument("--llm-response-tokens", type=int, default=150, help="simulated response length")
+    parser.add_argument("--llm-streaming", action="store_true", help="give the stand-in LLM a stream_message method")
+    parser.add_argument("--save-baseline", metavar="PATH", help="write results to PATH as the new baseline")
+    parser.add_argument("--compare", metavar="PATH", help="compare results against the baseline at PATH")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression for --compare")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(ALL_SCENARIOS)
+    if unknown:
+        print(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+        return 2
+
+    FakeLlmConfig.latency = args.llm_latency_ms / 1000
+    FakeLlmConfig.tokens_per_second = args.llm_tokens_per_second
+    FakeLlmConfig.response_tokens = args.llm_response_tokens
+    FakeLlmConfig.streaming = args.llm_streaming
+
+    print("=" * 70)
+    print("AI FITNESS TRAINER BACKEND BENCHMARK (offline)")
+    print("=" * 70)
+
+    server = load_server()
+    results = asyncio.run(BackendBenchmark(server, args).run(scenarios))
+
+    config = {k: v for k, v in vars(args).items() if k not in ("save_baseline", "compare", "tolerance")}
+    if args.save_baseline:
+        Path(args.save_baseline).write_text(json.dumps({"config": config, "scenarios": results}, indent=2))
+        print(f"\n📝 Baseline saved to {args.save_baseline}")
+
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+        if baseline.get("config") != config:
+            print("\n⚠️  Benchmark configuration differs from the baseline's; comparison may be misleading")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\nRegressed: {', '.join(regressions)}")
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,136 @@
+import asyncio
+
+import pytest
+
+from server import (
+    PRIORITY_BATCH, PRIORITY_INTERACTIVE, PRIORITY_STANDARD, AdmissionScheduler, LlmOverloaded
+)
+
+
+async def settle():
+    # Let handed-over slots and shed exceptions reach their waiters
+    await asyncio.sleep(0.01)
+
+
+async def queue_waiter(scheduler, user_id, priority, admitted):
+    async def wait():
+        await scheduler._acquire(user_id, priority)
+        admitted.append(user_id)
+
+    task = asyncio.ensure_future(wait())
+    await settle()
+    return task
+
+
+def test_admits_up_to_capacity_and_hands_slots_to_waiters():
+    async def scenario():
+        scheduler = AdmissionScheduler(2, 10, 5.0)
+        await scheduler._acquire("a", PRIORITY_STANDARD)
+        await scheduler._acquire("b", PRIORITY_STANDARD)
+        admitted = []
+        waiter = await queue_waiter(scheduler, "c", PRIORITY_STANDARD, admitted)
+        assert admitted == [] and scheduler.queued == 1
+        scheduler._release()
+        await waiter
+        assert admitted == ["c"]
+        assert scheduler.in_flight == 2 and scheduler.queued == 0
+        scheduler._release()
+        scheduler._release()
+        assert scheduler.in_flight == 0
+
+    asyncio.run(scenario())
+
+
+def test_higher_priority_is_served_first_and_users_round_robin():
+    async def scenario():
+        scheduler = AdmissionScheduler(1, 10, 5.0)
+        await scheduler._acquire("holder", PRIORITY_STANDARD)
+        admitted = []
+        tasks = [
+            await queue_waiter(scheduler, "batch", PRIORITY_BATCH, admitted),
+            await queue_waiter(scheduler, "busy", PRIORITY_STANDARD, admitted),
+            await queue_waiter(scheduler, "busy", PRIORITY_STANDARD, admitted),
+            await queue_waiter(scheduler, "other", PRIORITY_STANDARD, admitted),
+            await queue_waiter(scheduler, "ws", PRIORITY_INTERACTIVE, admitted),
+        ]
+        for _ in tasks:
+            scheduler._release()
+            await settle()
+        await asyncio.gather(*tasks)
+        return admitted
+
+    assert asyncio.run(scenario()) == ["ws", "busy", "other", "busy", "batch"]
+
+
+def test_sheds_when_the_estimated_wait_is_too_long():
+    async def scenario():
+        scheduler = AdmissionScheduler(1, 10, 1.0)
+        scheduler.avg_service_time = 0.6
+        await scheduler._acquire("holder", PRIORITY_STANDARD)
+        waiter = await queue_waiter(scheduler, "a", PRIORITY_STANDARD, [])
+        # One standard waiter ahead: (1 + 1) * 0.6s exceeds the 1s budget
+        with pytest.raises(LlmOverloaded):
+            await scheduler._acquire("b", PRIORITY_STANDARD)
+        waiter.cancel()
+        return scheduler.shed
+
+    assert asyncio.run(scenario()) == 1
+
+
+def test_interactive_requests_only_wait_behind_their_own_priority():
+    async def scenario():
+        scheduler = AdmissionScheduler(2, 10, 1.0)
+        await scheduler._acquire("a", PRIORITY_BATCH)
+        await scheduler._acquire("b", PRIORITY_BATCH)
+        batch = [await queue_waiter(scheduler, f"batch{i}", PRIORITY_BATCH, []) for i in range(2)]
+        scheduler.avg_service_time = 1.5
+        admitted = []
+        interactive = await queue_waiter(scheduler, "ws", PRIORITY_INTERACTIVE, admitted)
+        assert not interactive.done()
+        assert scheduler.retry_after(PRIORITY_INTERACTIVE) < scheduler.retry_after(PRIORITY_BATCH)
+        scheduler._release()
+        await interactive
+        for task in batch:
+            task.cancel()
+        return admitted
+
+    assert asyncio.run(scenario()) == ["ws"]
+
+
+def test_full_queue_evicts_the_newest_lower_priority_waiter():
+    async def scenario():
+        scheduler = AdmissionScheduler(1, 2, 10.0)
+        await scheduler._acquire("holder", PRIORITY_STANDARD)
+        older = await queue_waiter(scheduler, "older", PRIORITY_BATCH, [])
+        newer = await queue_waiter(scheduler, "newer", PRIORITY_BATCH, [])
+        interactive = await queue_waiter(scheduler, "ws", PRIORITY_INTERACTIVE, [])
+        assert isinstance(newer.exception(), LlmOverloaded)
+        assert not older.done() and not interactive.done()
+        assert scheduler.queued == 2
+        # Nothing below batch priority to evict
+        with pytest.raises(LlmOverloaded):
+            await scheduler._acquire("late", PRIORITY_BATCH)
+        older.cancel()
+        interactive.cancel()
+        await settle()
+        return scheduler.queued
+
+    assert asyncio.run(scenario()) == 0
+
+
+def test_waiter_is_shed_at_its_deadline_and_cancelled_waiters_are_skipped():
+    async def scenario():
+        scheduler = AdmissionScheduler(1, 10, 0.05)
+        scheduler.avg_service_time = 0.01
+        await scheduler._acquire("holder", PRIORITY_STANDARD)
+        with pytest.raises(LlmOverloaded):
+            await scheduler._acquire("slow", PRIORITY_STANDARD)
+        cancelled = await queue_waiter(scheduler, "gone", PRIORITY_STANDARD, [])
+        cancelled.cancel()
+        await settle()
+        assert scheduler.queued == 0
+        # The abandoned entry is skipped and the slot is freed
+        scheduler._release()
+        return scheduler.in_flight
+
+    assert asyncio.run(scenario()) == 0
@@ -0,0 +1,132 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from mongomock_motor import AsyncMongoMockClient
+
+from server import ChatArchiver
+
+NOW = datetime.utcnow().replace(microsecond=0)
+
+
+def make_archiver(db, archive_after_days=30, retention_days=0, batch_size=7, bucket_size=10):
+    return ChatArchiver(
+        db.chat_messages, db.chat_archive, db.maintenance_locks,
+        archive_after_days=archive_after_days, retention_days=retention_days,
+        batch_size=batch_size, bucket_size=bucket_size
+    )
+
+
+def message(user_id, index, days_ago):
+    return {
+        "id": f"{user_id}-{index:03d}",
+        "user_id": user_id,
+        "message": f"שאלה {index}",
+        "response": f"תשובה {index}",
+        "timestamp": NOW - timedelta(days=days_ago, minutes=index),
+        "message_type": "user"
+    }
+
+
+async def seed(db):
+    # 25 old messages a day apart, 5 recent ones, and another user's old messages
+    docs = [message("u1", i, 60 - i) for i in range(25)]
+    docs += [message("u1", 100 + i, 1) for i in range(5)]
+    docs += [message("u2", i, 45) for i in range(3)]
+    await db.chat_messages.insert_many(docs)
+    return docs
+
+
+def newest_first(docs):
+    return sorted(docs, key=lambda doc: (doc["timestamp"], doc["id"]), reverse=True)
+
+
+def test_run_moves_old_messages_into_bounded_buckets():
+    async def scenario():
+        db = AsyncMongoMockClient()["test"]
+        await seed(db)
+        archiver = make_archiver(db)
+        result = await archiver.run()
+        hot = await db.chat_messages.count_documents({})
+        buckets = await db.chat_archive.find({}, {"count": 1, "user_id": 1}).to_list(None)
+        return result, hot, buckets, await archiver.run()
+
+    result, hot, buckets, rerun = asyncio.run(scenario())
+    assert result["archived"] == 28 and result["expired"] == 0
+    assert hot == 5
+    assert all(bucket["count"] <= 10 for bucket in buckets)
+    assert sum(bucket["count"] for bucket in buckets) == 28
+    assert rerun == {"archived": 0, "expired": 0, "buckets": 0}
+
+
+def test_history_pages_newest_first_across_buckets():
+    async def scenario():
+        db = AsyncMongoMockClient()["test"]
+        docs = await seed(db)
+        archiver = make_archiver(db)
+        await archiver.run()
+        pages, before = [], None
+        while True:
+            page = await archiver.history("u1", 6, before)
+            if not page:
+                break
+            pages.append(page)
+            last = page[-1]
+            before = (datetime.fromisoformat(last["timestamp"]), last["id"])
+        return docs, pages
+
+    docs, pages = asyncio.run(scenario())
+    expected = [doc["id"] for doc in newest_first(doc for doc in docs if doc["user_id"] == "u1" and doc["id"] < "u1-100")]
+    assert [len(page) for page in pages] == [6, 6, 6, 6, 1]
+    assert [item["id"] for page in pages for item in page] == expected
+
+
+def test_history_skips_messages_archived_twice():
+    async def scenario():
+        db = AsyncMongoMockClient()["test"]
+        docs = await seed(db)
+        archiver = make_archiver(db)
+        await archiver.run()
+        original = set(await db.chat_archive.distinct("_id"))
+        # A partial re-import archives the first messages of a bucket a second time
+        await db.chat_messages.insert_many([{k: v for k, v in doc.items() if k != "_id"} for doc in docs[:3]])
+        await archiver.run()
+        return await archiver.history("u1", 100), original, set(await db.chat_archive.distinct("_id"))
+
+    history, original, after = asyncio.run(scenario())
+    ids = [item["id"] for item in history]
+    # The original bucket survives alongside the new one and history shows each message once
+    assert len(ids) == len(set(ids)) == 25
+    assert original < after
+
+
+def test_messages_past_retention_are_dropped_and_buckets_expire():
+    async def scenario():
+        db = AsyncMongoMockClient()["test"]
+        await seed(db)
+        archiver = make_archiver(db, retention_days=50)
+        result = await archiver.run()
+        buckets = await db.chat_archive.find({}, {"end": 1, "expires_at": 1}).to_list(None)
+        return result, buckets
+
+    result, buckets = asyncio.run(scenario())
+    # Messages 0..10 are 50 days old or more
+    assert result["expired"] == 11 and result["archived"] == 17
+    assert all(bucket["expires_at"] == bucket["end"] + timedelta(days=50) for bucket in buckets)
+
+
+def test_only_one_worker_archives_at_a_time():
+    async def scenario():
+        db = AsyncMongoMockClient()["test"]
+        await seed(db)
+        await db.maintenance_locks.insert_one(
+            {"_id": "chat_archive", "worker_id": "other", "expires_at": NOW + timedelta(minutes=10)}
+        )
+        return await make_archiver(db).run(), await db.chat_messages.count_documents({})
+
+    result, hot = asyncio.run(scenario())
+    assert result["archived"] == 0 and hot == 33
+
+
+def test_pack_round_trips_hebrew_text():
+    messages = [{"id": "a", "message": "שלום", "response": "היי 💪"}]
+    assert ChatArchiver.unpack(ChatArchiver.pack(messages)) == messages
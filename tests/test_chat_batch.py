@@ -0,0 +1,108 @@
+import asyncio
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+from mongomock_motor import AsyncMongoMockClient
+
+import server
+from server import PRIORITY_BATCH, InMemoryRateLimiter, LlmOverloaded, ProfileCache, UserStats
+
+AUTH = {"Authorization": "Bearer secret"}
+
+
+class FakeTrainer:
+    """Stand-in trainer: "busy" is shed by admission control and "boom" breaks, anything else is answered"""
+
+    def __init__(self):
+        self.calls = []
+
+    async def get_response(self, message, user_id, profile, use_cache=True, priority=None):
+        self.calls.append({"user_id": user_id, "profile": profile, "use_cache": use_cache, "priority": priority})
+        await asyncio.sleep(0)
+        if message == "busy":
+            raise LlmOverloaded(3)
+        if message == "boom":
+            raise RuntimeError("unexpected")
+        return f"reply to {user_id}"
+
+
+@pytest.fixture
+def trainer(monkeypatch):
+    db = AsyncMongoMockClient()["test"]
+    asyncio.run(db.user_profiles.insert_one({"user_id": "u1", "name": "Alice", "goals": ["כוח"]}))
+    trainer = FakeTrainer()
+    monkeypatch.setattr(server, "ADMIN_API_TOKEN", "secret")
+    monkeypatch.setattr(server, "db", db)
+    monkeypatch.setattr(server, "fitness_trainer", trainer)
+    monkeypatch.setattr(server, "profile_cache", ProfileCache(db.user_profiles, 10, 60))
+    monkeypatch.setattr(server, "rate_limiter", InMemoryRateLimiter(windows=(("minute", 60, 2),)))
+    monkeypatch.setattr(server, "user_stats", UserStats(db.user_stats, db.chat_messages, db.chat_archive))
+    monkeypatch.setattr(server, "conversation_context", None)
+    trainer.db = db
+    return trainer
+
+
+def post_batch(body, headers=AUTH):
+    response = TestClient(server.app).post("/api/chat/batch", json=body, headers=headers)
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    return response, lines
+
+
+def items(*pairs):
+    return {"items": [{"user_id": user_id, "message": message} for user_id, message in pairs]}
+
+
+def test_mixed_results_stream_one_line_per_item_then_a_summary(trainer):
+    response, lines = post_batch(items(("u1", "שלום"), ("u2", "busy"), ("u3", "boom"), ("u4", "מה נשמע")))
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+
+    *results, summary = lines
+    assert summary == {"done": True, "succeeded": 2, "failed": 2}
+    by_index = {result["index"]: result for result in results}
+    assert sorted(by_index) == [0, 1, 2, 3]
+
+    ok = by_index[0]
+    assert ok["status"] == 200 and ok["user_id"] == "u1"
+    assert ok["message"]["response"] == "reply to u1" and ok["message"]["message"] == "שלום"
+    assert set(ok) == {"index", "user_id", "status", "message"}
+    assert by_index[1] == {
+        "index": 1, "user_id": "u2", "status": 503, "error": LlmOverloaded.detail, "retry_after": 3
+    }
+    assert by_index[2] == {"index": 2, "user_id": "u3", "status": 500, "error": "Internal server error"}
+
+    # Only the successful turns are saved, with one insert
+    stored = asyncio.run(trainer.db.chat_messages.find({}, {"_id": 0, "user_id": 1}).to_list(None))
+    assert sorted(doc["user_id"] for doc in stored) == ["u1", "u4"]
+
+
+def test_items_count_against_each_users_rate_limit(trainer):
+    _, lines = post_batch(items(("u1", "א"), ("u1", "ב"), ("u1", "ג"), ("u2", "ד")))
+    *results, summary = lines
+    limited = [result for result in results if result["status"] == 429]
+    assert len(limited) == 1 and limited[0]["user_id"] == "u1"
+    assert limited[0]["error"] == "Rate limit exceeded" and limited[0]["retry_after"] > 0
+    assert summary == {"done": True, "succeeded": 3, "failed": 1}
+
+
+def test_profiles_are_loaded_once_and_items_run_at_batch_priority_without_cache(trainer):
+    post_batch(items(("u1", "שלום"), ("u2", "שלום")))
+    by_user = {call["user_id"]: call for call in trainer.calls}
+    assert by_user["u1"]["profile"]["name"] == "Alice"
+    assert by_user["u2"]["profile"] == {}
+    assert all(call["priority"] == PRIORITY_BATCH and call["use_cache"] is False for call in trainer.calls)
+
+
+def test_use_cache_is_opt_in_and_no_cache_header_wins(trainer):
+    post_batch({**items(("u1", "שלום")), "use_cache": True})
+    post_batch({**items(("u2", "שלום")), "use_cache": True}, headers={**AUTH, "Cache-Control": "no-cache"})
+    assert [call["use_cache"] for call in trainer.calls] == [True, False]
+
+
+def test_batch_requires_the_admin_token_and_validates_items(trainer):
+    response, _ = post_batch(items(("u1", "שלום")), headers={})
+    assert response.status_code == 401
+    response, _ = post_batch({"items": []})
+    assert response.status_code == 422
+    assert trainer.calls == []
@@ -0,0 +1,98 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+from mongomock_motor import AsyncMongoMockClient
+
+import server
+from server import ChatArchiver
+
+NOW = datetime.utcnow().replace(microsecond=0)
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = AsyncMongoMockClient()["test"]
+    monkeypatch.setattr(server, "db", db)
+    monkeypatch.setattr(server, "chat_archiver", ChatArchiver(
+        db.chat_messages, db.chat_archive, db.maintenance_locks,
+        archive_after_days=30, retention_days=0, batch_size=100, bucket_size=4
+    ))
+    return db
+
+
+def seed(db, hot: int, archived: int, same_timestamp: int = 1):
+    """Store `archived` old messages in archive buckets and `hot` recent ones in chat_messages.
+
+    Every `same_timestamp` consecutive messages share a timestamp, so pages
+    must break ties on id.
+    """
+    docs = []
+    for index in range(archived + hot):
+        days_ago = 60 if index < archived else 1
+        docs.append({
+            "id": f"m{index:03d}",
+            "user_id": "u1",
+            "message": f"שאלה {index}",
+            "response": f"תשובה {index}",
+            "timestamp": NOW - timedelta(days=days_ago) + timedelta(minutes=index // same_timestamp),
+            "message_type": "user"
+        })
+    docs.append({**docs[0], "id": "other", "user_id": "u2"})
+
+    async def store():
+        await db.chat_messages.insert_many(docs)
+        await server.chat_archiver.run()
+        return await db.chat_messages.count_documents({"user_id": "u1"})
+
+    assert asyncio.run(store()) == hot
+    return [doc["id"] for doc in reversed(docs[:-1])]
+
+
+def read_all_pages(limit: int):
+    client = TestClient(server.app)
+    pages, cursor = [], None
+    while True:
+        params = {"limit": limit, **({"before": cursor} if cursor else {})}
+        response = client.get("/api/chat/u1", params=params)
+        assert response.status_code == 200
+        pages.append([msg["id"] for msg in response.json()])
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            return pages
+        assert len(pages) < 50
+
+
+def test_pages_walk_from_hot_messages_into_the_archive(db):
+    expected = seed(db, hot=7, archived=8)
+    pages = read_all_pages(limit=5)
+    assert [len(page) for page in pages] == [5, 5, 5, 0]
+    assert sum(pages, []) == expected
+
+
+def test_page_boundary_on_the_last_hot_message(db):
+    # The first page ends exactly where the hot collection does
+    expected = seed(db, hot=5, archived=10)
+    pages = read_all_pages(limit=5)
+    assert pages[0] == expected[:5]
+    assert sum(pages, []) == expected
+    assert pages[-1] == []
+
+
+def test_ties_on_timestamp_are_broken_by_id_across_pages(db):
+    expected = seed(db, hot=6, archived=6, same_timestamp=3)
+    pages = read_all_pages(limit=4)
+    assert sum(pages, []) == expected
+
+
+def test_short_last_page_has_no_cursor(db):
+    seed(db, hot=3, archived=0)
+    response = TestClient(server.app).get("/api/chat/u1", params={"limit": 5})
+    assert len(response.json()) == 3
+    assert "X-Next-Cursor" not in response.headers
+
+
+def test_invalid_cursor_is_rejected(db):
+    response = TestClient(server.app).get("/api/chat/u1", params={"before": "not-a-cursor"})
+    assert response.status_code == 400
@@ -0,0 +1,101 @@
+import asyncio
+import gzip
+import json
+from datetime import datetime, timedelta
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+import server
+from server import ChatArchiver, UserStats
+
+TODAY = datetime.utcnow().replace(hour=10, minute=0, second=0, microsecond=0)
+
+
+class UploadRequest:
+    """Stand-in Request whose body arrives in small chunks"""
+
+    def __init__(self, body: bytes, chunk_size: int = 50):
+        self.body = body
+        self.chunk_size = chunk_size
+
+    async def stream(self):
+        for start in range(0, len(self.body), self.chunk_size):
+            yield self.body[start:start + self.chunk_size]
+        yield b""
+
+
+def ndjson(records) -> bytes:
+    return b"".join(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n" for record in records)
+
+
+def record(index, days_ago):
+    return {
+        "id": f"imported-{index}",
+        "user_id": "u1",
+        "message": "כמה חלבון לאכול",
+        "response": "תשובה",
+        "timestamp": (TODAY - timedelta(days=days_ago)).isoformat(),
+    }
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = AsyncMongoMockClient()["test"]
+    monkeypatch.setattr(server, "db", db)
+    monkeypatch.setattr(server, "chat_archiver", ChatArchiver(
+        db.chat_messages, db.chat_archive, db.maintenance_locks,
+        archive_after_days=30, retention_days=0, batch_size=100, bucket_size=10
+    ))
+    monkeypatch.setattr(server, "user_stats", UserStats(db.user_stats, db.chat_messages, db.chat_archive))
+    return db
+
+
+def test_import_reports_invalid_lines_and_rebuilds_stats(db):
+    body = ndjson([record(0, 2), record(1, 1), record(2, 0)]) + b"not json\n" + ndjson([{**record(3, 0), "user_id": "u2"}])
+
+    async def scenario():
+        result = await server.import_chat("u1", UploadRequest(gzip.compress(body)))
+        return result, await server.user_stats.get("u1", 7)
+
+    result, stats = asyncio.run(scenario())
+    assert result["imported"] == 3 and result["invalid"] == 2
+    assert [error["line"] for error in result["errors"]] == [4, 5]
+    assert result["stats_rebuilt"] is True
+    assert stats["total_messages"] == 3
+    assert stats["current_streak"] == 3
+
+
+def test_reimport_counts_duplicates_without_double_counting_stats(db):
+    body = ndjson([record(0, 1), record(1, 0)])
+
+    async def scenario():
+        # Created at startup by ensure_indexes
+        await db.chat_messages.create_index("id", unique=True)
+        await server.import_chat("u1", UploadRequest(body))
+        result = await server.import_chat("u1", UploadRequest(body + ndjson([record(2, 0)])))
+        return result, await server.user_stats.get("u1", 7)
+
+    result, stats = asyncio.run(scenario())
+    assert result["imported"] == 1 and result["duplicates"] == 2
+    assert stats["total_messages"] == 3
+
+
+def test_export_requires_the_admin_token(db, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    asyncio.run(db.chat_messages.insert_one({**record(0, 0), "timestamp": TODAY}))
+    # No lifespan: the startup hooks would connect to a real database
+    client = TestClient(server.app)
+
+    monkeypatch.setattr(server, "ADMIN_API_TOKEN", None)
+    assert client.get("/api/chat/u1/export").status_code == 404
+
+    monkeypatch.setattr(server, "ADMIN_API_TOKEN", "secret")
+    assert client.get("/api/chat/u1/export").status_code == 401
+    assert client.get("/api/chat/u1/export", headers={"Authorization": "Bearer wrong"}).status_code == 401
+
+    response = client.get("/api/chat/u1/export", headers={"Authorization": "Bearer secret"})
+    assert response.status_code == 200
+    lines = gzip.decompress(response.content).splitlines()
+    assert [json.loads(line)["id"] for line in lines] == ["imported-0"]
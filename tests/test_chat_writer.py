@@ -0,0 +1,121 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+import server
+from server import ChatMessageWriter
+
+
+class FlakyCollection:
+    """Wraps a collection, counting insert_many calls and failing them while `down` is set"""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.down = False
+        self.batches = []
+
+    async def insert_many(self, documents, ordered=True):
+        if self.down:
+            raise ConnectionError("mongo unavailable")
+        self.batches.append(len(documents))
+        return await self.collection.insert_many(documents, ordered=ordered)
+
+
+def message(index):
+    return {"id": f"m{index}", "user_id": "u1", "message": f"שאלה {index}", "response": "תשובה", "timestamp": datetime.utcnow()}
+
+
+@pytest.fixture
+def collection():
+    return FlakyCollection(AsyncMongoMockClient()["test"].chat_messages)
+
+
+@pytest.fixture(autouse=True)
+def single_attempt(monkeypatch):
+    # Retries back off for seconds; one attempt is enough to reach the spill path
+    monkeypatch.setattr(server, "CHAT_WRITE_MAX_RETRIES", 1)
+
+
+def test_full_batch_is_written_without_waiting_for_the_interval(collection, tmp_path):
+    async def scenario():
+        writer = ChatMessageWriter(collection, batch_size=3, flush_interval=10, max_queue=10, spill_dir=tmp_path)
+        writer.start()
+        for index in range(3):
+            await writer.enqueue(message(index))
+        await asyncio.sleep(0.05)
+        written = writer.written
+        await writer.close()
+        return written
+
+    assert asyncio.run(scenario()) == 3
+    assert collection.batches == [3]
+
+
+def test_partial_batch_is_flushed_after_the_interval(collection, tmp_path):
+    async def scenario():
+        writer = ChatMessageWriter(collection, batch_size=100, flush_interval=0.05, max_queue=10, spill_dir=tmp_path)
+        writer.start()
+        await writer.enqueue(message(0))
+        await writer.enqueue(message(1))
+        await asyncio.sleep(0.01)
+        before = writer.written
+        await asyncio.sleep(0.1)
+        after = writer.written
+        await writer.close()
+        return before, after
+
+    assert asyncio.run(scenario()) == (0, 2)
+    assert collection.batches == [2]
+
+
+def test_close_flushes_everything_still_queued(collection, tmp_path):
+    async def scenario():
+        writer = ChatMessageWriter(collection, batch_size=2, flush_interval=10, max_queue=10, spill_dir=tmp_path)
+        writer.start()
+        for index in range(5):
+            await writer.enqueue(message(index))
+        await writer.close()
+        return await collection.collection.count_documents({})
+
+    assert asyncio.run(scenario()) == 5
+
+
+def test_failed_batches_spill_to_file_and_replay_once_mongo_is_back(collection, tmp_path):
+    async def scenario():
+        collection.down = True
+        writer = ChatMessageWriter(collection, batch_size=2, flush_interval=10, max_queue=10, spill_dir=tmp_path)
+        writer.start()
+        for index in range(3):
+            await writer.enqueue(message(index))
+        await writer.close()
+        spilled = writer.spilled
+        spill_files = list(tmp_path.glob("chat_messages_*.ndjson"))
+
+        # Next startup, with Mongo reachable again
+        collection.down = False
+        restarted = ChatMessageWriter(collection, batch_size=2, flush_interval=10, max_queue=10, spill_dir=tmp_path)
+        await restarted.replay_spill()
+        stored = await collection.collection.find({}, {"_id": 0}).sort("id", 1).to_list(None)
+        return spilled, spill_files, stored, list(tmp_path.iterdir())
+
+    spilled, spill_files, stored, leftovers = asyncio.run(scenario())
+    assert spilled == 3 and len(spill_files) == 1
+    assert [doc["id"] for doc in stored] == ["m0", "m1", "m2"]
+    # Timestamps survive the round trip through the spill file as datetimes
+    assert all(isinstance(doc["timestamp"], datetime) for doc in stored)
+    assert leftovers == []
+
+
+def test_replay_after_a_partial_write_skips_what_already_landed(collection, tmp_path):
+    async def scenario():
+        await collection.collection.create_index("id", unique=True)
+        writer = ChatMessageWriter(collection, batch_size=10, flush_interval=10, max_queue=10, spill_dir=tmp_path)
+        documents = [message(index) for index in range(3)]
+        await collection.collection.insert_one(dict(documents[0]))
+        writer._spill(documents)
+        await writer.replay_spill()
+        return writer.written, await collection.collection.count_documents({})
+
+    assert asyncio.run(scenario()) == (2, 3)
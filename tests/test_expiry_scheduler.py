@@ -0,0 +1,174 @@
+import asyncio
+
+import pytest
+
+import server
+from server import ConnectionManager, ExpiryScheduler, InMemoryBackplane
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(server.time, "monotonic", clock)
+    return clock
+
+
+def advance(clock, scheduler, seconds: float) -> int:
+    clock.now += seconds
+    return scheduler.run_due()
+
+
+def test_runs_due_callbacks_in_deadline_order(clock):
+    scheduler = ExpiryScheduler()
+    fired = []
+    scheduler.schedule("b", 20, fired.append)
+    scheduler.schedule("a", 10, fired.append)
+    scheduler.schedule("c", 30, fired.append)
+    assert advance(clock, scheduler, 5) == 0
+    assert advance(clock, scheduler, 20) == 2
+    assert fired == ["a", "b"]
+    assert len(scheduler) == 1
+
+
+def test_rescheduling_moves_the_deadline_and_skips_the_stale_entry(clock):
+    scheduler = ExpiryScheduler()
+    fired = []
+    scheduler.schedule("session", 10, fired.append)
+    scheduler.schedule("session", 60, fired.append)
+    assert advance(clock, scheduler, 30) == 0
+    assert advance(clock, scheduler, 90) == 1
+    assert fired == ["session"]
+
+
+def test_cancelled_keys_never_fire(clock):
+    scheduler = ExpiryScheduler()
+    fired = []
+    scheduler.schedule("a", 10, fired.append)
+    scheduler.cancel("a")
+    scheduler.cancel("missing")
+    assert advance(clock, scheduler, 20) == 0
+    assert fired == [] and len(scheduler) == 0
+
+
+def test_every_repeats_until_cancelled(clock):
+    scheduler = ExpiryScheduler()
+    calls = []
+    scheduler.every("maintenance", 10, lambda: calls.append(1))
+    advance(clock, scheduler, 11)
+    advance(clock, scheduler, 11)
+    assert len(calls) == 2 and len(scheduler) == 1
+    scheduler.cancel("maintenance")
+    advance(clock, scheduler, 100)
+    assert len(calls) == 2
+
+
+def test_failing_callback_does_not_stop_the_others(clock):
+    scheduler = ExpiryScheduler()
+    fired = []
+
+    def fail(key):
+        raise RuntimeError("boom")
+
+    scheduler.schedule("bad", 1, fail)
+    scheduler.schedule("good", 2, fired.append)
+    assert advance(clock, scheduler, 5) == 2
+    assert fired == ["good"]
+
+
+def test_heap_is_compacted_when_stale_entries_pile_up(clock):
+    scheduler = ExpiryScheduler()
+    for delay in range(5000):
+        scheduler.schedule("hot-key", 100 + delay, lambda key: None)
+    assert len(scheduler) == 1
+    assert scheduler.stats()["heap_size"] <= 2 * len(scheduler) + 1024
+    assert advance(clock, scheduler, 10_000) == 1
+
+
+def test_runner_wakes_up_for_an_earlier_deadline():
+    async def scenario():
+        scheduler = ExpiryScheduler()
+        fired = asyncio.Event()
+        scheduler.schedule("far", 3600, lambda key: None)
+        scheduler.start()
+        await asyncio.sleep(0.01)
+        scheduler.schedule("soon", 0.02, lambda key: fired.set())
+        try:
+            await asyncio.wait_for(fired.wait(), 1)
+        finally:
+            await scheduler.close()
+        return len(scheduler)
+
+    assert asyncio.run(scenario()) == 1
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.incoming: asyncio.Queue = asyncio.Queue()
+        self.sent = []
+        self.close_code = None
+
+    async def accept(self):
+        pass
+
+    async def receive_text(self):
+        return await self.incoming.get()
+
+    async def send_text(self, message):
+        self.sent.append(message)
+
+    async def close(self, code=1000):
+        self.close_code = code
+
+
+def test_only_clients_that_send_heartbeats_are_closed_for_missing_pongs(clock):
+    async def scenario():
+        scheduler = ExpiryScheduler()
+        manager = ConnectionManager(InMemoryBackplane(), scheduler)
+        legacy_socket, heartbeat_socket = FakeWebSocket(), FakeWebSocket()
+        await manager.connect(legacy_socket, "legacy")
+        heartbeat = await manager.connect(heartbeat_socket, "modern")
+        heartbeat_socket.incoming.put_nowait('{"type": "ping"}')
+        await asyncio.sleep(0)
+
+        advance(clock, scheduler, server.WS_PING_INTERVAL_SECONDS)
+        await asyncio.sleep(0)
+        pinged = '{"type":"ping"}' in legacy_socket.sent and '{"type":"ping"}' in heartbeat_socket.sent
+
+        advance(clock, scheduler, server.WS_PONG_TIMEOUT_SECONDS)
+        await asyncio.sleep(0)
+        after_pong_timeout = (manager.is_connected("legacy"), manager.is_connected("modern"), heartbeat.closed)
+
+        advance(clock, scheduler, server.WS_IDLE_TIMEOUT_SECONDS)
+        await asyncio.sleep(0)
+        return pinged, after_pong_timeout, manager.is_connected("legacy"), legacy_socket.close_code, manager.reaped
+
+    pinged, after_pong_timeout, legacy_connected, legacy_code, reaped = asyncio.run(scenario())
+    assert pinged
+    assert after_pong_timeout == (True, False, True)
+    assert not legacy_connected and legacy_code == 1001
+    assert reaped == 2
+
+
+def test_any_frame_keeps_a_heartbeat_client_alive(clock):
+    async def scenario():
+        scheduler = ExpiryScheduler()
+        manager = ConnectionManager(InMemoryBackplane(), scheduler)
+        websocket = FakeWebSocket()
+        await manager.connect(websocket, "u1")
+        websocket.incoming.put_nowait('{"type": "pong"}')
+        await asyncio.sleep(0)
+        for _ in range(5):
+            advance(clock, scheduler, server.WS_PING_INTERVAL_SECONDS)
+            websocket.incoming.put_nowait('{"type": "pong"}')
+            await asyncio.sleep(0)
+        return manager.is_connected("u1")
+
+    assert asyncio.run(scenario())
@@ -0,0 +1,145 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+import server
+from server import ModelRouter, PlanJobQueue, ProductionFitnessTrainer, load_llm_routes
+
+
+class SlowChat:
+    """Stand-in LlmChat that answers each call after `delay` seconds, or raises the scripted errors first"""
+
+    def __init__(self, delay, errors=()):
+        self.delay = delay
+        self.errors = list(errors)
+        self.calls = 0
+
+    async def send_message(self, message):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        await asyncio.sleep(self.delay)
+        return "תוכנית של 8 שבועות"
+
+
+class Profiles:
+    async def get(self, user_id):
+        return None
+
+
+class Connections:
+    def __init__(self):
+        self.frames = []
+
+    async def push(self, user_id, frame):
+        self.frames.append(frame)
+
+
+@pytest.fixture(autouse=True)
+def short_plan_budget(monkeypatch):
+    monkeypatch.setattr(server, "PLAN_DEADLINE_SECONDS", 1.0)
+    monkeypatch.setattr(server, "LLM_RETRY_BASE_DELAY_SECONDS", 0.001)
+
+
+def make_queue(chat):
+    routes = load_llm_routes()
+    # The plan route's chat-sized attempt timeout is far shorter than a plan takes
+    routes["plan"]["attempt_timeout"] = 0.05
+    trainer = ProductionFitnessTrainer("test-key", router=ModelRouter(routes))
+    trainer.llm.hedge = False
+    trainer._new_chat = lambda session_id, route: chat
+    db = AsyncMongoMockClient()["test"]
+    return PlanJobQueue(db.plans, trainer, Profiles(), Connections(), workers=1, max_queue=10)
+
+
+def test_plan_attempts_may_run_for_the_whole_plan_deadline():
+    chat = SlowChat(0.2)
+    queue = make_queue(chat)
+
+    async def scenario():
+        job, _ = await queue.submit("u1", "תוכנית אימון ל-8 שבועות")
+        await queue._run(job["id"])
+        return await queue.get(job["id"])
+
+    job = asyncio.run(scenario())
+    assert job["status"] == "completed" and job["attempts"] == 1
+    assert chat.calls == 1
+
+
+def test_worker_that_lost_its_lease_cannot_overwrite_the_job():
+    chat = SlowChat(0.1)
+    queue = make_queue(chat)
+
+    async def scenario():
+        job, _ = await queue.submit("u1", "תוכנית אימון ל-8 שבועות")
+        running = asyncio.ensure_future(queue._run(job["id"]))
+        await asyncio.sleep(0.05)
+        # The lease lapsed and another worker reclaimed the job mid-generation
+        await queue.collection.update_one(
+            {"id": job["id"]}, {"$set": {"worker_id": "other-worker"}, "$inc": {"attempts": 1}}
+        )
+        await running
+        return await queue.collection.find_one({"id": job["id"]})
+
+    job = asyncio.run(scenario())
+    assert job["status"] == "running" and job["worker_id"] == "other-worker"
+    assert job.get("result") is None
+    assert queue.completed == 0
+    assert all(frame["status"] != "completed" for frame in queue.connections.frames)
+
+
+def test_temporary_failure_requeues_the_job_with_backoff():
+    # Every attempt inside the first job attempt fails, so the LLM client gives up
+    chat = SlowChat(0, errors=[ConnectionError("reset")] * (server.LLM_MAX_RETRIES + 1))
+    queue = make_queue(chat)
+
+    async def scenario():
+        job, _ = await queue.submit("u1", "תוכנית אימון ל-8 שבועות")
+        await queue._run(job["id"])
+        requeued = await queue.collection.find_one({"id": job["id"]})
+        # Not due yet, so no worker may claim it
+        await queue._run(job["id"])
+        await queue.collection.update_one({"id": job["id"]}, {"$set": {"retry_at": datetime.utcnow()}})
+        await queue._run(job["id"])
+        await queue.close()
+        return requeued, await queue.get(job["id"])
+
+    requeued, job = asyncio.run(scenario())
+    assert requeued["status"] == "queued" and requeued["attempts"] == 1
+    assert requeued["retry_at"] > datetime.utcnow()
+    assert "dedupe_key" in requeued
+    assert job["status"] == "completed" and job["attempts"] == 2
+    assert job.get("error") is None
+    assert queue.retried == 1 and queue.failed == 0
+    assert [frame["status"] for frame in queue.connections.frames] == ["running", "queued", "running", "completed"]
+
+
+def test_job_fails_once_attempts_run_out(monkeypatch):
+    monkeypatch.setattr(server, "PLAN_MAX_ATTEMPTS", 1)
+    chat = SlowChat(0, errors=[ConnectionError("reset")] * (server.LLM_MAX_RETRIES + 1))
+    queue = make_queue(chat)
+
+    async def scenario():
+        job, _ = await queue.submit("u1", "תוכנית אימון ל-8 שבועות")
+        await queue._run(job["id"])
+        return await queue.collection.find_one({"id": job["id"]})
+
+    job = asyncio.run(scenario())
+    assert job["status"] == "failed" and "dedupe_key" not in job
+    assert queue.failed == 1 and queue.retried == 0
+
+
+def test_rejected_request_fails_without_retry():
+    chat = SlowChat(0, errors=[ValueError("bad request")])
+    queue = make_queue(chat)
+
+    async def scenario():
+        job, _ = await queue.submit("u1", "תוכנית אימון ל-8 שבועות")
+        await queue._run(job["id"])
+        return await queue.get(job["id"])
+
+    job = asyncio.run(scenario())
+    assert job["status"] == "failed" and job["attempts"] == 1
+    assert chat.calls == 1 and queue.retried == 0
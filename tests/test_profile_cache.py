@@ -0,0 +1,75 @@
+import asyncio
+
+from mongomock_motor import AsyncMongoMockClient
+
+from server import ProfileCache
+
+
+class SlowReads:
+    """Wraps a collection so reads return the data they saw at the start, only once released"""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.release = asyncio.Event()
+
+    async def find_one(self, query, *args, **kwargs):
+        doc = await self.collection.find_one(query, *args, **kwargs)
+        await self.release.wait()
+        return doc
+
+    def find(self, query, *args, **kwargs):
+        return self.collection.find(query, *args, **kwargs)
+
+
+def test_miss_is_cached_and_served_without_another_read():
+    async def scenario():
+        db = AsyncMongoMockClient()["test"]
+        await db.user_profiles.insert_one({"user_id": "u1", "name": "Alice"})
+        cache = ProfileCache(db.user_profiles, 10, 60)
+        first = await cache.get("u1")
+        await db.user_profiles.update_one({"user_id": "u1"}, {"$set": {"name": "Changed elsewhere"}})
+        return first, await cache.get("u1")
+
+    first, second = asyncio.run(scenario())
+    assert first["name"] == second["name"] == "Alice"
+
+
+def test_read_racing_a_write_does_not_cache_the_old_profile():
+    async def scenario():
+        db = AsyncMongoMockClient()["test"]
+        await db.user_profiles.insert_one({"user_id": "u1", "name": "Alice"})
+        slow = SlowReads(db.user_profiles)
+        cache = ProfileCache(slow, 10, 60)
+        reading = asyncio.ensure_future(cache.get("u1"))
+        await asyncio.sleep(0)
+        # A profile update lands while the read is still in flight
+        await db.user_profiles.update_one({"user_id": "u1"}, {"$set": {"name": "Alicia"}})
+        cache.invalidate("u1")
+        slow.release.set()
+        stale = await reading
+        return stale, await cache.get("u1")
+
+    stale, fresh = asyncio.run(scenario())
+    assert stale["name"] == "Alice"
+    assert fresh["name"] == "Alicia"
+
+
+def test_batch_read_racing_an_invalidation_skips_only_that_user():
+    async def scenario():
+        db = AsyncMongoMockClient()["test"]
+        await db.user_profiles.insert_many([{"user_id": "u1", "name": "Alice"}, {"user_id": "u2", "name": "Bob"}])
+        cache = ProfileCache(db.user_profiles, 10, 60)
+        original_find = db.user_profiles.find
+
+        def find_then_invalidate(query, *args, **kwargs):
+            cursor = original_find(query, *args, **kwargs)
+            cache.invalidate("u1")
+            return cursor
+
+        cache.collection = type("Collection", (), {"find": staticmethod(find_then_invalidate)})()
+        await cache.get_many(["u1", "u2"])
+        return cache.cache.get("u1"), cache.cache.get("u2")
+
+    u1, u2 = asyncio.run(scenario())
+    assert u1 is None
+    assert u2["name"] == "Bob"
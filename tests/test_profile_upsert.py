@@ -0,0 +1,92 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+from mongomock_motor import AsyncMongoMockClient
+from pymongo.errors import DuplicateKeyError
+
+import server
+from server import ProfileCache, UserProfile, upsert_profile
+
+
+class RacingProfiles:
+    """Wraps user_profiles so the first upsert loses a race the way Mongo reports it.
+
+    Another request's upsert lands first, and this one fails with a duplicate
+    key error on the unique user_id index instead of matching it.
+    """
+
+    def __init__(self, collection, winner: UserProfile):
+        self.collection = collection
+        self.winner = winner
+        self.raced = False
+
+    async def find_one_and_update(self, *args, **kwargs):
+        if not self.raced:
+            self.raced = True
+            await self.collection.insert_one(self.winner.dict())
+            raise DuplicateKeyError("E11000 duplicate key error collection: user_profiles index: profile_user_id")
+        return await self.collection.find_one_and_update(*args, **kwargs)
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = AsyncMongoMockClient()["test"]
+    # Created at startup by ensure_indexes
+    asyncio.run(db.user_profiles.create_index("user_id", unique=True))
+    monkeypatch.setattr(server, "db", db)
+    monkeypatch.setattr(server, "profile_cache", ProfileCache(db.user_profiles, 10, 60))
+    return db
+
+
+def test_concurrent_first_upserts_create_exactly_one_profile(db):
+    candidates = [UserProfile(user_id="u1", name=f"Name {index}", age=20 + index) for index in range(10)]
+
+    async def scenario():
+        return await asyncio.gather(*(upsert_profile(profile) for profile in candidates))
+
+    results = asyncio.run(scenario())
+    stored = asyncio.run(db.user_profiles.find({"user_id": "u1"}, {"_id": 0}).to_list(None))
+    assert len(stored) == 1
+    assert [created for _, created in results].count(True) == 1
+    # Every caller gets the winner's document, with its defaults intact
+    assert all(doc == stored[0] for doc, _ in results)
+    winner = next(profile for profile in candidates if profile.id == stored[0]["id"])
+    assert stored[0]["name"] == winner.name and stored[0]["age"] == winner.age
+    assert stored[0]["fitness_level"] == "beginner" and stored[0]["goals"] == []
+
+
+def test_upsert_that_loses_the_race_returns_the_winners_profile(db, monkeypatch):
+    winner = UserProfile(user_id="u1", name="Winner", goals=["כוח"])
+    monkeypatch.setattr(server, "db", type("Db", (), {"user_profiles": RacingProfiles(db.user_profiles, winner)})())
+    doc, created = asyncio.run(upsert_profile(UserProfile(user_id="u1", name="Loser")))
+    assert created is False
+    assert doc["id"] == winner.id and doc["name"] == "Winner" and doc["goals"] == ["כוח"]
+    assert asyncio.run(db.user_profiles.count_documents({"user_id": "u1"})) == 1
+
+
+def test_profile_routes_keep_the_first_profile_and_its_insert_defaults(db):
+    client = TestClient(server.app)
+    created = client.post("/api/profile", json={"user_id": "u1", "name": "Alice", "goals": ["כוח"]}).json()
+    again = client.post("/api/profile", json={"user_id": "u1", "name": "Someone else", "fitness_level": "advanced"}).json()
+    assert again == created
+
+    server.profile_cache.cache.pop("u1")
+    # A read of an existing profile does not replace it with the default one
+    assert client.get("/api/profile/u1").json() == created
+
+    updated = client.put("/api/profile/u1", json={"age": 31}).json()
+    assert updated["age"] == 31
+    assert {key: updated[key] for key in ("id", "name", "fitness_level", "goals", "created_at")} == \
+        {key: created[key] for key in ("id", "name", "fitness_level", "goals", "created_at")}
+    assert updated["updated_at"] > created["updated_at"]
+    assert asyncio.run(db.user_profiles.count_documents({})) == 1
+
+
+def test_get_creates_the_default_profile_once(db):
+    client = TestClient(server.app)
+    first = client.get("/api/profile/new-user").json()
+    server.profile_cache.cache.pop("new-user")
+    assert client.get("/api/profile/new-user").json() == first
+    assert first["name"] == "משתמש" and first["fitness_level"] == "beginner"
+    assert client.put("/api/profile/missing", json={"age": 30}).status_code == 404
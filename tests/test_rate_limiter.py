@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+
+import server
+from server import InMemoryRateLimiter, sliding_window_count
+
+
+class Clock:
+    def __init__(self, now: float):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # Start on a minute boundary so bucket arithmetic is easy to follow
+    clock = Clock(1_700_000_040.0)
+    monkeypatch.setattr(server.time, "time", clock)
+    return clock
+
+
+def hits(limiter, user_id, count):
+    return [asyncio.run(limiter.hit(user_id)) for _ in range(count)]
+
+
+def test_sliding_window_count_weights_previous_bucket_by_overlap():
+    assert sliding_window_count(10, 2, now=120.0, size=60) == 12
+    assert sliding_window_count(10, 2, now=150.0, size=60) == 7
+    assert sliding_window_count(10, 2, now=179.0, size=60) == pytest.approx(10 / 60 + 2)
+
+
+def test_allows_up_to_the_limit_then_rejects(clock):
+    limiter = InMemoryRateLimiter(windows=(("minute", 60, 3),))
+    assert hits(limiter, "u1", 4) == [True, True, True, False]
+    # Users are limited independently
+    assert hits(limiter, "u2", 1) == [True]
+
+
+def test_rejected_requests_do_not_count(clock):
+    limiter = InMemoryRateLimiter(windows=(("minute", 60, 2),))
+    hits(limiter, "u1", 5)
+    clock.now += 60
+    # The previous bucket holds the two accepted hits, fully weighted at the boundary
+    assert hits(limiter, "u1", 1) == [False]
+    clock.now += 30
+    # Half of the previous bucket still overlaps the window: 1 < 2
+    assert hits(limiter, "u1", 1) == [True]
+    assert hits(limiter, "u1", 1) == [False]
+
+
+def test_previous_bucket_is_forgotten_after_a_gap(clock):
+    limiter = InMemoryRateLimiter(windows=(("minute", 60, 2),))
+    hits(limiter, "u1", 2)
+    clock.now += 120
+    assert hits(limiter, "u1", 2) == [True, True]
+
+
+def test_every_window_is_enforced(clock):
+    limiter = InMemoryRateLimiter(windows=(("minute", 60, 5), ("hour", 3600, 6)))
+    assert hits(limiter, "u1", 5) == [True] * 5
+    clock.now += 120
+    assert hits(limiter, "u1", 2) == [True, False]
+
+
+def test_evict_idle_drops_only_users_past_every_window(clock):
+    limiter = InMemoryRateLimiter(windows=(("minute", 60, 5),))
+    hits(limiter, "old", 1)
+    clock.now += 100
+    hits(limiter, "recent", 1)
+    clock.now += 30
+    assert limiter.evict_idle() == 1
+    assert len(limiter) == 1
+    assert hits(limiter, "recent", 1) == [True]
@@ -0,0 +1,148 @@
+import asyncio
+from collections import deque
+
+import pytest
+
+import server
+from server import (
+    PRIORITY_STANDARD, AdmissionScheduler, CircuitBreaker, CircuitOpen, EmptyLlmResponse, LlmRejected,
+    LlmUnavailable, ResilientLlmClient, is_transient_llm_error
+)
+
+
+class FakeChat:
+    """Stand-in LlmChat whose replies are scripted per call: a string, an exception, or a delay"""
+
+    def __init__(self, *script):
+        self.script = list(script)
+        self.calls = 0
+
+    async def send_message(self, message):
+        self.calls += 1
+        step = self.script.pop(0) if len(self.script) > 1 else self.script[0]
+        if isinstance(step, Exception):
+            raise step
+        if isinstance(step, tuple):
+            delay, step = step
+            await asyncio.sleep(delay)
+        return step
+
+
+class UpstreamError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"upstream returned {status_code}")
+        self.status_code = status_code
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(server, "LLM_RETRY_BASE_DELAY_SECONDS", 0.001)
+
+
+def make_client(threshold=5, **options):
+    options.setdefault("hedge", False)
+    breaker = CircuitBreaker(threshold, 30)
+    return ResilientLlmClient(AdmissionScheduler(4, 10, 5.0), breaker, **options), breaker
+
+
+def send(client, chat, **options):
+    return asyncio.run(client.send(chat, "שלום", "u1", PRIORITY_STANDARD, new_chat=lambda: chat, **options))
+
+
+def test_breaker_opens_at_threshold_and_probes_after_reset():
+    breaker = CircuitBreaker(2, 30)
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN and not breaker.allow()
+    breaker.opened_at -= 30
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # A single probe at a time
+    assert breaker.allow() and not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN and breaker.trips == 2
+    breaker.opened_at -= 30
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED and breaker.failures == 0
+
+
+def test_released_probe_lets_the_next_call_probe():
+    breaker = CircuitBreaker(1, 30)
+    breaker.record_failure()
+    breaker.opened_at -= 30
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.allow()
+
+
+def test_transient_errors_are_classified():
+    assert is_transient_llm_error(asyncio.TimeoutError())
+    assert is_transient_llm_error(ConnectionResetError())
+    assert is_transient_llm_error(UpstreamError(503))
+    assert is_transient_llm_error(UpstreamError(429))
+    assert is_transient_llm_error(RuntimeError("unknown"))
+    assert not is_transient_llm_error(UpstreamError(400))
+    assert not is_transient_llm_error(EmptyLlmResponse())
+    assert not is_transient_llm_error(ValueError("bad request"))
+
+
+def test_transient_failure_is_retried_on_a_fresh_session():
+    client, breaker = make_client()
+    chat = FakeChat(UpstreamError(503), "  תשובה  ")
+    response, answered_by = send(client, chat)
+    assert (response, answered_by, chat.calls) == ("תשובה", chat, 2)
+    assert client.retries == 1 and breaker.failures == 0
+
+
+def test_a_failed_call_counts_once_toward_the_breaker():
+    client, breaker = make_client(max_retries=2)
+    chat = FakeChat(UpstreamError(503))
+    with pytest.raises(LlmUnavailable):
+        send(client, chat)
+    assert chat.calls == 3
+    assert client.failures == 3
+    assert breaker.failures == 1 and breaker.state == CircuitBreaker.CLOSED
+
+
+@pytest.mark.parametrize("error", [UpstreamError(400), ValueError("bad request"), ""])
+def test_non_transient_failures_are_not_retried_or_counted(error):
+    client, breaker = make_client()
+    chat = FakeChat(error)
+    with pytest.raises(LlmRejected):
+        send(client, chat)
+    assert chat.calls == 1
+    assert breaker.failures == 0 and breaker.state == CircuitBreaker.CLOSED
+
+
+def test_open_circuit_fails_fast_without_calling_upstream():
+    client, breaker = make_client(threshold=2, max_retries=0)
+    chat = FakeChat(UpstreamError(500))
+    for _ in range(2):
+        with pytest.raises(LlmUnavailable):
+            send(client, chat)
+    with pytest.raises(CircuitOpen):
+        send(client, chat)
+    assert chat.calls == 2
+
+
+def test_attempts_are_bounded_by_the_deadline():
+    client, breaker = make_client(max_retries=5)
+    chat = FakeChat((1.0, "late"))
+    with pytest.raises(LlmUnavailable):
+        send(client, chat, attempt_timeout=0.02, deadline=0.1)
+    assert chat.calls < 6
+    assert breaker.failures == 1
+
+
+def test_slow_attempt_is_hedged_and_the_first_answer_wins(monkeypatch):
+    monkeypatch.setattr(server, "LLM_HEDGE_MIN_DELAY_SECONDS", 0.01)
+    client, _ = make_client(hedge=True)
+    client.latencies["default"] = deque([0.01] * server.LLM_HEDGE_MIN_SAMPLES)
+    slow = FakeChat((1.0, "slow"))
+    fast = FakeChat("fast")
+    response, answered_by = asyncio.run(
+        client.send(slow, "שלום", "u1", PRIORITY_STANDARD, new_chat=lambda: fast)
+    )
+    assert (response, answered_by) == ("fast", fast)
+    assert client.hedges == 1 and client.hedge_wins == 1
@@ -0,0 +1,43 @@
+import asyncio
+
+from server import RESPONSE_CACHE_MAX_MESSAGE_LENGTH, ResponseCache, normalize_message
+
+ALICE = {"name": "Alice", "age": 30, "fitness_level": "beginner", "goals": ["כוח", "סיבולת"]}
+
+
+def test_normalize_message_ignores_case_punctuation_and_niqqud():
+    assert normalize_message("  Hello,   WORLD!! ") == "hello world"
+    assert normalize_message("שָׁלוֹם!") == normalize_message("שלום")
+
+
+def test_key_is_shared_by_trivial_variations():
+    cache = ResponseCache(10, 60)
+    assert cache.make_key("כמה חלבון לאכול?", ALICE) == cache.make_key("כמה  חלבון לאכול", dict(ALICE))
+
+
+def test_key_covers_every_profile_field_in_the_prompt():
+    cache = ResponseCache(10, 60)
+    key = cache.make_key("כמה חלבון לאכול", ALICE)
+    # Same level and goals, but the prompt would carry a different name or age
+    assert cache.make_key("כמה חלבון לאכול", dict(ALICE, name="Bob")) != key
+    assert cache.make_key("כמה חלבון לאכול", dict(ALICE, age=41)) != key
+    assert cache.make_key("כמה חלבון לאכול", dict(ALICE, fitness_level="advanced")) != key
+    assert cache.make_key("כמה חלבון לאכול", dict(ALICE, goals=["כוח"])) != key
+    assert cache.make_key("כמה חלבון לאכול", None) != key
+
+
+def test_long_and_empty_messages_are_not_cached():
+    cache = ResponseCache(10, 60)
+    assert cache.make_key("א " * RESPONSE_CACHE_MAX_MESSAGE_LENGTH, ALICE) is None
+    assert cache.make_key("?!", ALICE) is None
+
+
+def test_memory_tier_round_trip():
+    async def scenario():
+        cache = ResponseCache(10, 60)
+        key = cache.make_key("שלום", None)
+        assert await cache.get(key) is None
+        await cache.set(key, "היי")
+        return await cache.get(key)
+
+    assert asyncio.run(scenario()) == "היי"
@@ -0,0 +1,97 @@
+import asyncio
+
+import server
+from server import SingleFlight
+
+
+def test_concurrent_calls_share_one_execution():
+    async def scenario():
+        flight = SingleFlight()
+        calls = 0
+
+        async def work():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return "answer"
+
+        results = await asyncio.gather(*(flight.do("k", work) for _ in range(5)))
+        return results, calls, flight.stats()
+
+    results, calls, stats = asyncio.run(scenario())
+    assert results == ["answer"] * 5
+    assert calls == 1
+    assert stats == {"in_flight": 0, "executions": 1, "coalesced": 4}
+
+
+def test_key_is_released_once_the_call_completes():
+    async def scenario():
+        flight = SingleFlight()
+        first = await flight.do("k", lambda: asyncio.sleep(0, "first"))
+        second = await flight.do("k", lambda: asyncio.sleep(0, "second"))
+        return first, second
+
+    assert asyncio.run(scenario()) == ("first", "second")
+
+
+def test_exception_is_delivered_to_every_waiter():
+    async def scenario():
+        flight = SingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise RuntimeError("upstream down")
+
+        return await asyncio.gather(*(flight.do("k", fail) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_cancelled_waiter_does_not_cancel_the_others():
+    async def scenario():
+        flight = SingleFlight()
+        started = asyncio.Event()
+
+        async def work():
+            started.set()
+            await asyncio.sleep(0.02)
+            return "answer"
+
+        leaving = asyncio.ensure_future(flight.do("k", work))
+        staying = asyncio.ensure_future(flight.do("k", work))
+        await started.wait()
+        leaving.cancel()
+        return await staying
+
+    assert asyncio.run(scenario()) == "answer"
+
+
+def test_work_is_cancelled_when_every_waiter_leaves():
+    async def scenario():
+        flight = SingleFlight()
+        cancelled = asyncio.Event()
+
+        async def work():
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        waiter = asyncio.ensure_future(flight.do("k", work))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.wait_for(cancelled.wait(), 1)
+        return flight.stats()["in_flight"]
+
+    assert asyncio.run(scenario()) == 0
+
+
+def test_flight_key_covers_the_whole_upstream_prompt():
+    trainer = server.fitness_trainer
+    key = trainer._flight_key("שאלה\n\n--- פרופיל המשתמש ---\nשם: Alice\n", "standard", True)
+    assert trainer._flight_key("שאלה\n\n--- פרופיל המשתמש ---\nשם: Bob\n", "standard", True) != key
+    assert trainer._flight_key("שאלה\n\n--- פרופיל המשתמש ---\nשם: Alice\n", "plan", True) != key
+    assert trainer._flight_key("שאלה", "standard", False) is None
+
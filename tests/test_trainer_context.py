@@ -0,0 +1,83 @@
+import asyncio
+
+import server
+from server import ModelRouter, ProductionFitnessTrainer, ResponseCache, load_llm_routes
+
+PROFILE = {"name": "Alice", "age": 30, "fitness_level": "beginner", "goals": ["כוח"]}
+
+
+class CountingChat:
+    calls = 0
+
+    async def send_message(self, message):
+        CountingChat.calls += 1
+        await asyncio.sleep(0.01)
+        return f"reply {CountingChat.calls}"
+
+
+class FakeContext:
+    """Stand-in ConversationContext for a returning user with earlier turns on record"""
+
+    def __init__(self):
+        self.builds = 0
+
+    async def build(self, user_id):
+        self.builds += 1
+        return "--- סיכום השיחה ---\nהמשתמש שאל על אימוני כוח"
+
+    def observe_prompt(self, prompt):
+        pass
+
+
+def make_trainer():
+    CountingChat.calls = 0
+    context = FakeContext()
+    trainer = ProductionFitnessTrainer("test-key", response_cache=ResponseCache(10, 60), context=context)
+    trainer._new_chat = lambda session_id, route: CountingChat()
+    return trainer, context
+
+
+def test_standalone_messages_are_short_and_do_not_refer_back():
+    router = ModelRouter(load_llm_routes())
+    assert router.is_standalone("כמה חלבון לאכול?")
+    assert router.is_standalone("תודה רבה!")
+    assert not router.is_standalone("ומה עם זה?")
+    assert not router.is_standalone("תן לי עוד תרגילים")
+    assert not router.is_standalone("can you explain that again")
+    assert not router.is_standalone(" ".join(["מילה"] * (server.ROUTE_STANDALONE_MAX_WORDS + 1)))
+
+
+def test_returning_users_repeated_faq_is_served_from_cache():
+    trainer, context = make_trainer()
+
+    async def scenario():
+        first = await trainer.get_response("כמה חלבון לאכול?", "returning", PROFILE)
+        second = await trainer.get_response("כמה חלבון לאכול", "returning", PROFILE)
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert first == second
+    assert CountingChat.calls == 1
+    assert context.builds == 0
+
+
+def test_concurrent_faq_from_returning_users_is_coalesced():
+    trainer, _ = make_trainer()
+
+    async def scenario():
+        return await asyncio.gather(*(trainer.get_response("איך לשפר סיבולת", "returning", PROFILE) for _ in range(5)))
+
+    assert len(set(asyncio.run(scenario()))) == 1
+    assert CountingChat.calls == 1
+
+
+def test_follow_ups_carry_context_and_are_not_shared():
+    trainer, context = make_trainer()
+
+    async def scenario():
+        await trainer.get_response("ומה עם זה?", "returning", PROFILE)
+        await trainer.get_response("ומה עם זה?", "returning", PROFILE)
+
+    asyncio.run(scenario())
+    assert CountingChat.calls == 2
+    assert context.builds == 2
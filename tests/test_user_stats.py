@@ -0,0 +1,114 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from mongomock_motor import AsyncMongoMockClient
+
+from server import UserStats, classify_topics, compute_streaks, local_day, previous_day
+
+TODAY = datetime.utcnow().replace(hour=10, minute=0, second=0, microsecond=0)
+
+
+def turn(user_id, days_ago, message="שלום", minutes=0):
+    return {
+        "id": f"{user_id}-{days_ago}-{minutes}",
+        "user_id": user_id,
+        "message": message,
+        "response": "תשובה",
+        "timestamp": TODAY - timedelta(days=days_ago) + timedelta(minutes=minutes),
+    }
+
+
+async def make_stats():
+    db = AsyncMongoMockClient()["test"]
+    stats = UserStats(db.user_stats, db.chat_messages, db.chat_archive)
+    await stats.setup()
+    return db, stats
+
+
+def test_streaks_count_consecutive_days():
+    assert compute_streaks([]) == (0, 0)
+    assert compute_streaks(["2026-03-01"]) == (1, 1)
+    assert compute_streaks(["2026-03-03", "2026-03-01", "2026-03-02", "2026-03-05"]) == (1, 3)
+    assert compute_streaks(["2026-02-27", "2026-02-28", "2026-03-01"]) == (3, 3)
+
+
+def test_days_follow_the_stats_timezone():
+    # 22:30 UTC is already the next day in Israel
+    assert local_day(datetime(2026, 3, 1, 22, 30)) == "2026-03-02"
+    assert local_day(datetime(2026, 3, 1, 12, 0)) == "2026-03-01"
+    assert previous_day("2026-03-01") == "2026-02-28"
+
+
+def test_topics_match_word_starts_with_hebrew_prefixes():
+    assert classify_topics("כמה חלבון לאכול אחרי האימון?") == ["workout", "nutrition"]
+    assert classify_topics("אין לי מוטיבציה") == ["motivation"]
+    assert classify_topics("שלום מה נשמע") == ["other"]
+
+
+def test_record_extends_resets_and_keeps_the_longest_streak():
+    async def scenario():
+        _, stats = await make_stats()
+        for days_ago in (6, 5, 5, 4, 1, 0):
+            await stats.record(turn("u1", days_ago, "אימון ריצה"))
+        return await stats.get("u1")
+
+    result = asyncio.run(scenario())
+    assert result["total_messages"] == 6
+    assert result["active_days"] == 5
+    assert (result["current_streak"], result["longest_streak"]) == (2, 3)
+    assert result["topics"]["workout"] == 6
+
+
+def test_streak_is_reported_as_broken_after_a_missed_day():
+    async def scenario():
+        _, stats = await make_stats()
+        for days_ago in (4, 3, 2):
+            await stats.record(turn("u1", days_ago))
+        return await stats.get("u1")
+
+    result = asyncio.run(scenario())
+    assert (result["current_streak"], result["longest_streak"]) == (0, 3)
+
+
+def test_concurrent_first_messages_create_one_document():
+    async def scenario():
+        db, stats = await make_stats()
+        await asyncio.gather(*(stats.record(turn("u1", 0, minutes=i)) for i in range(5)))
+        return await db.user_stats.count_documents({}), await stats.get("u1")
+
+    documents, result = asyncio.run(scenario())
+    assert documents == 1
+    assert result["total_messages"] == 5 and result["current_streak"] == 1
+
+
+def test_late_message_is_counted_without_touching_streaks():
+    async def scenario():
+        _, stats = await make_stats()
+        await stats.record(turn("u1", 1))
+        await stats.record(turn("u1", 0))
+        # Arrives after today's message but belongs to three days ago
+        await stats.record(turn("u1", 3))
+        return await stats.get("u1")
+
+    result = asyncio.run(scenario())
+    assert result["total_messages"] == 3
+    assert (result["current_streak"], result["longest_streak"]) == (2, 2)
+
+
+def test_backfill_rebuilds_the_incremental_aggregates():
+    async def scenario():
+        db, stats = await make_stats()
+        turns = [turn("u1", days_ago, message) for days_ago, message in
+                 ((9, "כמה חלבון"), (8, "אימון כוח"), (2, "שלום"), (1, "אין לי מוטיבציה"), (0, "ריצה"))]
+        turns.append(turn("u2", 0, "דיאטה"))
+        for document in turns:
+            await stats.record(document)
+        await db.chat_messages.insert_many(turns)
+        live = {user_id: await stats.get(user_id) for user_id in ("u1", "u2")}
+        await db.user_stats.delete_many({})
+        written = await stats.backfill(batch_size=1)
+        return live, written, {user_id: await stats.get(user_id) for user_id in ("u1", "u2")}
+
+    live, written, rebuilt = asyncio.run(scenario())
+    assert written == 2
+    assert rebuilt == live